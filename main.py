@@ -7,28 +7,42 @@ import io
 import hmac
 import hashlib
 import time
+import heapq
+import os
+import random
+import functools
 import threading
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
+from itertools import islice
+from typing import List, Optional, Dict, Any, Iterable, Iterator, Union
 from decimal import Decimal
 
 import aiohttp
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import SendMessage, SendDocument, GetUpdates, AnswerCallbackQuery, GetChatMember, GetChat
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from sqlalchemy import create_engine, and_, or_
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import create_engine, and_, or_, insert, update, case, cast, func, event, exists, inspect, text
+from sqlalchemy.orm import sessionmaker, scoped_session, joinedload, contains_eager
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm.exc import StaleDataError
 
 from models import (
     Base, User, Service, Country, ServiceCountry, Number, Provider, ServiceProviderMap,
     Reservation, Transaction, Channel, UserChannelReward, Group, UserGroupReward,
     ProviderMessage, ServiceGroup, BlockedMessage, AdminAuditLink,
-    UserDataChannel, ForcedSubscription, UserSubscriptionStatus,
+    UserDataChannel, ForcedSubscription, UserSubscriptionStatus, StatsMessage, SystemCounters,
     NumberStatus, ReservationStatus, TransactionType, ProviderMode,
     SecurityMode, MessageStatus
 )
@@ -47,16 +61,112 @@ logger = logging.getLogger(__name__)
 # Database setup
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is required")
-engine = create_engine(DATABASE_URL, echo=False)
-SessionLocal = scoped_session(sessionmaker(bind=engine))
+engine = create_engine(
+    DATABASE_URL,
+    echo=False,
+    pool_size=25,
+    max_overflow=25,
+    pool_recycle=1800,  # Replace connections before the server drops idle ones
+    pool_pre_ping=True,
+    query_cache_size=1200  # Room for every distinct statement the handlers compile
+)
+
+if engine.dialect.name == 'sqlite':
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        """Use WAL so readers are not blocked by writers"""
+        # Let SQLAlchemy emit BEGIN itself (see begin_sqlite_transaction)
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-64000")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
+    
+    @event.listens_for(engine, "begin")
+    def begin_sqlite_transaction(conn):
+        """Take the write lock up front for sessions marked with sqlite_immediate"""
+        if conn.get_execution_options().get("sqlite_immediate"):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        else:
+            conn.exec_driver_sql("BEGIN")
+
+# Objects keep their loaded values after commit, so reading them later doesn't trigger a reload
+SessionLocal = scoped_session(sessionmaker(bind=engine, expire_on_commit=False))
+
+# Worker threads for blocking database work called from handlers
+DB_POOL = ThreadPoolExecutor(max_workers=8)
+# Separate small pool for the bulk cleanup statements so they can't starve handler work
+CLEANUP_POOL = ThreadPoolExecutor(max_workers=2)
+
+async def run_db(func, *args):
+    """Run blocking database work on DB_POOL, where each thread has its own session"""
+    return await asyncio.get_running_loop().run_in_executor(DB_POOL, func, *args)
+
+class RateLimiter:
+    """Allow at most max_rate acquisitions in any period-second window"""
+    
+    def __init__(self, max_rate: int, period: float):
+        self.max_rate = max_rate
+        self.period = period
+        self._calls = deque()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                if len(self._calls) < self.max_rate:
+                    self._calls.append(now)
+                    return
+                await asyncio.sleep(self.period - (now - self._calls[0]))
+
+class TelegramRateLimitMiddleware(BaseRequestMiddleware):
+    """Keep Bot API calls within Telegram's global and per-group limits and retry flood waits"""
+    
+    # Only posting messages counts against the per-group limit
+    GROUP_LIMITED_METHODS = (SendMessage, SendDocument)
+    # Polling, callback answers and membership lookups don't count against the global message limit,
+    # so a subscription sweep can't hold interactive replies behind it
+    OVERALL_EXEMPT_METHODS = (GetUpdates, AnswerCallbackQuery, GetChatMember, GetChat)
+    
+    def __init__(self, overall_max_rate: int = 30, overall_period: float = 1,
+                 group_max_rate: int = 20, group_period: float = 60, max_retries: int = 3):
+        self.overall = RateLimiter(overall_max_rate, overall_period)
+        self.groups = defaultdict(lambda: RateLimiter(group_max_rate, group_period))
+        self.max_retries = max_retries
+    
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        is_group_send = isinstance(method, self.GROUP_LIMITED_METHODS) and str(chat_id).startswith('-')
+        is_overall_limited = not isinstance(method, self.OVERALL_EXEMPT_METHODS)
+        
+        for attempt in range(self.max_retries + 1):
+            if is_overall_limited:
+                await self.overall.acquire()
+            if is_group_send:
+                await self.groups[str(chat_id)].acquire()
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"⏳ Telegram flood limit on {type(method).__name__}, retrying in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after + 0.1)
 
 # Bot setup
 bot = Bot(token=BOT_TOKEN)
+bot.session.middleware(TelegramRateLimitMiddleware())
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
 # Global variables for session management
-admin_sessions = {}  # {user_id: datetime}
+admin_sessions = {}  # {user_id: session expiry on the monotonic clock}
+ADMIN_SESSION_TTL = 3600  # 1 hour
 maintenance_mode = False
 
 def load_maintenance_mode():
@@ -86,6 +196,37 @@ auto_cleanup_enabled = True
 cleanup_interval_hours = 6  # Run cleanup every 6 hours
 message_retention_days = 3  # Keep messages for 3 days
 orphan_message_retention_hours = 24  # Keep orphan messages for 24 hours
+cleanup_task: Optional[asyncio.Task] = None
+
+# Detached tasks kept referenced until they finish so they aren't garbage collected mid-flight
+_background_tasks: set = set()
+
+def spawn_background(coro) -> asyncio.Task:
+    """Run a coroutine as a detached task"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Incoming group messages waiting for processing, drained by a fixed pool of workers
+GROUP_MESSAGE_QUEUE_SIZE = 2000
+GROUP_MESSAGE_WORKERS = 8
+GROUP_MESSAGE_DRAIN_TIMEOUT = 10  # seconds
+group_message_queue: asyncio.Queue = asyncio.Queue(maxsize=GROUP_MESSAGE_QUEUE_SIZE)
+group_message_tasks: List[asyncio.Task] = []
+
+# Reservation expiry schedule: heap of (expired_at, reservation_id) and a wake-up signal for the expiry loop
+expiry_heap: List[tuple] = []
+next_expiry_changed = asyncio.Event()
+EXPIRY_BATCH_SIZE = 100
+EXPIRY_RETRY_DELAY = 5  # seconds
+
+# Seeded per process so periodic tasks of restarted bots don't stay aligned
+_jitter_rng = random.Random(os.getpid())
+
+def jittered(seconds: float) -> float:
+    """Add up to 10% random delay to a periodic task interval"""
+    return seconds + _jitter_rng.uniform(0, seconds * 0.1)
 
 # FSM States
 class UserStates(StatesGroup):
@@ -169,6 +310,10 @@ def update_user_language(user_id: str, lang_code: str) -> bool:
 
 async def get_or_create_user(telegram_id: str, username: Optional[str] = None, first_name: Optional[str] = None, last_name: Optional[str] = None) -> tuple[User, bool]:
     """Get existing user or create new one. Returns (user, is_new_user)"""
+    return await run_db(_get_or_create_user_sync, telegram_id, username, first_name, last_name)
+
+def _get_or_create_user_sync(telegram_id: str, username: Optional[str], first_name: Optional[str], last_name: Optional[str]) -> tuple[User, bool]:
+    """Blocking part of get_or_create_user, run on the DB thread pool"""
     db = get_db()
     try:
         user = db.query(User).filter(User.telegram_id == telegram_id).first()
@@ -198,9 +343,13 @@ def is_admin_session_valid(user_id: int) -> bool:
     """Check if admin session is still valid"""
     if user_id == ADMIN_ID:
         return True
-    if user_id in admin_sessions:
-        # Session valid for 1 hour
-        return (datetime.now() - admin_sessions[user_id]).seconds < 3600
+    expires_at = admin_sessions.get(user_id)
+    if expires_at is None:
+        return False
+    if time.monotonic() < expires_at:
+        return True
+    # Drop the expired session so is_admin stops treating the user as logged in
+    del admin_sessions[user_id]
     return False
 
 def normalize_phone_number(phone: str) -> str:
@@ -294,35 +443,51 @@ def extract_last_three_digits_from_masked_number(message_text: str) -> Optional[
         logger.error(f"Error extracting last digits from masked number: {e}")
         return None
 
-async def find_reservation_by_last_digits(last_digits: str, service_id: int) -> Optional[Reservation]:
-    """Find active reservation by matching last 2-3 digits of phone number"""
-    db = get_db()
-    try:
-        # Get all active reservations for this service
-        active_reservations = db.query(Reservation).join(Number).filter(
-            Reservation.service_id == service_id,
-            Reservation.status == ReservationStatus.WAITING_CODE,
-            Reservation.expired_at > datetime.now()
-        ).all()
-        
-        digits_count = len(last_digits)
-        
-        # Check each reservation's phone number last digits
-        for reservation in active_reservations:
-            number = db.query(Number).filter(Number.id == reservation.number_id).first()
-            if number:
-                # Extract same number of digits as the search term
-                number_last_digits = extract_last_digits(str(number.phone_number), digits_count)
-                if number_last_digits == last_digits:
-                    logger.info(f"Found reservation by last {digits_count} digits '{last_digits}': {str(number.phone_number)}")
-                    return reservation
-        
+def find_reservations_by_last_digits(db, last_digits: str, service_ids: List[int]) -> Optional[tuple]:
+    """Find an active reservation and its number across several services by the last digits, in one query"""
+    if not last_digits or not service_ids:
         return None
-    except Exception as e:
-        logger.error(f"Error finding reservation by last digits: {e}")
+    
+    rows = db.query(Reservation, Number).join(
+        Number, Reservation.number_id == Number.id
+    ).filter(
+        Reservation.service_id.in_(service_ids),
+        Reservation.status == ReservationStatus.WAITING_CODE,
+        Reservation.expired_at > datetime.now(),
+        Number.phone_number.like(f"%{last_digits}")
+    ).order_by(Reservation.id).all()
+    
+    # Keep the priority of the given service order
+    by_service = {}
+    for reservation, number in rows:
+        by_service.setdefault(reservation.service_id, (reservation, number))
+    for service_id in service_ids:
+        if service_id in by_service:
+            return by_service[service_id]
+    return None
+
+def find_reservation_by_digit_runs(db, digit_runs: List[str], service_id: int) -> Optional[tuple]:
+    """Find the first digit run whose last 3 digits match an active reservation of a service, in one query"""
+    suffixes = list(dict.fromkeys(run[-3:] for run in digit_runs if len(run) >= 3))
+    if not suffixes:
         return None
-    finally:
-        db.close()
+    
+    rows = db.query(Reservation, Number).join(
+        Number, Reservation.number_id == Number.id
+    ).filter(
+        Reservation.service_id == service_id,
+        Reservation.status == ReservationStatus.WAITING_CODE,
+        Reservation.expired_at > datetime.now(),
+        or_(*[Number.phone_number.like(f"%{suffix}") for suffix in suffixes])
+    ).order_by(Reservation.id).all()
+    
+    by_suffix = {}
+    for reservation, number in rows:
+        by_suffix.setdefault(extract_last_digits(str(number.phone_number)), (reservation, number))
+    for suffix in suffixes:
+        if suffix in by_suffix:
+            return by_suffix[suffix]
+    return None
 
 async def search_in_orphan_messages(last_digits: str, service_id: int) -> Optional[tuple]:
     """Search for codes in orphan messages using last digits"""
@@ -336,10 +501,7 @@ async def search_in_orphan_messages(last_digits: str, service_id: int) -> Option
         ).order_by(ProviderMessage.received_at.desc()).limit(50).all()
         
         # Get regex pattern for this service
-        service_provider_map = db.query(ServiceProviderMap).filter(
-            ServiceProviderMap.service_id == service_id
-        ).first()
-        regex_pattern = str(service_provider_map.regex_pattern) if service_provider_map else r'\b\d{5,6}\b'
+        regex_pattern = get_service_regex(service_id)
         
         for msg in orphan_messages:
             # Check if message contains our last digits
@@ -349,7 +511,7 @@ async def search_in_orphan_messages(last_digits: str, service_id: int) -> Option
                 for full_number in numbers_in_message:
                     if extract_last_digits(full_number) == last_digits:
                         # Extract code from this message
-                        codes = re.findall(regex_pattern, str(msg.message_text))
+                        codes = regex_pattern.findall(str(msg.message_text))
                         if codes:
                             logger.info(f"Found orphan message with number ending {last_digits}: {full_number}, code: {codes[0]}")
                             return (full_number, codes[0], msg.message_text)
@@ -376,10 +538,7 @@ async def search_code_in_groups(phone_number: str, service_id: int) -> Optional[
             return None
         
         # Get regex pattern for this service
-        service_provider_map = db.query(ServiceProviderMap).filter(
-            ServiceProviderMap.service_id == service_id
-        ).first()
-        regex_pattern = str(service_provider_map.regex_pattern) if service_provider_map else r'\b\d{5,6}\b'
+        regex_pattern = get_service_regex(service_id)
         
         # Search in recent messages for this phone number
         for group in service_groups:
@@ -430,7 +589,7 @@ async def auto_search_for_code(reservation_id: int):
                 return
             
             # Get number for this reservation
-            number = db.query(Number).filter(Number.id == reservation.number_id).first()
+            number = db.get(Number, reservation.number_id)
             if not number:
                 logger.warning(f"Number not found for reservation {reservation_id}")
                 return
@@ -448,7 +607,7 @@ async def auto_search_for_code(reservation_id: int):
                 
                 if success:
                     # Send code to user
-                    service = db.query(Service).filter(Service.id == number.service_id).first()
+                    service = db.get(Service, number.service_id)
                     
                     await bot.send_message(
                         reservation.user_id,
@@ -472,393 +631,444 @@ async def auto_search_for_code(reservation_id: int):
     
     logger.info(f"Auto search completed for reservation {reservation_id} after {max_attempts} attempts")
 
+# Known international calling codes
+_COUNTRY_CODES = frozenset({
+    '+1',     # USA/Canada
+    '+7',     # Russia/Kazakhstan
+    '+20',    # Egypt
+    '+33',    # France
+    '+34',    # Spain
+    '+39',    # Italy
+    '+44',    # UK
+    '+49',    # Germany
+    '+52',    # Mexico
+    '+55',    # Brazil
+    '+60',    # Malaysia
+    '+61',    # Australia
+    '+62',    # Indonesia
+    '+63',    # Philippines
+    '+64',    # New Zealand
+    '+65',    # Singapore
+    '+66',    # Thailand
+    '+81',    # Japan
+    '+82',    # South Korea
+    '+84',    # Vietnam
+    '+86',    # China
+    '+90',    # Turkey
+    '+91',    # India
+    '+92',    # Pakistan
+    '+93',    # Afghanistan
+    '+94',    # Sri Lanka
+    '+95',    # Myanmar
+    '+98',    # Iran
+    '+212',   # Morocco
+    '+213',   # Algeria
+    '+216',   # Tunisia
+    '+218',   # Libya
+    '+220',   # Gambia
+    '+221',   # Senegal
+    '+222',   # Mauritania
+    '+223',   # Mali
+    '+224',   # Guinea
+    '+225',   # Ivory Coast
+    '+226',   # Burkina Faso
+    '+227',   # Niger
+    '+228',   # Togo
+    '+229',   # Benin
+    '+230',   # Mauritius
+    '+231',   # Liberia
+    '+232',   # Sierra Leone
+    '+233',   # Ghana
+    '+234',   # Nigeria
+    '+235',   # Chad
+    '+236',   # Central African Republic
+    '+237',   # Cameroon
+    '+238',   # Cape Verde
+    '+239',   # Sao Tome and Principe
+    '+240',   # Equatorial Guinea
+    '+241',   # Gabon
+    '+242',   # Republic of the Congo
+    '+243',   # Democratic Republic of the Congo
+    '+244',   # Angola
+    '+245',   # Guinea-Bissau
+    '+246',   # British Indian Ocean Territory
+    '+248',   # Seychelles
+    '+249',   # Sudan
+    '+250',   # Rwanda
+    '+251',   # Ethiopia
+    '+252',   # Somalia
+    '+253',   # Djibouti
+    '+254',   # Kenya
+    '+255',   # Tanzania
+    '+256',   # Uganda
+    '+257',   # Burundi
+    '+258',   # Mozambique
+    '+260',   # Zambia
+    '+261',   # Madagascar
+    '+262',   # Reunion
+    '+263',   # Zimbabwe
+    '+264',   # Namibia
+    '+265',   # Malawi
+    '+266',   # Lesotho
+    '+267',   # Botswana
+    '+268',   # Swaziland
+    '+269',   # Comoros
+    '+290',   # Saint Helena
+    '+291',   # Eritrea
+    '+297',   # Aruba
+    '+298',   # Faroe Islands
+    '+299',   # Greenland
+    '+350',   # Gibraltar
+    '+351',   # Portugal
+    '+352',   # Luxembourg
+    '+353',   # Ireland
+    '+354',   # Iceland
+    '+355',   # Albania
+    '+356',   # Malta
+    '+357',   # Cyprus
+    '+358',   # Finland
+    '+359',   # Bulgaria
+    '+370',   # Lithuania
+    '+371',   # Latvia
+    '+372',   # Estonia
+    '+373',   # Moldova
+    '+374',   # Armenia
+    '+375',   # Belarus
+    '+376',   # Andorra
+    '+377',   # Monaco
+    '+378',   # San Marino
+    '+380',   # Ukraine
+    '+381',   # Serbia
+    '+382',   # Montenegro
+    '+383',   # Kosovo
+    '+385',   # Croatia
+    '+386',   # Slovenia
+    '+387',   # Bosnia and Herzegovina
+    '+389',   # North Macedonia
+    '+420',   # Czech Republic
+    '+421',   # Slovakia
+    '+423',   # Liechtenstein
+    '+500',   # Falkland Islands
+    '+501',   # Belize
+    '+502',   # Guatemala
+    '+503',   # El Salvador
+    '+504',   # Honduras
+    '+505',   # Nicaragua
+    '+506',   # Costa Rica
+    '+507',   # Panama
+    '+508',   # Saint Pierre and Miquelon
+    '+509',   # Haiti
+    '+590',   # Guadeloupe
+    '+591',   # Bolivia
+    '+592',   # Guyana
+    '+593',   # Ecuador
+    '+594',   # French Guiana
+    '+595',   # Paraguay
+    '+596',   # Martinique
+    '+597',   # Suriname
+    '+598',   # Uruguay
+    '+599',   # Netherlands Antilles
+    '+670',   # East Timor
+    '+672',   # Antarctica
+    '+673',   # Brunei
+    '+674',   # Nauru
+    '+675',   # Papua New Guinea
+    '+676',   # Tonga
+    '+677',   # Solomon Islands
+    '+678',   # Vanuatu
+    '+679',   # Fiji
+    '+680',   # Palau
+    '+681',   # Wallis and Futuna
+    '+682',   # Cook Islands
+    '+683',   # Niue
+    '+684',   # American Samoa
+    '+685',   # Samoa
+    '+686',   # Kiribati
+    '+687',   # New Caledonia
+    '+688',   # Tuvalu
+    '+689',   # French Polynesia
+    '+690',   # Tokelau
+    '+691',   # Micronesia
+    '+692',   # Marshall Islands
+    '+850',   # North Korea
+    '+852',   # Hong Kong
+    '+853',   # Macau
+    '+855',   # Cambodia
+    '+856',   # Laos
+    '+880',   # Bangladesh
+    '+886',   # Taiwan
+    '+960',   # Maldives
+    '+961',   # Lebanon
+    '+962',   # Jordan
+    '+963',   # Syria
+    '+964',   # Iraq
+    '+965',   # Kuwait
+    '+966',   # Saudi Arabia
+    '+967',   # Yemen
+    '+968',   # Oman
+    '+970',   # Palestine
+    '+971',   # United Arab Emirates
+    '+972',   # Israel
+    '+973',   # Bahrain
+    '+974',   # Qatar
+    '+975',   # Bhutan
+    '+976',   # Mongolia
+    '+977',   # Nepal
+    '+992',   # Tajikistan
+    '+993',   # Turkmenistan
+    '+994',   # Azerbaijan
+    '+995',   # Georgia
+    '+996',   # Kyrgyzstan
+    '+998',   # Uzbekistan
+})
+
+# Country name and flag by calling code
+_COUNTRY_INFO = {
+    '+1': ('الولايات المتحدة', '🇺🇸'),
+    '+7': ('روسيا', '🇷🇺'),
+    '+20': ('مصر', '🇪🇬'),
+    '+33': ('فرنسا', '🇫🇷'),
+    '+34': ('إسبانيا', '🇪🇸'),
+    '+39': ('إيطاليا', '🇮🇹'),
+    '+44': ('المملكة المتحدة', '🇬🇧'),
+    '+49': ('ألمانيا', '🇩🇪'),
+    '+52': ('المكسيك', '🇲🇽'),
+    '+55': ('البرازيل', '🇧🇷'),
+    '+60': ('ماليزيا', '🇲🇾'),
+    '+61': ('أستراليا', '🇦🇺'),
+    '+62': ('إندونيسيا', '🇮🇩'),
+    '+63': ('الفلبين', '🇵🇭'),
+    '+64': ('نيوزيلندا', '🇳🇿'),
+    '+65': ('سنغافورة', '🇸🇬'),
+    '+66': ('تايلاند', '🇹🇭'),
+    '+81': ('اليابان', '🇯🇵'),
+    '+82': ('كوريا الجنوبية', '🇰🇷'),
+    '+84': ('فيتنام', '🇻🇳'),
+    '+86': ('الصين', '🇨🇳'),
+    '+90': ('تركيا', '🇹🇷'),
+    '+91': ('الهند', '🇮🇳'),
+    '+92': ('باكستان', '🇵🇰'),
+    '+93': ('أفغانستان', '🇦🇫'),
+    '+94': ('سريلانكا', '🇱🇰'),
+    '+95': ('ميانمار', '🇲🇲'),
+    '+98': ('إيران', '🇮🇷'),
+    '+212': ('المغرب', '🇲🇦'),
+    '+213': ('الجزائر', '🇩🇿'),
+    '+216': ('تونس', '🇹🇳'),
+    '+218': ('ليبيا', '🇱🇾'),
+    '+220': ('غامبيا', '🇬🇲'),
+    '+221': ('السنغال', '🇸🇳'),
+    '+222': ('موريتانيا', '🇲🇷'),
+    '+223': ('مالي', '🇲🇱'),
+    '+224': ('غينيا', '🇬🇳'),
+    '+225': ('ساحل العاج', '🇨🇮'),
+    '+226': ('بوركينا فاسو', '🇧🇫'),
+    '+227': ('النيجر', '🇳🇪'),
+    '+228': ('توغو', '🇹🇬'),
+    '+229': ('بنين', '🇧🇯'),
+    '+230': ('موريشيوس', '🇲🇺'),
+    '+231': ('ليبيريا', '🇱🇷'),
+    '+232': ('سيراليون', '🇸🇱'),
+    '+233': ('غانا', '🇬🇭'),
+    '+234': ('نيجيريا', '🇳🇬'),
+    '+235': ('تشاد', '🇹🇩'),
+    '+236': ('جمهورية أفريقيا الوسطى', '🇨🇫'),
+    '+237': ('الكاميرون', '🇨🇲'),
+    '+238': ('الرأس الأخضر', '🇨🇻'),
+    '+239': ('ساو تومي وبرينسيبي', '🇸🇹'),
+    '+240': ('غينيا الاستوائية', '🇬🇶'),
+    '+241': ('الغابون', '🇬🇦'),
+    '+242': ('جمهورية الكونغو', '🇨🇬'),
+    '+243': ('جمهورية الكونغو الديمقراطية', '🇨🇩'),
+    '+244': ('أنغولا', '🇦🇴'),
+    '+245': ('غينيا بيساو', '🇬🇼'),
+    '+248': ('سيشل', '🇸🇨'),
+    '+249': ('السودان', '🇸🇩'),
+    '+250': ('رواندا', '🇷🇼'),
+    '+251': ('إثيوبيا', '🇪🇹'),
+    '+252': ('الصومال', '🇸🇴'),
+    '+253': ('جيبوتي', '🇩🇯'),
+    '+254': ('كينيا', '🇰🇪'),
+    '+255': ('تنزانيا', '🇹🇿'),
+    '+256': ('أوغندا', '🇺🇬'),
+    '+257': ('بوروندي', '🇧🇮'),
+    '+258': ('موزمبيق', '🇲🇿'),
+    '+260': ('زامبيا', '🇿🇲'),
+    '+261': ('مدغشقر', '🇲🇬'),
+    '+263': ('زيمبابوي', '🇿🇼'),
+    '+264': ('ناميبيا', '🇳🇦'),
+    '+265': ('ملاوي', '🇲🇼'),
+    '+266': ('ليسوتو', '🇱🇸'),
+    '+267': ('بوتسوانا', '🇧🇼'),
+    '+268': ('إسواتيني', '🇸🇿'),
+    '+269': ('جزر القمر', '🇰🇲'),
+    '+351': ('البرتغال', '🇵🇹'),
+    '+352': ('لوكسمبورغ', '🇱🇺'),
+    '+353': ('أيرلندا', '🇮🇪'),
+    '+354': ('أيسلندا', '🇮🇸'),
+    '+355': ('ألبانيا', '🇦🇱'),
+    '+356': ('مالطا', '🇲🇹'),
+    '+357': ('قبرص', '🇨🇾'),
+    '+358': ('فنلندا', '🇫🇮'),
+    '+359': ('بلغاريا', '🇧🇬'),
+    '+370': ('ليتوانيا', '🇱🇹'),
+    '+371': ('لاتفيا', '🇱🇻'),
+    '+372': ('إستونيا', '🇪🇪'),
+    '+373': ('مولدوفا', '🇲🇩'),
+    '+374': ('أرمينيا', '🇦🇲'),
+    '+375': ('بيلاروس', '🇧🇾'),
+    '+376': ('أندورا', '🇦🇩'),
+    '+377': ('موناكو', '🇲🇨'),
+    '+378': ('سان مارينو', '🇸🇲'),
+    '+380': ('أوكرانيا', '🇺🇦'),
+    '+381': ('صربيا', '🇷🇸'),
+    '+382': ('الجبل الأسود', '🇲🇪'),
+    '+383': ('كوسوفو', '🇽🇰'),
+    '+385': ('كرواتيا', '🇭🇷'),
+    '+386': ('سلوفينيا', '🇸🇮'),
+    '+387': ('البوسنة والهرسك', '🇧🇦'),
+    '+389': ('مقدونيا الشمالية', '🇲🇰'),
+    '+420': ('التشيك', '🇨🇿'),
+    '+421': ('سلوفاكيا', '🇸🇰'),
+    '+423': ('ليختنشتاين', '🇱🇮'),
+    '+500': ('جزر فوكلاند', '🇫🇰'),
+    '+501': ('بليز', '🇧🇿'),
+    '+502': ('غواتيمالا', '🇬🇹'),
+    '+503': ('السلفادور', '🇸🇻'),
+    '+504': ('هندوراس', '🇭🇳'),
+    '+505': ('نيكاراغوا', '🇳🇮'),
+    '+506': ('كوستاريكا', '🇨🇷'),
+    '+507': ('بنما', '🇵🇦'),
+    '+509': ('هايتي', '🇭🇹'),
+    '+590': ('غوادلوب', '🇬🇵'),
+    '+591': ('بوليفيا', '🇧🇴'),
+    '+592': ('غيانا', '🇬🇾'),
+    '+593': ('الإكوادور', '🇪🇨'),
+    '+594': ('غيانا الفرنسية', '🇬🇫'),
+    '+595': ('باراغواي', '🇵🇾'),
+    '+596': ('مارتينيك', '🇲🇶'),
+    '+597': ('سورينام', '🇸🇷'),
+    '+598': ('أوروغواي', '🇺🇾'),
+    '+670': ('تيمور الشرقية', '🇹🇱'),
+    '+673': ('بروناي', '🇧🇳'),
+    '+674': ('ناورو', '🇳🇷'),
+    '+675': ('بابوا غينيا الجديدة', '🇵🇬'),
+    '+676': ('تونغا', '🇹🇴'),
+    '+677': ('جزر سليمان', '🇸🇧'),
+    '+678': ('فانواتو', '🇻🇺'),
+    '+679': ('فيجي', '🇫🇯'),
+    '+680': ('بالاو', '🇵🇼'),
+    '+681': ('واليس وفوتونا', '🇼🇫'),
+    '+682': ('جزر كوك', '🇨🇰'),
+    '+683': ('نيوي', '🇳🇺'),
+    '+684': ('ساموا الأمريكية', '🇦🇸'),
+    '+685': ('ساموا', '🇼🇸'),
+    '+686': ('كيريباتي', '🇰🇮'),
+    '+687': ('كاليدونيا الجديدة', '🇳🇨'),
+    '+688': ('توفالو', '🇹🇻'),
+    '+689': ('بولينيزيا الفرنسية', '🇵🇫'),
+    '+690': ('توكيلاو', '🇹🇰'),
+    '+691': ('ميكرونيزيا', '🇫🇲'),
+    '+692': ('جزر مارشال', '🇲🇭'),
+    '+850': ('كوريا الشمالية', '🇰🇵'),
+    '+852': ('هونغ كونغ', '🇭🇰'),
+    '+853': ('ماكاو', '🇲🇴'),
+    '+855': ('كمبوديا', '🇰🇭'),
+    '+856': ('لاوس', '🇱🇦'),
+    '+880': ('بنغلاديش', '🇧🇩'),
+    '+886': ('تايوان', '🇹🇼'),
+    '+960': ('المالديف', '🇲🇻'),
+    '+961': ('لبنان', '🇱🇧'),
+    '+962': ('الأردن', '🇯🇴'),
+    '+963': ('سوريا', '🇸🇾'),
+    '+964': ('العراق', '🇮🇶'),
+    '+965': ('الكويت', '🇰🇼'),
+    '+966': ('السعودية', '🇸🇦'),
+    '+967': ('اليمن', '🇾🇪'),
+    '+968': ('عمان', '🇴🇲'),
+    '+970': ('فلسطين', '🇵🇸'),
+    '+971': ('الإمارات', '🇦🇪'),
+    '+972': ('إسرائيل', '🇮🇱'),
+    '+973': ('البحرين', '🇧🇭'),
+    '+974': ('قطر', '🇶🇦'),
+    '+975': ('بوتان', '🇧🇹'),
+    '+976': ('منغوليا', '🇲🇳'),
+    '+977': ('نيبال', '🇳🇵'),
+    '+992': ('طاجيكستان', '🇹🇯'),
+    '+993': ('تركمانستان', '🇹🇲'),
+    '+994': ('أذربيجان', '🇦🇿'),
+    '+995': ('جورجيا', '🇬🇪'),
+    '+996': ('قيرغيزستان', '🇰🇬'),
+    '+998': ('أوزبكستان', '🇺🇿'),
+}
+
+# Calling code lengths (without '+'), longest first, for longest-prefix matching
+_CC_LENS = sorted({len(code) - 1 for code in _COUNTRY_CODES}, reverse=True)
+
+def lookup_by_number(phone: str) -> Optional[tuple[str, str, str]]:
+    """Find the calling code, country name and flag for a phone number by longest prefix"""
+    digits = phone[1:] if phone.startswith('+') else phone
+    for length in _CC_LENS:
+        if len(digits) > length:
+            code = '+' + digits[:length]
+            if code in _COUNTRY_CODES:
+                return (code, *get_country_name_and_flag(code))
+    return None
+
 def detect_country_code(phone: str) -> str:
     """Detect country code from phone number"""
     phone = normalize_phone_number(phone)
     
-    # Common country codes mapping
-    country_codes = {
-        '+1': '+1',      # USA/Canada
-        '+7': '+7',      # Russia/Kazakhstan  
-        '+20': '+20',    # Egypt
-        '+33': '+33',    # France
-        '+34': '+34',    # Spain
-        '+39': '+39',    # Italy
-        '+44': '+44',    # UK
-        '+49': '+49',    # Germany
-        '+52': '+52',    # Mexico
-        '+55': '+55',    # Brazil
-        '+60': '+60',    # Malaysia
-        '+61': '+61',    # Australia
-        '+62': '+62',    # Indonesia
-        '+63': '+63',    # Philippines
-        '+64': '+64',    # New Zealand
-        '+65': '+65',    # Singapore
-        '+66': '+66',    # Thailand
-        '+81': '+81',    # Japan
-        '+82': '+82',    # South Korea
-        '+84': '+84',    # Vietnam
-        '+86': '+86',    # China
-        '+90': '+90',    # Turkey
-        '+91': '+91',    # India
-        '+92': '+92',    # Pakistan
-        '+93': '+93',    # Afghanistan
-        '+94': '+94',    # Sri Lanka
-        '+95': '+95',    # Myanmar
-        '+98': '+98',    # Iran
-        '+212': '+212',  # Morocco
-        '+213': '+213',  # Algeria
-        '+216': '+216',  # Tunisia
-        '+218': '+218',  # Libya
-        '+220': '+220',  # Gambia
-        '+221': '+221',  # Senegal
-        '+222': '+222',  # Mauritania
-        '+223': '+223',  # Mali
-        '+224': '+224',  # Guinea
-        '+225': '+225',  # Ivory Coast
-        '+226': '+226',  # Burkina Faso
-        '+227': '+227',  # Niger
-        '+228': '+228',  # Togo
-        '+229': '+229',  # Benin
-        '+230': '+230',  # Mauritius
-        '+231': '+231',  # Liberia
-        '+232': '+232',  # Sierra Leone
-        '+233': '+233',  # Ghana
-        '+234': '+234',  # Nigeria
-        '+235': '+235',  # Chad
-        '+236': '+236',  # Central African Republic
-        '+237': '+237',  # Cameroon
-        '+238': '+238',  # Cape Verde
-        '+239': '+239',  # Sao Tome and Principe
-        '+240': '+240',  # Equatorial Guinea
-        '+241': '+241',  # Gabon
-        '+242': '+242',  # Republic of the Congo
-        '+243': '+243',  # Democratic Republic of the Congo
-        '+244': '+244',  # Angola
-        '+245': '+245',  # Guinea-Bissau
-        '+246': '+246',  # British Indian Ocean Territory
-        '+248': '+248',  # Seychelles
-        '+249': '+249',  # Sudan
-        '+250': '+250',  # Rwanda
-        '+251': '+251',  # Ethiopia
-        '+252': '+252',  # Somalia
-        '+253': '+253',  # Djibouti
-        '+254': '+254',  # Kenya
-        '+255': '+255',  # Tanzania
-        '+256': '+256',  # Uganda
-        '+257': '+257',  # Burundi
-        '+258': '+258',  # Mozambique
-        '+260': '+260',  # Zambia
-        '+261': '+261',  # Madagascar
-        '+262': '+262',  # Reunion
-        '+263': '+263',  # Zimbabwe
-        '+264': '+264',  # Namibia
-        '+265': '+265',  # Malawi
-        '+266': '+266',  # Lesotho
-        '+267': '+267',  # Botswana
-        '+268': '+268',  # Swaziland
-        '+269': '+269',  # Comoros
-        '+290': '+290',  # Saint Helena
-        '+291': '+291',  # Eritrea
-        '+297': '+297',  # Aruba
-        '+298': '+298',  # Faroe Islands
-        '+299': '+299',  # Greenland
-        '+350': '+350',  # Gibraltar
-        '+351': '+351',  # Portugal
-        '+352': '+352',  # Luxembourg
-        '+353': '+353',  # Ireland
-        '+354': '+354',  # Iceland
-        '+355': '+355',  # Albania
-        '+356': '+356',  # Malta
-        '+357': '+357',  # Cyprus
-        '+358': '+358',  # Finland
-        '+359': '+359',  # Bulgaria
-        '+370': '+370',  # Lithuania
-        '+371': '+371',  # Latvia
-        '+372': '+372',  # Estonia
-        '+373': '+373',  # Moldova
-        '+374': '+374',  # Armenia
-        '+375': '+375',  # Belarus
-        '+376': '+376',  # Andorra
-        '+377': '+377',  # Monaco
-        '+378': '+378',  # San Marino
-        '+380': '+380',  # Ukraine
-        '+381': '+381',  # Serbia
-        '+382': '+382',  # Montenegro
-        '+383': '+383',  # Kosovo
-        '+385': '+385',  # Croatia
-        '+386': '+386',  # Slovenia
-        '+387': '+387',  # Bosnia and Herzegovina
-        '+389': '+389',  # North Macedonia
-        '+420': '+420',  # Czech Republic
-        '+421': '+421',  # Slovakia
-        '+423': '+423',  # Liechtenstein
-        '+500': '+500',  # Falkland Islands
-        '+501': '+501',  # Belize
-        '+502': '+502',  # Guatemala
-        '+503': '+503',  # El Salvador
-        '+504': '+504',  # Honduras
-        '+505': '+505',  # Nicaragua
-        '+506': '+506',  # Costa Rica
-        '+507': '+507',  # Panama
-        '+508': '+508',  # Saint Pierre and Miquelon
-        '+509': '+509',  # Haiti
-        '+590': '+590',  # Guadeloupe
-        '+591': '+591',  # Bolivia
-        '+592': '+592',  # Guyana
-        '+593': '+593',  # Ecuador
-        '+594': '+594',  # French Guiana
-        '+595': '+595',  # Paraguay
-        '+596': '+596',  # Martinique
-        '+597': '+597',  # Suriname
-        '+598': '+598',  # Uruguay
-        '+599': '+599',  # Netherlands Antilles
-        '+670': '+670',  # East Timor
-        '+672': '+672',  # Antarctica
-        '+673': '+673',  # Brunei
-        '+674': '+674',  # Nauru
-        '+675': '+675',  # Papua New Guinea
-        '+676': '+676',  # Tonga
-        '+677': '+677',  # Solomon Islands
-        '+678': '+678',  # Vanuatu
-        '+679': '+679',  # Fiji
-        '+680': '+680',  # Palau
-        '+681': '+681',  # Wallis and Futuna
-        '+682': '+682',  # Cook Islands
-        '+683': '+683',  # Niue
-        '+684': '+684',  # American Samoa
-        '+685': '+685',  # Samoa
-        '+686': '+686',  # Kiribati
-        '+687': '+687',  # New Caledonia
-        '+688': '+688',  # Tuvalu
-        '+689': '+689',  # French Polynesia
-        '+690': '+690',  # Tokelau
-        '+691': '+691',  # Micronesia
-        '+692': '+692',  # Marshall Islands
-        '+850': '+850',  # North Korea
-        '+852': '+852',  # Hong Kong
-        '+853': '+853',  # Macau
-        '+855': '+855',  # Cambodia
-        '+856': '+856',  # Laos
-        '+880': '+880',  # Bangladesh
-        '+886': '+886',  # Taiwan
-        '+960': '+960',  # Maldives
-        '+961': '+961',  # Lebanon
-        '+962': '+962',  # Jordan
-        '+963': '+963',  # Syria
-        '+964': '+964',  # Iraq
-        '+965': '+965',  # Kuwait
-        '+966': '+966',  # Saudi Arabia
-        '+967': '+967',  # Yemen
-        '+968': '+968',  # Oman
-        '+970': '+970',  # Palestine
-        '+971': '+971',  # United Arab Emirates
-        '+972': '+972',  # Israel
-        '+973': '+973',  # Bahrain
-        '+974': '+974',  # Qatar
-        '+975': '+975',  # Bhutan
-        '+976': '+976',  # Mongolia
-        '+977': '+977',  # Nepal
-        '+992': '+992',  # Tajikistan
-        '+993': '+993',  # Turkmenistan
-        '+994': '+994',  # Azerbaijan
-        '+995': '+995',  # Georgia
-        '+996': '+996',  # Kyrgyzstan
-        '+998': '+998',  # Uzbekistan
-    }
-    
-    # Check for exact matches (longest first)
-    for length in [4, 3, 2]:
-        if len(phone) >= length + 1:  # +1 for the '+' sign
-            prefix = phone[:length + 1]
-            if prefix in country_codes:
-                return country_codes[prefix]
+    match = lookup_by_number(phone)
+    if match:
+        return match[0]
     
     # Default fallback
     return '+1'  # Default to US/Canada if no match found
 
 def get_country_name_and_flag(country_code: str) -> tuple[str, str]:
     """Get country name and flag from country code"""
-    country_info = {
-        '+1': ('الولايات المتحدة', '🇺🇸'),
-        '+7': ('روسيا', '🇷🇺'),
-        '+20': ('مصر', '🇪🇬'),
-        '+33': ('فرنسا', '🇫🇷'),
-        '+34': ('إسبانيا', '🇪🇸'),
-        '+39': ('إيطاليا', '🇮🇹'),
-        '+44': ('المملكة المتحدة', '🇬🇧'),
-        '+49': ('ألمانيا', '🇩🇪'),
-        '+52': ('المكسيك', '🇲🇽'),
-        '+55': ('البرازيل', '🇧🇷'),
-        '+60': ('ماليزيا', '🇲🇾'),
-        '+61': ('أستراليا', '🇦🇺'),
-        '+62': ('إندونيسيا', '🇮🇩'),
-        '+63': ('الفلبين', '🇵🇭'),
-        '+64': ('نيوزيلندا', '🇳🇿'),
-        '+65': ('سنغافورة', '🇸🇬'),
-        '+66': ('تايلاند', '🇹🇭'),
-        '+81': ('اليابان', '🇯🇵'),
-        '+82': ('كوريا الجنوبية', '🇰🇷'),
-        '+84': ('فيتنام', '🇻🇳'),
-        '+86': ('الصين', '🇨🇳'),
-        '+90': ('تركيا', '🇹🇷'),
-        '+91': ('الهند', '🇮🇳'),
-        '+92': ('باكستان', '🇵🇰'),
-        '+93': ('أفغانستان', '🇦🇫'),
-        '+94': ('سريلانكا', '🇱🇰'),
-        '+95': ('ميانمار', '🇲🇲'),
-        '+98': ('إيران', '🇮🇷'),
-        '+212': ('المغرب', '🇲🇦'),
-        '+213': ('الجزائر', '🇩🇿'),
-        '+216': ('تونس', '🇹🇳'),
-        '+218': ('ليبيا', '🇱🇾'),
-        '+220': ('غامبيا', '🇬🇲'),
-        '+221': ('السنغال', '🇸🇳'),
-        '+222': ('موريتانيا', '🇲🇷'),
-        '+223': ('مالي', '🇲🇱'),
-        '+224': ('غينيا', '🇬🇳'),
-        '+225': ('ساحل العاج', '🇨🇮'),
-        '+226': ('بوركينا فاسو', '🇧🇫'),
-        '+227': ('النيجر', '🇳🇪'),
-        '+228': ('توغو', '🇹🇬'),
-        '+229': ('بنين', '🇧🇯'),
-        '+230': ('موريشيوس', '🇲🇺'),
-        '+231': ('ليبيريا', '🇱🇷'),
-        '+232': ('سيراليون', '🇸🇱'),
-        '+233': ('غانا', '🇬🇭'),
-        '+234': ('نيجيريا', '🇳🇬'),
-        '+235': ('تشاد', '🇹🇩'),
-        '+236': ('جمهورية أفريقيا الوسطى', '🇨🇫'),
-        '+237': ('الكاميرون', '🇨🇲'),
-        '+238': ('الرأس الأخضر', '🇨🇻'),
-        '+239': ('ساو تومي وبرينسيبي', '🇸🇹'),
-        '+240': ('غينيا الاستوائية', '🇬🇶'),
-        '+241': ('الغابون', '🇬🇦'),
-        '+242': ('جمهورية الكونغو', '🇨🇬'),
-        '+243': ('جمهورية الكونغو الديمقراطية', '🇨🇩'),
-        '+244': ('أنغولا', '🇦🇴'),
-        '+245': ('غينيا بيساو', '🇬🇼'),
-        '+248': ('سيشل', '🇸🇨'),
-        '+249': ('السودان', '🇸🇩'),
-        '+250': ('رواندا', '🇷🇼'),
-        '+251': ('إثيوبيا', '🇪🇹'),
-        '+252': ('الصومال', '🇸🇴'),
-        '+253': ('جيبوتي', '🇩🇯'),
-        '+254': ('كينيا', '🇰🇪'),
-        '+255': ('تنزانيا', '🇹🇿'),
-        '+256': ('أوغندا', '🇺🇬'),
-        '+257': ('بوروندي', '🇧🇮'),
-        '+258': ('موزمبيق', '🇲🇿'),
-        '+260': ('زامبيا', '🇿🇲'),
-        '+261': ('مدغشقر', '🇲🇬'),
-        '+263': ('زيمبابوي', '🇿🇼'),
-        '+264': ('ناميبيا', '🇳🇦'),
-        '+265': ('ملاوي', '🇲🇼'),
-        '+266': ('ليسوتو', '🇱🇸'),
-        '+267': ('بوتسوانا', '🇧🇼'),
-        '+268': ('إسواتيني', '🇸🇿'),
-        '+269': ('جزر القمر', '🇰🇲'),
-        '+351': ('البرتغال', '🇵🇹'),
-        '+352': ('لوكسمبورغ', '🇱🇺'),
-        '+353': ('أيرلندا', '🇮🇪'),
-        '+354': ('أيسلندا', '🇮🇸'),
-        '+355': ('ألبانيا', '🇦🇱'),
-        '+356': ('مالطا', '🇲🇹'),
-        '+357': ('قبرص', '🇨🇾'),
-        '+358': ('فنلندا', '🇫🇮'),
-        '+359': ('بلغاريا', '🇧🇬'),
-        '+370': ('ليتوانيا', '🇱🇹'),
-        '+371': ('لاتفيا', '🇱🇻'),
-        '+372': ('إستونيا', '🇪🇪'),
-        '+373': ('مولدوفا', '🇲🇩'),
-        '+374': ('أرمينيا', '🇦🇲'),
-        '+375': ('بيلاروس', '🇧🇾'),
-        '+376': ('أندورا', '🇦🇩'),
-        '+377': ('موناكو', '🇲🇨'),
-        '+378': ('سان مارينو', '🇸🇲'),
-        '+380': ('أوكرانيا', '🇺🇦'),
-        '+381': ('صربيا', '🇷🇸'),
-        '+382': ('الجبل الأسود', '🇲🇪'),
-        '+383': ('كوسوفو', '🇽🇰'),
-        '+385': ('كرواتيا', '🇭🇷'),
-        '+386': ('سلوفينيا', '🇸🇮'),
-        '+387': ('البوسنة والهرسك', '🇧🇦'),
-        '+389': ('مقدونيا الشمالية', '🇲🇰'),
-        '+420': ('التشيك', '🇨🇿'),
-        '+421': ('سلوفاكيا', '🇸🇰'),
-        '+423': ('ليختنشتاين', '🇱🇮'),
-        '+500': ('جزر فوكلاند', '🇫🇰'),
-        '+501': ('بليز', '🇧🇿'),
-        '+502': ('غواتيمالا', '🇬🇹'),
-        '+503': ('السلفادور', '🇸🇻'),
-        '+504': ('هندوراس', '🇭🇳'),
-        '+505': ('نيكاراغوا', '🇳🇮'),
-        '+506': ('كوستاريكا', '🇨🇷'),
-        '+507': ('بنما', '🇵🇦'),
-        '+509': ('هايتي', '🇭🇹'),
-        '+590': ('غوادلوب', '🇬🇵'),
-        '+591': ('بوليفيا', '🇧🇴'),
-        '+592': ('غيانا', '🇬🇾'),
-        '+593': ('الإكوادور', '🇪🇨'),
-        '+594': ('غيانا الفرنسية', '🇬🇫'),
-        '+595': ('باراغواي', '🇵🇾'),
-        '+596': ('مارتينيك', '🇲🇶'),
-        '+597': ('سورينام', '🇸🇷'),
-        '+598': ('أوروغواي', '🇺🇾'),
-        '+670': ('تيمور الشرقية', '🇹🇱'),
-        '+673': ('بروناي', '🇧🇳'),
-        '+674': ('ناورو', '🇳🇷'),
-        '+675': ('بابوا غينيا الجديدة', '🇵🇬'),
-        '+676': ('تونغا', '🇹🇴'),
-        '+677': ('جزر سليمان', '🇸🇧'),
-        '+678': ('فانواتو', '🇻🇺'),
-        '+679': ('فيجي', '🇫🇯'),
-        '+680': ('بالاو', '🇵🇼'),
-        '+681': ('واليس وفوتونا', '🇼🇫'),
-        '+682': ('جزر كوك', '🇨🇰'),
-        '+683': ('نيوي', '🇳🇺'),
-        '+684': ('ساموا الأمريكية', '🇦🇸'),
-        '+685': ('ساموا', '🇼🇸'),
-        '+686': ('كيريباتي', '🇰🇮'),
-        '+687': ('كاليدونيا الجديدة', '🇳🇨'),
-        '+688': ('توفالو', '🇹🇻'),
-        '+689': ('بولينيزيا الفرنسية', '🇵🇫'),
-        '+690': ('توكيلاو', '🇹🇰'),
-        '+691': ('ميكرونيزيا', '🇫🇲'),
-        '+692': ('جزر مارشال', '🇲🇭'),
-        '+850': ('كوريا الشمالية', '🇰🇵'),
-        '+852': ('هونغ كونغ', '🇭🇰'),
-        '+853': ('ماكاو', '🇲🇴'),
-        '+855': ('كمبوديا', '🇰🇭'),
-        '+856': ('لاوس', '🇱🇦'),
-        '+880': ('بنغلاديش', '🇧🇩'),
-        '+886': ('تايوان', '🇹🇼'),
-        '+960': ('المالديف', '🇲🇻'),
-        '+961': ('لبنان', '🇱🇧'),
-        '+962': ('الأردن', '🇯🇴'),
-        '+963': ('سوريا', '🇸🇾'),
-        '+964': ('العراق', '🇮🇶'),
-        '+965': ('الكويت', '🇰🇼'),
-        '+966': ('السعودية', '🇸🇦'),
-        '+967': ('اليمن', '🇾🇪'),
-        '+968': ('عمان', '🇴🇲'),
-        '+970': ('فلسطين', '🇵🇸'),
-        '+971': ('الإمارات', '🇦🇪'),
-        '+972': ('إسرائيل', '🇮🇱'),
-        '+973': ('البحرين', '🇧🇭'),
-        '+974': ('قطر', '🇶🇦'),
-        '+975': ('بوتان', '🇧🇹'),
-        '+976': ('منغوليا', '🇲🇳'),
-        '+977': ('نيبال', '🇳🇵'),
-        '+992': ('طاجيكستان', '🇹🇯'),
-        '+993': ('تركمانستان', '🇹🇲'),
-        '+994': ('أذربيجان', '🇦🇿'),
-        '+995': ('جورجيا', '🇬🇪'),
-        '+996': ('قيرغيزستان', '🇰🇬'),
-        '+998': ('أوزبكستان', '🇺🇿'),
-    }
-    
-    return country_info.get(country_code, ('دولة غير معروفة', '🌍'))
+    return _COUNTRY_INFO.get(country_code, ('دولة غير معروفة', '🌍'))
+
+class ServiceCountryLite:
+    """Read-only service country record kept in memory without the ORM instance overhead"""
+    __slots__ = ('id', 'service_id', 'country_code', 'country_name', 'flag', 'active')
+
+    def __init__(self, service_country: ServiceCountry):
+        self.id = service_country.id
+        self.service_id = service_country.service_id
+        self.country_code = service_country.country_code
+        self.country_name = service_country.country_name
+        self.flag = service_country.flag
+        self.active = service_country.active
+
+# Active countries per service, loaded on first use
+_SERVICE_COUNTRIES: Dict[int, List[ServiceCountryLite]] = {}
+
+def get_service_countries(service_id: int) -> List[ServiceCountryLite]:
+    """Get active countries for a service from the in-memory cache"""
+    countries = _SERVICE_COUNTRIES.get(service_id)
+    if countries is None:
+        db = get_db()
+        try:
+            countries = [
+                ServiceCountryLite(service_country)
+                for service_country in db.query(ServiceCountry).filter(
+                    ServiceCountry.service_id == service_id,
+                    ServiceCountry.active == True
+                ).all()
+            ]
+        finally:
+            db.close()
+        _SERVICE_COUNTRIES[service_id] = countries
+    return countries
+
+def invalidate_service_countries(service_id: Optional[int] = None):
+    """Drop cached countries for one service, or for all services"""
+    if service_id is None:
+        _SERVICE_COUNTRIES.clear()
+    else:
+        _SERVICE_COUNTRIES.pop(service_id, None)
 
 def ensure_service_country_exists(service_id: int, country_code: str, db_session) -> ServiceCountry:
     """Ensure ServiceCountry entry exists for the given service and country code"""
@@ -934,12 +1144,17 @@ async def check_and_notify_empty_countries():
 
 def format_sms_message(phone_number: str, code: str) -> str:
     """Format SMS message in 'to: code:' format"""
+    # Fast path: number is already in the form normalize_phone_number would return
+    digits = phone_number[1:] if phone_number and phone_number[0] == '+' else None
+    if digits and len(digits) >= 7 and digits.isascii() and digits.isdigit() and not digits.startswith('00'):
+        return f"to: {phone_number}\ncode: {code}"
+    
     try:
         normalized_phone = normalize_phone_number(phone_number)
-        return f"to: {normalized_phone}\ncode: {code}"
     except Exception as e:
         logger.error(f"Error formatting SMS message: {e}")
-        return f"to: {phone_number}\ncode: {code}"
+        normalized_phone = phone_number
+    return f"to: {normalized_phone}\ncode: {code}"
 
 def create_example_sms_message(service_name: str = "Example", phone_number: str = "+1234567890", code: str = "123456") -> str:
     """Create an example SMS message for group demonstration"""
@@ -976,11 +1191,11 @@ def test_extract_number_and_code():
     
     return True
 
-def extract_number_and_code(message_text: str, regex_pattern: str) -> tuple[Optional[str], Optional[str]]:
+def extract_number_and_code(message_text: str, regex_pattern: str | re.Pattern) -> tuple[Optional[str], Optional[str]]:
     """Extract phone number and code from message text in format: to:+20112763404 code:123456"""
     try:
         # Extract number from 'to:' format (with or without spaces, with or without +)
-        number_match = re.search(r'to:\s*(\+?\d+)', message_text, re.IGNORECASE)
+        number_match = TO_NUMBER_REGEX.search(message_text)
         if number_match:
             raw_number = number_match.group(1)
             # Add + if not present
@@ -991,7 +1206,7 @@ def extract_number_and_code(message_text: str, regex_pattern: str) -> tuple[Opti
             number = None
         
         # Extract code from 'code:' format (with or without spaces)
-        code_match = re.search(r'code:\s*(\d+)', message_text, re.IGNORECASE)
+        code_match = CODE_FIELD_REGEX.search(message_text)
         if code_match:
             code = code_match.group(1)
         else:
@@ -1019,18 +1234,217 @@ async def is_user_admin_in_chat(user_id: int, chat_id: str) -> bool:
         logger.error(f"Error checking admin status: {e}")
         return False
 
+@dataclass
+class ServiceInfo:
+    """In-memory view of a service with its precompiled code regex"""
+    id: int
+    name: str
+    regex: re.Pattern
+
+# Services keyed by name, loaded at startup and refreshed after admin edits
+_SERVICE_BY_NAME: Dict[str, ServiceInfo] = {}
+# Monotonic time of the last service cache load; unknown names reload it at most this often
+_service_cache_loaded_at: Optional[float] = None
+SERVICE_CACHE_MISS_RELOAD_INTERVAL = 30
+
+def load_service_cache():
+    """Load all services and their provider regex patterns into memory"""
+    global _service_cache_loaded_at
+    db = get_db()
+    try:
+        # The newest provider mapping with a pattern wins for each service
+        patterns = {
+            mapping.service_id: str(mapping.regex_pattern)
+            for mapping in db.query(ServiceProviderMap).order_by(ServiceProviderMap.id).all()
+            if mapping.regex_pattern
+        }
+        
+        services = {}
+        regexes = {}
+        for service in db.query(Service).all():
+            regexes[int(service.id)] = _compile_service_regex(service.id, patterns.get(service.id))
+            pattern = patterns.get(service.id, r'\b\d{4,8}\b')
+            try:
+                regex = re.compile(pattern, re.IGNORECASE)
+            except re.error as e:
+                logger.warning(f"Invalid regex '{pattern}' for service {service.name}: {e}")
+                regex = re.compile(r'\b\d{4,8}\b', re.IGNORECASE)
+            services[str(service.name)] = ServiceInfo(id=int(service.id), name=str(service.name), regex=regex)
+        
+        _SERVICE_BY_NAME.clear()
+        _SERVICE_BY_NAME.update(services)
+        _REGEX_CACHE.clear()
+        _REGEX_CACHE.update(regexes)
+        _SERVICE_GROUP_BY_CHAT.clear()
+        _GROUP_SERVICE_IDS_BY_CHAT.clear()
+        _SERVICE_DETAILS_BY_ID.clear()
+        invalidate_service_countries()
+        _service_cache_loaded_at = time.monotonic()
+        logger.info(f"Loaded {len(services)} services into cache")
+    except Exception as e:
+        logger.error(f"Error loading service cache: {e}")
+    finally:
+        db.close()
+
+class ServiceGroupLite:
+    """Read-only service group record used on the incoming group message path"""
+    __slots__ = ('id', 'service_id', 'service_name', 'regex_pattern')
+
+    def __init__(self, id: int, service_id: int, service_name: Optional[str], regex_pattern: Optional[str]):
+        self.id = id
+        self.service_id = service_id
+        self.service_name = service_name
+        self.regex_pattern = regex_pattern
+
+# Active service group per group chat id (None for unregistered chats), cleared together with the service cache
+_SERVICE_GROUP_BY_CHAT: Dict[str, Optional[ServiceGroupLite]] = {}
+
+def get_service_group_for_chat(db, group_chat_id: str) -> Optional[ServiceGroupLite]:
+    """Get the active service group of a chat, querying only on the first message from it"""
+    if group_chat_id in _SERVICE_GROUP_BY_CHAT:
+        return _SERVICE_GROUP_BY_CHAT[group_chat_id]
+    
+    row = db.query(
+        ServiceGroup.id, ServiceGroup.service_id, Service.name, ServiceGroup.regex_pattern
+    ).outerjoin(Service, Service.id == ServiceGroup.service_id).filter(
+        ServiceGroup.group_chat_id == group_chat_id,
+        ServiceGroup.active == True
+    ).first()
+    
+    service_group = ServiceGroupLite(*row) if row else None
+    _SERVICE_GROUP_BY_CHAT[group_chat_id] = service_group
+    return service_group
+
+# Active service ids bound to each group chat, cleared together with the service cache
+_GROUP_SERVICE_IDS_BY_CHAT: Dict[str, List[int]] = {}
+
+def get_group_service_ids(db, group_chat_id: str) -> List[int]:
+    """Get the ids of all services with an active group binding for a chat"""
+    service_ids = _GROUP_SERVICE_IDS_BY_CHAT.get(group_chat_id)
+    if service_ids is None:
+        service_ids = [
+            service_id for (service_id,) in db.query(ServiceGroup.service_id).filter(
+                ServiceGroup.group_chat_id == group_chat_id,
+                ServiceGroup.active == True
+            )
+        ]
+        _GROUP_SERVICE_IDS_BY_CHAT[group_chat_id] = service_ids
+    return service_ids
+
+@dataclass
+class ServiceDetails:
+    """Service fields needed to complete a reservation from a group message"""
+    id: int
+    name: str
+    emoji: str
+    default_price: float
+
+# Service details per id with their expiry on the monotonic clock, cleared together with the service cache
+_SERVICE_DETAILS_BY_ID: Dict[int, tuple[ServiceDetails, float]] = {}
+SERVICE_DETAILS_CACHE_TTL = 60
+
+def get_service_details(db, service_id: int) -> Optional[ServiceDetails]:
+    """Get cached service details, reading the service again once the entry has expired"""
+    now = time.monotonic()
+    cached = _SERVICE_DETAILS_BY_ID.get(service_id)
+    if cached and now < cached[1]:
+        return cached[0]
+    
+    row = db.query(Service.id, Service.name, Service.emoji, Service.default_price).filter(
+        Service.id == service_id
+    ).first()
+    if not row:
+        _SERVICE_DETAILS_BY_ID.pop(service_id, None)
+        return None
+    
+    details = ServiceDetails(id=row.id, name=row.name, emoji=row.emoji, default_price=float(row.default_price))
+    _SERVICE_DETAILS_BY_ID[service_id] = (details, now + SERVICE_DETAILS_CACHE_TTL)
+    return details
+
+# Compiled provider code regex per service id, filled by load_service_cache()
+_REGEX_CACHE: Dict[int, re.Pattern] = {}
+
+DEFAULT_CODE_PATTERN = r'\b\d{5,6}\b'
+DEFAULT_CODE_REGEX = re.compile(DEFAULT_CODE_PATTERN)
+# Runs of 3+ digits that may end with the last digits of a reserved number
+DIGIT_GROUP_REGEX = re.compile(r'\d{3,}')
+# Fallback code pattern tried on incoming group messages
+CODE_4_6_REGEX = re.compile(r'\b\d{4,6}\b')
+# Every maximal digit run, classified in a single pass by scan_digit_runs()
+DIGIT_RUN_REGEX = re.compile(r'\d+')
+# 'to:+201...' and 'code:123456' fields of provider messages
+TO_NUMBER_REGEX = re.compile(r'to:\s*(\+?\d+)', re.IGNORECASE)
+CODE_FIELD_REGEX = re.compile(r'code:\s*(\d+)', re.IGNORECASE)
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == '_'
+
+def scan_digit_runs(message_text: str) -> tuple[Optional[str], Optional[str], List[str]]:
+    """Scan digit runs once: last standalone 4-6 digit run, last standalone 3 digit run, all 3+ digit runs"""
+    code_4_6 = None
+    code_3 = None
+    long_runs = []
+    for match in DIGIT_RUN_REGEX.finditer(message_text):
+        run = match.group()
+        if len(run) < 3:
+            continue
+        long_runs.append(run)
+        if len(run) > 6:
+            continue
+        # Same as \b on both sides of the run
+        start, end = match.span()
+        if (start and _is_word_char(message_text[start - 1])) or (end < len(message_text) and _is_word_char(message_text[end])):
+            continue
+        if len(run) == 3:
+            code_3 = run
+        else:
+            code_4_6 = run
+    return code_4_6, code_3, long_runs
+
+@functools.lru_cache(maxsize=1024)
+def get_group_code_regex(pattern: str) -> re.Pattern:
+    """Compile a service group's code regex once, falling back to the 4-6 digit pattern"""
+    try:
+        return re.compile(pattern)
+    except re.error as e:
+        logger.warning(f"Invalid group regex '{pattern}': {e}")
+        return CODE_4_6_REGEX
+
+def _compile_service_regex(service_id: int, pattern: Optional[str]) -> re.Pattern:
+    """Compile a service's code regex, falling back to the default pattern"""
+    if not pattern:
+        return DEFAULT_CODE_REGEX
+    try:
+        return re.compile(str(pattern))
+    except re.error as e:
+        logger.warning(f"Invalid regex '{pattern}' for service {service_id}: {e}")
+        return DEFAULT_CODE_REGEX
+
+def get_service_regex(service_id: int) -> re.Pattern:
+    """Get the compiled provider code regex for a service from the service cache"""
+    return _REGEX_CACHE.get(service_id, DEFAULT_CODE_REGEX)
+
+def get_service_info(service_name: str) -> Optional[ServiceInfo]:
+    """Get cached service info, reloading from the database on a miss at most once per interval"""
+    service_info = _SERVICE_BY_NAME.get(service_name)
+    if service_info is None and service_name and (
+        _service_cache_loaded_at is None
+        or time.monotonic() - _service_cache_loaded_at >= SERVICE_CACHE_MISS_RELOAD_INTERVAL
+    ):
+        load_service_cache()
+        service_info = _SERVICE_BY_NAME.get(service_name)
+    return service_info
+
 async def extract_code_from_message(text: str, service_name: str) -> Optional[str]:
     """Enhanced OTP code extraction with advanced pattern matching and context awareness"""
-    db = get_db()
     try:
-        service = db.query(Service).filter(Service.name == service_name).first()
+        service = get_service_info(service_name)
         if not service:
             logger.warning(f"Service '{service_name}' not found for code extraction")
             return None
         
-        # Get service-specific regex pattern
-        mapping = db.query(ServiceProviderMap).filter(ServiceProviderMap.service_id == service.id).first()
-        service_pattern = str(mapping.regex_pattern) if mapping else r'\b\d{4,8}\b'
+        # Service-specific regex pattern, precompiled in the service cache
+        service_pattern = service.regex
         
         # Enhanced pattern collection with multilingual support
         patterns = [
@@ -1068,7 +1482,10 @@ async def extract_code_from_message(text: str, service_name: str) -> Optional[st
         
         for i, pattern in enumerate(patterns):
             try:
-                matches = re.findall(pattern, text, re.IGNORECASE)
+                if isinstance(pattern, re.Pattern):
+                    matches = pattern.findall(text)
+                else:
+                    matches = re.findall(pattern, text, re.IGNORECASE)
                 for match in matches:
                     code = match if isinstance(match, str) else match[0] if isinstance(match, tuple) else str(match)
                     
@@ -1113,13 +1530,12 @@ async def extract_code_from_message(text: str, service_name: str) -> Optional[st
     except Exception as e:
         logger.error(f"Error in enhanced code extraction: {e}")
         return None
-    finally:
-        db.close()
 
 # ==== AUTOMATIC MESSAGE CLEANUP SYSTEM ====
 
-def cleanup_dead_messages():
+def cleanup_dead_messages() -> int:
     """Background function to automatically cleanup dead and old messages"""
+    total_deleted = 0
     try:
         db = get_db()
         current_time = datetime.now()
@@ -1132,30 +1548,30 @@ def cleanup_dead_messages():
         # Cleanup old provider messages
         deleted_provider = db.query(ProviderMessage).filter(
             ProviderMessage.received_at < old_message_cutoff
-        ).delete()
+        ).delete(synchronize_session=False)
         
         # Cleanup old orphan messages (unmatched messages)
         deleted_orphan = db.query(ProviderMessage).filter(
             ProviderMessage.status == MessageStatus.ORPHAN,
             ProviderMessage.received_at < orphan_message_cutoff
-        ).delete()
+        ).delete(synchronize_session=False)
         
         # Cleanup old blocked messages
         deleted_blocked = db.query(BlockedMessage).filter(
             BlockedMessage.created_at < blocked_message_cutoff
-        ).delete()
+        ).delete(synchronize_session=False)
         
         # Cleanup old rejected messages
         deleted_rejected = db.query(ProviderMessage).filter(
             ProviderMessage.status == MessageStatus.REJECTED,
             ProviderMessage.received_at < old_message_cutoff
-        ).delete()
+        ).delete(synchronize_session=False)
         
         # Cleanup processed messages older than retention period
         deleted_processed = db.query(ProviderMessage).filter(
             ProviderMessage.status == MessageStatus.PROCESSED,
             ProviderMessage.received_at < old_message_cutoff
-        ).delete()
+        ).delete(synchronize_session=False)
         
         db.commit()
         
@@ -1185,34 +1601,60 @@ def cleanup_dead_messages():
             db.close()
         except:
             pass
+    
+    return total_deleted
 
-def cleanup_expired_reservations():
+def cleanup_expired_reservations() -> int:
     """Clean up expired reservations and release numbers"""
+    released_count = 0
     try:
         db = get_db()
         current_time = datetime.now()
         
-        # Find expired reservations
-        expired_reservations = db.query(Reservation).filter(
-            Reservation.status == ReservationStatus.WAITING_CODE,
-            Reservation.expired_at < current_time
-        ).all()
-        
-        released_count = 0
-        for reservation in expired_reservations:
-            # Update reservation status
-            reservation.status = ReservationStatus.EXPIRED
+        if engine.dialect.name == 'postgresql':
+            # Expire reservations and release their numbers in a single statement
+            expired_count, released_count = db.execute(text("""
+                WITH expired AS (
+                    UPDATE reservations SET status = 'EXPIRED', version = version + 1
+                    WHERE status = 'WAITING_CODE' AND expired_at < :now
+                    RETURNING number_id
+                ), released AS (
+                    UPDATE numbers
+                    SET status = 'AVAILABLE', reserved_by_user_id = NULL, reserved_at = NULL, expires_at = NULL
+                    WHERE id IN (SELECT number_id FROM expired)
+                    RETURNING id
+                )
+                SELECT (SELECT count(*) FROM expired), (SELECT count(*) FROM released)
+            """), {"now": current_time}).one()
+        else:
+            db.connection(execution_options={"sqlite_immediate": True})
             
-            # Release the number
-            number = db.query(Number).filter(Number.id == reservation.number_id).first()
-            if number:
-                number.status = 'AVAILABLE'
-                number.reserved_by_user_id = None
-                number.reserved_at = None
-                number.expires_at = None
-                released_count += 1
-        
+            # SQLite has no writable CTEs: expire reservations, then release their numbers
+            expired_number_ids = db.execute(
+                update(Reservation)
+                .where(
+                    Reservation.status == ReservationStatus.WAITING_CODE,
+                    Reservation.expired_at < current_time
+                )
+                .values(status=ReservationStatus.EXPIRED, version=Reservation.version + 1)
+                .returning(Reservation.number_id)
+                .execution_options(synchronize_session=False)
+            ).scalars().all()
+            expired_count = len(expired_number_ids)
+            
+            if expired_number_ids:
+                released_count = db.execute(
+                    update(Number)
+                    .where(Number.id.in_(set(expired_number_ids)))
+                    .values(status='AVAILABLE', reserved_by_user_id=None, reserved_at=None, expires_at=None)
+                    .execution_options(synchronize_session=False)
+                ).rowcount
+        
+        if expired_count:
+            bump_system_counters(db, failed=expired_count)
         db.commit()
+        if expired_count:
+            invalidate_system_stats()
         
         if released_count > 0:
             logger.info(f"📱 Released {released_count} expired number reservations")
@@ -1228,18 +1670,28 @@ def cleanup_expired_reservations():
             db.close()
         except:
             pass
+    
+    return released_count
+
+async def run_cleanup_tasks():
+    """Run the independent cleanup tasks concurrently, each with its own session"""
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(
+        loop.run_in_executor(CLEANUP_POOL, cleanup_dead_messages),
+        loop.run_in_executor(CLEANUP_POOL, cleanup_expired_reservations),
+        return_exceptions=True
+    )
+    deleted_messages, released_numbers = [0 if isinstance(r, BaseException) else r for r in results]
+    logger.info(f"🧹 Cleanup cycle finished: {deleted_messages} messages deleted, {released_numbers} numbers released")
 
-def periodic_cleanup_worker():
-    """Background worker that runs cleanup tasks periodically"""
+async def periodic_cleanup_worker():
+    """Background task that runs cleanup tasks periodically"""
     logger.info(f"🔄 Auto cleanup worker started - Running every {cleanup_interval_hours} hours")
     
     while auto_cleanup_enabled:
         try:
-            # Run message cleanup
-            cleanup_dead_messages()
-            
-            # Run reservation cleanup
-            cleanup_expired_reservations()
+            # Run message and reservation cleanup concurrently
+            await run_cleanup_tasks()
             
             # Wait for next cleanup cycle
             sleep_time = cleanup_interval_hours * 3600  # Convert hours to seconds
@@ -1248,22 +1700,22 @@ def periodic_cleanup_worker():
             for _ in range(int(sleep_time / 60)):  # Check every minute if cleanup is still enabled
                 if not auto_cleanup_enabled:
                     break
-                time.sleep(60)
+                await asyncio.sleep(60)
                 
         except Exception as e:
             logger.error(f"❌ Error in cleanup worker: {e}")
-            time.sleep(300)  # Wait 5 minutes before retrying on error
+            await asyncio.sleep(300)  # Wait 5 minutes before retrying on error
     
     logger.info("🛑 Auto cleanup worker stopped")
 
 def start_auto_cleanup():
     """Start the automatic cleanup system"""
-    global auto_cleanup_enabled
+    global auto_cleanup_enabled, cleanup_task
     auto_cleanup_enabled = True
     
-    # Start cleanup thread
-    cleanup_thread = threading.Thread(target=periodic_cleanup_worker, daemon=True)
-    cleanup_thread.start()
+    # Start cleanup task unless one is still running
+    if cleanup_task is None or cleanup_task.done():
+        cleanup_task = asyncio.create_task(periodic_cleanup_worker())
     
     logger.info("✅ Automatic message cleanup system started")
 
@@ -1337,10 +1789,7 @@ def create_countries_keyboard(service_id: int, user_id: Optional[int] = None, pa
     db = get_db()
     try:
         # First, get all countries for this service and filter those with available numbers
-        all_countries = db.query(ServiceCountry).filter(
-            ServiceCountry.service_id == service_id,
-            ServiceCountry.active == True
-        ).all()
+        all_countries = get_service_countries(service_id)
         
         # Filter countries to only include those with available numbers for this user
         countries_with_numbers = []
@@ -1419,7 +1868,9 @@ def create_service_groups_keyboard() -> InlineKeyboardMarkup:
     
     db = get_db()
     try:
-        service_groups = db.query(ServiceGroup).join(Service).filter(
+        service_groups = db.query(ServiceGroup).join(Service).options(
+            contains_eager(ServiceGroup.service)
+        ).filter(
             ServiceGroup.active == True,
             Service.active == True
         ).all()
@@ -1504,13 +1955,13 @@ async def reserve_number(user_id: int, service_id: int, country_code: str) -> Op
             Reservation.status == ReservationStatus.COMPLETED
         ).subquery()
         
-        # Find available number that user hasn't used before
+        # Find available number that user hasn't used before, skipping rows locked by concurrent reservations
         available_number = db.query(Number).filter(
             Number.service_id == service_id,
             Number.country_code == country_code,
             Number.status == 'AVAILABLE',
             ~Number.id.in_(used_number_ids)  # Exclude numbers already used by this user
-        ).first()
+        ).order_by(Number.id).with_for_update(skip_locked=True).limit(1).first()
         
         if not available_number:
             return None
@@ -1532,129 +1983,196 @@ async def reserve_number(user_id: int, service_id: int, country_code: str) -> Op
         available_number.expires_at = expires_at
         
         db.add(reservation)
+        bump_system_counters(db, total=1)
         db.commit()
-        db.refresh(reservation)
+        invalidate_system_stats()
+        
+        schedule_reservation_expiry(reservation.id, expires_at)
         
         return reservation
     finally:
         db.close()
 
+@dataclass
+class CompletionResult:
+    """Outcome of the database part of completing a reservation"""
+    completed: bool
+    telegram_id: str
+    price: float
+    balance: Any
+    phone_number: str = ""
+    service_id: int = 0
+    country_code: str = ""
+    has_remaining_numbers: bool = True
+
+def _complete_once(db, reservation_id: int, code: str) -> Optional[CompletionResult]:
+    """Single completion attempt; raises StaleDataError if the reservation or user changed meanwhile"""
+    # Fetch the reservation with its user, service and number in one query
+    query = db.query(Reservation, User, Service, Number).join(
+        User, Reservation.user_id == User.id
+    ).join(
+        Service, Reservation.service_id == Service.id
+    ).join(
+        Number, Reservation.number_id == Number.id
+    ).filter(
+        Reservation.id == reservation_id
+    )
+    row = query.first()
+    
+    if not row:
+        db.rollback()
+        return None
+    
+    reservation, user, service, number = row
+    
+    if reservation.status != ReservationStatus.WAITING_CODE:
+        db.rollback()
+        return None
+    
+    # Calculate price
+    price = float(number.price_override or service.default_price)
+    
+    # Check if user has enough balance
+    if float(user.balance or 0) < float(price):
+        # Mark reservation as failed due to insufficient balance
+        reservation.status = ReservationStatus.EXPIRED
+        bump_system_counters(db, failed=1)
+        db.commit()
+        invalidate_system_stats()
+        return CompletionResult(False, str(user.telegram_id), price, user.balance)
+    
+    # Complete the transaction atomically
+    user.balance = float(user.balance or 0) - price
+    reservation.status = ReservationStatus.COMPLETED
+    reservation.code_value = code
+    reservation.completed_at = datetime.now()
+    number.status = 'USED'
+    number.code_received_at = datetime.now()
+    
+    # Increment usage count
+    number.usage_count = (number.usage_count or 0) + 1
+    
+    # Count unique users who have completed reservations for this number (only up to 3 are needed)
+    unique_users = db.query(Reservation.user_id).filter(
+        Reservation.number_id == number.id,
+        Reservation.status == ReservationStatus.COMPLETED
+    ).distinct().limit(3).subquery()
+    unique_users_count = db.query(func.count()).select_from(unique_users).scalar()
+    
+    # If number has been used by 3 different users, mark it as deleted
+    if unique_users_count >= 3:
+        number.status = 'DELETED'
+        logger.info(f"Number {number.phone_number} marked as deleted after being used by {unique_users_count} different users")
+    
+    # Create transaction record
+    transaction = Transaction(
+        user_id=user.id,
+        type=TransactionType.PURCHASE,
+        amount=price,
+        reason=f"{service.name} {number.phone_number}"
+    )
+    db.add(transaction)
+    
+    # Check if this was the last available number for this country/service before committing
+    has_remaining_numbers = db.query(exists().where(
+        Number.service_id == reservation.service_id,
+        Number.country_code == number.country_code,
+        Number.status == 'AVAILABLE',
+        Number.id != number.id  # Exclude the current number being used
+    )).scalar()
+    
+    bump_system_counters(db, successful=1)
+    
+    # Commit all changes
+    db.commit()
+    invalidate_system_stats()
+    
+    return CompletionResult(
+        True, str(user.telegram_id), price, user.balance,
+        phone_number=str(number.phone_number),
+        service_id=int(reservation.service_id),
+        country_code=str(number.country_code),
+        has_remaining_numbers=has_remaining_numbers
+    )
+
+def _sync_complete(reservation_id: int, code: str) -> Optional[CompletionResult]:
+    """Charge the user and mark the reservation and number as used in one transaction"""
+    db = get_db()
+    try:
+        # Reservation and User are version-checked on commit, so no row locks are taken; retry on conflict
+        for attempt in range(3):
+            try:
+                db.connection(execution_options={"sqlite_immediate": True})
+                return _complete_once(db, reservation_id, code)
+            except StaleDataError:
+                db.rollback()
+                logger.warning(f"Reservation {reservation_id} changed concurrently, retrying ({attempt + 1}/3)")
+        return None
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
 async def complete_reservation_atomic(reservation_id: int, code: str) -> bool:
     """Complete reservation atomically with proper transaction handling"""
-    db = get_db()
     try:
-        # Begin transaction
-        
-        # Lock the reservation for update
-        reservation = db.query(Reservation).filter(
-            Reservation.id == reservation_id
-        ).with_for_update().first()
+        result = await run_db(_sync_complete, reservation_id, code)
         
-        if not reservation or reservation.status != ReservationStatus.WAITING_CODE:
-            db.rollback()
+        if not result:
             return False
         
-        # Lock related records
-        user = db.query(User).filter(
-            User.id == reservation.user_id
-        ).with_for_update().first()
-        
-        service = db.query(Service).filter(
-            Service.id == reservation.service_id
-        ).first()
-        
-        number = db.query(Number).filter(
-            Number.id == reservation.number_id
-        ).with_for_update().first()
-        
-        if not user or not service or not number:
-            db.rollback()
-            return False
-        
-        # Calculate price
-        price = float(number.price_override or service.default_price)
-        
-        # Check if user has enough balance
-        if float(user.balance or 0) < float(price):
-            # Mark reservation as failed due to insufficient balance
-            reservation.status = ReservationStatus.EXPIRED
-            db.commit()
-            
+        if not result.completed:
             await bot.send_message(
-                str(user.telegram_id),
-                f"❌ رصيدك غير كافي!\nالسعر المطلوب: {price}\nرصيدك الحالي: {user.balance}"
+                result.telegram_id,
+                f"❌ رصيدك غير كافي!\nالسعر المطلوب: {result.price}\nرصيدك الحالي: {result.balance}"
             )
             return False
         
-        # Complete the transaction atomically
-        user.balance = float(user.balance or 0) - price
-        reservation.status = ReservationStatus.COMPLETED
-        reservation.code_value = code
-        reservation.completed_at = datetime.now()
-        number.status = 'USED'
-        number.code_received_at = datetime.now()
-        
-        # Increment usage count
-        number.usage_count = (number.usage_count or 0) + 1
-        
-        # Count unique users who have completed reservations for this number
-        unique_users_count = db.query(Reservation.user_id).filter(
-            Reservation.number_id == number.id,
-            Reservation.status == ReservationStatus.COMPLETED
-        ).distinct().count()
-        
-        # If number has been used by 3 different users, mark it as deleted
-        if unique_users_count >= 3:
-            number.status = 'DELETED'
-            logger.info(f"Number {number.phone_number} marked as deleted after being used by {unique_users_count} different users")
-        
-        # Create transaction record
-        transaction = Transaction(
-            user_id=user.id,
-            type=TransactionType.PURCHASE,
-            amount=price,
-            reason=f"{service.name} {number.phone_number}"
-        )
-        db.add(transaction)
-        
-        # Check if this was the last available number for this country/service before committing
-        remaining_numbers = db.query(Number).filter(
-            Number.service_id == reservation.service_id,
-            Number.country_code == number.country_code,
-            Number.status == 'AVAILABLE',
-            Number.id != number.id  # Exclude the current number being used
-        ).count()
-        
-        # Commit all changes
-        db.commit()
-        
         # Format message with new style
-        sms_formatted = format_sms_message(str(number.phone_number), code)
+        sms_formatted = format_sms_message(result.phone_number, code)
         
         # Notify user
         await bot.send_message(
-            str(user.telegram_id),
+            result.telegram_id,
             f"🎉 وصل الكود!\n\n"
             f"```\n{sms_formatted}\n```\n\n"
-            f"تم خصم {price} من رصيدك\n"
-            f"رصيدك الحالي: {user.balance}",
+            f"تم خصم {result.price} من رصيدك\n"
+            f"رصيدك الحالي: {result.balance}",
             parse_mode="Markdown"
         )
         
         # Check if we need to notify admin about empty stock
-        if remaining_numbers == 0:
+        if not result.has_remaining_numbers:
             # Get country name for notification
-            country_name, _ = get_country_name_and_flag(str(number.country_code))
-            await notify_admin_low_stock(int(reservation.service_id), str(number.country_code), country_name)
+            country_name, _ = get_country_name_and_flag(result.country_code)
+            await notify_admin_low_stock(result.service_id, result.country_code, country_name)
         
         return True
         
     except Exception as e:
         logger.error(f"Error completing reservation atomically: {e}")
-        db.rollback()
         return False
-    finally:
-        db.close()
+
+# Shared HTTP session for provider API calls, created on first use
+_http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Get the shared provider HTTP session so connections are reused between polls"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=60, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=PROVIDER_API_TIMEOUT)
+        )
+    return _http_session
+
+async def close_http_session():
+    """Close the shared provider HTTP session when the bot stops"""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
 
 async def poll_provider_messages():
     """Poll provider APIs for new messages"""
@@ -1667,34 +2185,35 @@ async def poll_provider_messages():
                     Provider.active == True,
                     Provider.mode == ProviderMode.POLL
                 ).all()
-                
-                for provider in providers:
-                    try:
-                        await process_provider_messages(provider)
-                    except Exception as e:
-                        logger.error(f"Error processing provider {provider.name}: {e}")
-                
             finally:
                 db.close()
+            
+            # Poll all providers concurrently so a slow provider doesn't delay the others
+            session = get_http_session()
+            results = await asyncio.gather(
+                *[process_provider_messages(provider, session) for provider in providers],
+                return_exceptions=True
+            )
+            for provider, result in zip(providers, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Error processing provider {provider.name}: {result}")
                 
         except Exception as e:
             logger.error(f"Error in polling loop: {e}")
         
-        await asyncio.sleep(min(POLL_INTERVAL_SEC, 30))
+        await asyncio.sleep(jittered(min(POLL_INTERVAL_SEC, 30)))
 
-async def process_provider_messages(provider: Provider):
+async def process_provider_messages(provider: Provider, session: aiohttp.ClientSession):
     """Process messages from a specific provider"""
     try:
-        timeout = aiohttp.ClientTimeout(total=PROVIDER_API_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            headers = {"Authorization": f"Bearer {provider.api_key}"}
-            async with session.get(f"{provider.base_url}/messages", headers=headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    messages = data.get('messages', [])
-                    
-                    for msg in messages:
-                        await process_single_message(provider, msg)
+        headers = {"Authorization": f"Bearer {provider.api_key}"}
+        async with session.get(f"{provider.base_url}/messages", headers=headers) as response:
+            if response.status == 200:
+                data = await response.json()
+                messages = data.get('messages', [])
+                
+                for msg in messages:
+                    await process_single_message(provider, msg)
                         
     except Exception as e:
         logger.error(f"Error fetching messages from {provider.name}: {e}")
@@ -1721,22 +2240,15 @@ async def process_single_message(provider: Provider, message: Dict[str, Any]):
         if not code:
             return
         
-        # Find matching reservation
-        service = db.query(Service).filter(Service.name == service_name).first()
-        if not service:
-            return
-        
-        number = db.query(Number).filter(
+        # Find matching reservation by service name and reserved number in one query
+        reservation = db.query(Reservation.id).join(
+            Number, Reservation.number_id == Number.id
+        ).join(
+            Service, Number.service_id == Service.id
+        ).filter(
+            Service.name == service_name,
             Number.phone_number == to_number,
-            Number.service_id == service.id,
-            Number.status == 'RESERVED'
-        ).first()
-        
-        if not number:
-            return
-        
-        reservation = db.query(Reservation).filter(
-            Reservation.number_id == number.id,
+            Number.status == 'RESERVED',
             Reservation.status == ReservationStatus.WAITING_CODE
         ).first()
         
@@ -1757,66 +2269,126 @@ async def process_single_message(provider: Provider, message: Dict[str, Any]):
     finally:
         db.close()
 
+def schedule_reservation_expiry(reservation_id: int, expired_at: datetime):
+    """Register a reservation expiry time and wake the expiry loop"""
+    heapq.heappush(expiry_heap, (expired_at, reservation_id))
+    next_expiry_changed.set()
+
+def load_pending_expiries():
+    """Fill the expiry schedule with reservations still waiting for a code"""
+    db = get_db()
+    try:
+        pending = db.query(Reservation.expired_at, Reservation.id).filter(
+            Reservation.status == ReservationStatus.WAITING_CODE,
+            Reservation.expired_at.isnot(None)
+        ).all()
+        for expired_at, reservation_id in pending:
+            heapq.heappush(expiry_heap, (expired_at, reservation_id))
+    finally:
+        db.close()
+
+async def expire_reservations(reservation_ids: List[int]):
+    """Expire the given reservations if they are still waiting for a code"""
+    db = get_db()
+    try:
+        db.connection(execution_options={"sqlite_immediate": True})
+        
+        # Mark reservations as expired and collect their numbers and users
+        expired = db.execute(
+            update(Reservation)
+            .where(
+                Reservation.id.in_(reservation_ids),
+                Reservation.status == ReservationStatus.WAITING_CODE,
+                Reservation.expired_at < datetime.now()
+            )
+            .values(status=ReservationStatus.EXPIRED, version=Reservation.version + 1)
+            .returning(Reservation.id, Reservation.user_id, Reservation.number_id)
+        ).all()
+        
+        if not expired:
+            db.commit()
+            return
+        
+        # Delete numbers that didn't receive codes, return the others to available
+        db.execute(
+            update(Number)
+            .where(Number.id.in_([row.number_id for row in expired]))
+            .values(
+                status=cast(case(
+                    (Number.code_received_at.is_(None), 'DELETED'),
+                    else_='AVAILABLE'
+                ), Number.status.type),
+                reserved_by_user_id=None,
+                reserved_at=None,
+                expires_at=None
+            )
+            .execution_options(synchronize_session=False)
+        )
+        
+        telegram_ids = dict(
+            db.query(User.id, User.telegram_id).filter(
+                User.id.in_({row.user_id for row in expired})
+            ).all()
+        )
+        
+        bump_system_counters(db, failed=len(expired))
+        db.commit()
+        invalidate_system_stats()
+        logger.info(f"⏰ Expired {len(expired)} reservations")
+    finally:
+        db.close()
+    
+    # Notify users
+    keyboard = InlineKeyboardBuilder()
+    keyboard.row(InlineKeyboardButton(text="🔄 احجز رقم جديد", callback_data="main_menu"))
+    reply_markup = keyboard.as_markup()
+    
+    # Notification errors are silently ignored
+    await asyncio.gather(*[
+        bot.send_message(
+            telegram_id,
+            "⏰ انتهت مهلة انتظار الكود\n"
+            "لم يتم خصم أي رسوم من رصيدك\n"
+            "يمكنك حجز رقم جديد",
+            reply_markup=reply_markup
+        )
+        for telegram_id in (telegram_ids.get(row.user_id) for row in expired)
+        if telegram_id
+    ], return_exceptions=True)
+
 async def check_expired_reservations():
-    """Check and expire old reservations"""
+    """Check and expire old reservations, sleeping until the next scheduled expiry"""
+    load_pending_expiries()
+    
     while True:
         try:
-            db = get_db()
-            try:
-                now = datetime.now()
-                expired_reservations = db.query(Reservation).filter(
-                    Reservation.status == ReservationStatus.WAITING_CODE,
-                    Reservation.expired_at < now
-                ).all()
-                
-                for reservation in expired_reservations:
-                    # Mark as expired
-                    reservation.status = ReservationStatus.EXPIRED
-                    
-                    # Delete number that was reserved but didn't receive codes
-                    number = db.query(Number).filter(Number.id == reservation.number_id).first()
-                    if number:
-                        # Check if number received any codes during reservation
-                        if number.code_received_at is None:
-                            # Delete the number if no code was received
-                            number.status = 'DELETED'
-                            logger.info(f"Number {number.phone_number} deleted after reservation expired without receiving code")
-                        else:
-                            # Return to available if it did receive a code but wasn't completed
-                            number.status = 'AVAILABLE'
-                            
-                        number.reserved_by_user_id = None
-                        number.reserved_at = None
-                        number.expires_at = None
-                    
-                    # Notify user
-                    user = db.query(User).filter(User.id == reservation.user_id).first()
-                    if user:
-                        keyboard = InlineKeyboardBuilder()
-                        keyboard.row(InlineKeyboardButton(text="🔄 احجز رقم جديد", callback_data="main_menu"))
-                        
-                        try:
-                            await bot.send_message(
-                                user.telegram_id,
-                                "⏰ انتهت مهلة انتظار الكود\n"
-                                "لم يتم خصم أي رسوم من رصيدك\n"
-                                "يمكنك حجز رقم جديد",
-                                reply_markup=keyboard.as_markup()
-                            )
-                        except Exception:
-                            # Silently ignore user notification errors
-                            pass
-                
-                db.commit()
-                
-            finally:
-                db.close()
+            now = datetime.now()
+            due = []
+            while expiry_heap and expiry_heap[0][0] <= now:
+                due.append(heapq.heappop(expiry_heap))
+            
+            # Expire in batches so a backlog after downtime doesn't stall the loop
+            for start in range(0, len(due), EXPIRY_BATCH_SIZE):
+                try:
+                    await expire_reservations([reservation_id for _, reservation_id in due[start:start + EXPIRY_BATCH_SIZE]])
+                except Exception:
+                    # Reschedule this batch and the ones after it so the next pass retries them
+                    for entry in due[start:]:
+                        heapq.heappush(expiry_heap, entry)
+                    raise
+                await asyncio.sleep(0)
         
-        except Exception:
-            # Reduced logging to prevent spam
-            pass
+        except Exception as e:
+            logger.error(f"❌ Error expiring reservations, retrying in {EXPIRY_RETRY_DELAY}s: {e}")
+            await asyncio.sleep(EXPIRY_RETRY_DELAY)
         
-        await asyncio.sleep(30)  # Check every 30 seconds
+        # Sleep until the next expiry or until a new reservation is scheduled
+        timeout = (expiry_heap[0][0] - datetime.now()).total_seconds() if expiry_heap else None
+        next_expiry_changed.clear()
+        try:
+            await asyncio.wait_for(next_expiry_changed.wait(), timeout=max(timeout, 0) if timeout is not None else None)
+        except asyncio.TimeoutError:
+            pass
 
 async def check_user_subscriptions_periodically():
     """Check all users' subscriptions periodically and block those who left"""
@@ -1825,87 +2397,158 @@ async def check_user_subscriptions_periodically():
             db = get_db()
             try:
                 # Get all active forced subscriptions
-                forced_subs = db.query(ForcedSubscription).filter(
-                    ForcedSubscription.active == True
-                ).all()
-                
-                if not forced_subs:
-                    await asyncio.sleep(120)  # Check every 2 minutes if no forced subs
-                    continue
+                channel_ids = [
+                    channel_id for (channel_id,) in db.query(ForcedSubscription.channel_id).filter(
+                        ForcedSubscription.active == True
+                    ).all()
+                ]
                 
                 # Get all users who are not admins
-                users = db.query(User).filter(
-                    User.telegram_id != str(ADMIN_ID),
-                    User.is_banned == False
-                ).all()
+                telegram_ids = [
+                    telegram_id for (telegram_id,) in db.query(User.telegram_id).filter(
+                        User.telegram_id != str(ADMIN_ID),
+                        User.is_banned == False
+                    ).all()
+                ] if channel_ids else []
+            finally:
+                db.close()
+            
+            if not channel_ids:
+                await asyncio.sleep(jittered(120))  # Check every 2 minutes if no forced subs
+                continue
+            
+            user_ids = []
+            for telegram_id in telegram_ids:
+                try:
+                    user_ids.append(int(telegram_id))
+                except ValueError as e:
+                    logger.error(f"Error processing user {telegram_id}: {e}")
+            
+            # Check all memberships concurrently, limited to stay within Telegram rate limits
+            semaphore = asyncio.Semaphore(20)
+            
+            async def is_member(user_id: int, channel_id: str) -> bool:
+                async with semaphore:
+                    return await is_channel_member(user_id, channel_id)
+            
+            results = await asyncio.gather(
+                *[is_member(user_id, channel_id) for user_id in user_ids for channel_id in channel_ids],
+                return_exceptions=True
+            )
+            
+            subscription_keyboard = None
+            for index, user_id in enumerate(user_ids):
+                user_results = results[index * len(channel_ids):(index + 1) * len(channel_ids)]
                 
-                for user in users:
+                for channel_id, result in zip(channel_ids, user_results):
+                    if isinstance(result, Exception):
+                        logger.error(f"Error checking subscription for user {user_id} in channel {channel_id}: {result}")
+                
+                # If user left required channels, send warning
+                if any(result is False for result in user_results):
                     try:
-                        user_id = int(user.telegram_id)
-                        is_subscribed = True
-                        
-                        for sub in forced_subs:
-                            try:
-                                member = await bot.get_chat_member(sub.channel_id, user_id)
-                                if member.status in ['left', 'kicked']:
-                                    is_subscribed = False
-                                    break
-                            except Exception as e:
-                                logger.error(f"Error checking subscription for user {user_id} in channel {sub.channel_id}: {e}")
-                                continue
-                        
-                        # If user left required channels, send warning
-                        if not is_subscribed:
-                            try:
-                                subscription_keyboard = await create_subscription_keyboard()
-                                await bot.send_message(
-                                    user_id,
-                                    "⚠️ تم اكتشاف خروجك من إحدى القنوات الإجبارية!\n\n"
-                                    "🔒 يجب الاشتراك في جميع القنوات التالية لمواصلة استخدام البوت:\n\n"
-                                    "👇 اضغط على الأزرار للاشتراك مرة أخرى:",
-                                    reply_markup=subscription_keyboard
-                                )
-                            except Exception as e:
-                                logger.error(f"Error sending subscription warning to user {user_id}: {e}")
-                        
+                        if subscription_keyboard is None:
+                            subscription_keyboard = await create_subscription_keyboard()
+                        await bot.send_message(
+                            user_id,
+                            "⚠️ تم اكتشاف خروجك من إحدى القنوات الإجبارية!\n\n"
+                            "🔒 يجب الاشتراك في جميع القنوات التالية لمواصلة استخدام البوت:\n\n"
+                            "👇 اضغط على الأزرار للاشتراك مرة أخرى:",
+                            reply_markup=subscription_keyboard
+                        )
                     except Exception as e:
-                        logger.error(f"Error processing user {user.telegram_id}: {e}")
-                        continue
-                
-            finally:
-                db.close()
+                        logger.error(f"Error sending subscription warning to user {user_id}: {e}")
                 
         except Exception as e:
             logger.error(f"Error in subscription check task: {e}")
         
-        await asyncio.sleep(900)  # Check every 15 minutes
+        await asyncio.sleep(jittered(900))  # Check every 15 minutes
 
 # Subscription and user data channel functions
+
+# Confirmed channel memberships per (user_id, channel_id) with their expiry on the monotonic clock;
+# negative answers aren't cached so a user who just joined is let in right away
+_sub_cache: Dict[tuple, float] = {}
+SUBSCRIPTION_CACHE_TTL = 300  # 5 minutes
+
+async def is_channel_member(user_id: int, channel_id: str) -> bool:
+    """Check channel membership, reusing a recent positive answer"""
+    now = time.monotonic()
+    expires_at = _sub_cache.get((user_id, channel_id))
+    if expires_at and now < expires_at:
+        return True
+    
+    member = await bot.get_chat_member(channel_id, user_id)
+    if member.status in ['left', 'kicked']:
+        _sub_cache.pop((user_id, channel_id), None)
+        return False
+    
+    # Drop expired entries once the cache grows large
+    if len(_sub_cache) > 10000:
+        for key in [key for key, expires_at in _sub_cache.items() if expires_at <= now]:
+            del _sub_cache[key]
+    _sub_cache[(user_id, channel_id)] = now + SUBSCRIPTION_CACHE_TTL
+    return True
+
+def clear_subscription_cache(user_id: int):
+    """Forget cached memberships of a user so the next check asks Telegram"""
+    for key in [key for key in _sub_cache if key[0] == user_id]:
+        _sub_cache.pop(key, None)
+
 async def check_user_subscription(user_id: int) -> bool:
     """Check if user is subscribed to all required channels"""
     db = get_db()
     try:
         # Get all active forced subscriptions
-        forced_subs = db.query(ForcedSubscription).filter(
-            ForcedSubscription.active == True
-        ).all()
-        
-        if not forced_subs:
-            return True  # No forced subscriptions
-        
-        for sub in forced_subs:
-            try:
-                # Check if user is member of the channel
-                member = await bot.get_chat_member(sub.channel_id, user_id)
-                if member.status in ['left', 'kicked']:
-                    return False
-            except Exception as e:
-                logger.error(f"Error checking subscription for channel {sub.channel_id}: {e}")
-                return False
-        
-        return True
+        channel_ids = [
+            channel_id for (channel_id,) in db.query(ForcedSubscription.channel_id).filter(
+                ForcedSubscription.active == True
+            ).all()
+        ]
     finally:
         db.close()
+    
+    if not channel_ids:
+        return True  # No forced subscriptions
+    
+    # Check if user is member of each channel
+    results = await asyncio.gather(
+        *[is_channel_member(user_id, channel_id) for channel_id in channel_ids],
+        return_exceptions=True
+    )
+    
+    for channel_id, result in zip(channel_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error checking subscription for channel {channel_id}: {result}")
+            return False
+        if not result:
+            return False
+    
+    return True
+
+# Message templates for the user data channel
+USER_DATA_TEMPLATE = (
+    "👤 **معلومات مستخدم جديد**\n\n"
+    "🆔 **المعرف:** `{telegram_id}`\n"
+    "👤 **الاسم:** {full_name}\n"
+    "{username_line}"
+    "💰 **الرصيد:** {balance}\n"
+    "📅 **تاريخ الانضمام:** {joined_at}\n"
+)
+USER_RESERVATION_TEMPLATE = (
+    "\n📱 **آخر رقم:** {phone_number}\n"
+    "🏷 **الخدمة:** {service_emoji} {service_name}\n"
+)
+USERS_REPORT_TEMPLATE = (
+    "📊 **تقرير شامل لجميع المستخدمين**\n"
+    "📅 **التاريخ:** {date}\n\n"
+    "👥 **إجمالي المستخدمين:** {total_users}\n\n"
+    "💰 **إجمالي الأرصدة:** {total_balance:.2f}\n"
+    "✅ **المستخدمين النشطين:** {active_users}\n"
+    "🚫 **المستخدمين المحظورين:** {banned_users}\n\n"
+    "📱 **الحجوزات النشطة:** {active_reservations}\n"
+    "✅ **الحجوزات المكتملة:** {completed_reservations}\n\n"
+)
 
 async def send_user_data_to_channel(user: User, reservation: Optional[Reservation] = None):
     """Send user data to the configured user data channel"""
@@ -1920,25 +2563,23 @@ async def send_user_data_to_channel(user: User, reservation: Optional[Reservatio
             return
         
         # Prepare user info
-        user_info = f"👤 **معلومات مستخدم جديد**\n\n"
-        user_info += f"🆔 **المعرف:** `{user.telegram_id}`\n"
-        user_info += f"👤 **الاسم:** {user.first_name or 'غير محدد'}"
-        if user.last_name:
-            user_info += f" {user.last_name}"
-        user_info += "\n"
-        
-        if user.username:
-            user_info += f"📝 **اليوزر:** @{user.username}\n"
-        
-        user_info += f"💰 **الرصيد:** {user.balance}\n"
-        user_info += f"📅 **تاريخ الانضمام:** {user.joined_at.strftime('%Y-%m-%d %H:%M')}\n"
+        user_info = USER_DATA_TEMPLATE.format(
+            telegram_id=user.telegram_id,
+            full_name=f"{user.first_name or 'غير محدد'} {user.last_name}" if user.last_name else (user.first_name or 'غير محدد'),
+            username_line=f"📝 **اليوزر:** @{user.username}\n" if user.username else "",
+            balance=user.balance,
+            joined_at=user.joined_at.strftime('%Y-%m-%d %H:%M')
+        )
         
         if reservation:
-            service = db.query(Service).filter(Service.id == reservation.service_id).first()
-            number = db.query(Number).filter(Number.id == reservation.number_id).first()
+            service = db.get(Service, reservation.service_id)
+            number = db.get(Number, reservation.number_id)
             if service and number:
-                user_info += f"\n📱 **آخر رقم:** {number.phone_number}\n"
-                user_info += f"🏷 **الخدمة:** {service.emoji} {service.name}\n"
+                user_info += USER_RESERVATION_TEMPLATE.format(
+                    phone_number=number.phone_number,
+                    service_emoji=service.emoji,
+                    service_name=service.name
+                )
         
         # Send to channel
         await bot.send_message(
@@ -1965,40 +2606,36 @@ async def send_all_users_data_periodically():
                 
                 if not channel:
                     logger.info("No active user data channel configured")
-                    await asyncio.sleep(1800)  # Check every 30 minutes if no channel
+                    await asyncio.sleep(jittered(1800))  # Check every 30 minutes if no channel
                     continue
                 
-                # Get all users
-                users = db.query(User).all()
+                # Aggregate user statistics in the database
+                total_users, banned_users, total_balance = db.query(
+                    func.count(User.id),
+                    func.count(User.id).filter(User.is_banned == True),
+                    func.coalesce(func.sum(User.balance), 0)
+                ).one()
                 
-                if not users:
-                    await asyncio.sleep(1800)  # Check every 30 minutes if no users
+                if not total_users:
+                    await asyncio.sleep(jittered(1800))  # Check every 30 minutes if no users
                     continue
                 
-                # Prepare comprehensive report
-                report = f"📊 **تقرير شامل لجميع المستخدمين**\n"
-                report += f"📅 **التاريخ:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-                report += f"👥 **إجمالي المستخدمين:** {len(users)}\n\n"
-                
-                # Calculate statistics
-                total_balance = sum(user.balance for user in users)
-                active_users = [u for u in users if not u.is_banned]
-                banned_users = [u for u in users if u.is_banned]
-                
-                report += f"💰 **إجمالي الأرصدة:** {total_balance:.2f}\n"
-                report += f"✅ **المستخدمين النشطين:** {len(active_users)}\n"
-                report += f"🚫 **المستخدمين المحظورين:** {len(banned_users)}\n\n"
-                
                 # Get reservations data
-                active_reservations = db.query(Reservation).filter(
-                    Reservation.status == ReservationStatus.WAITING_CODE
-                ).count()
-                completed_reservations = db.query(Reservation).filter(
-                    Reservation.status == ReservationStatus.COMPLETED
-                ).count()
+                active_reservations, completed_reservations = db.query(
+                    func.count(Reservation.id).filter(Reservation.status == ReservationStatus.WAITING_CODE),
+                    func.count(Reservation.id).filter(Reservation.status == ReservationStatus.COMPLETED)
+                ).one()
                 
-                report += f"📱 **الحجوزات النشطة:** {active_reservations}\n"
-                report += f"✅ **الحجوزات المكتملة:** {completed_reservations}\n\n"
+                # Prepare comprehensive report
+                report = USERS_REPORT_TEMPLATE.format(
+                    date=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    total_users=total_users,
+                    total_balance=total_balance,
+                    active_users=total_users - banned_users,
+                    banned_users=banned_users,
+                    active_reservations=active_reservations,
+                    completed_reservations=completed_reservations
+                )
                 
                 # Send summary first
                 await bot.send_message(
@@ -2008,8 +2645,7 @@ async def send_all_users_data_periodically():
                 )
                 
                 # Skip sending individual user data to prevent flood control
-                user_count = len(users)
-                logger.info(f"Report sent successfully. Total users: {user_count}")
+                logger.info(f"Report sent successfully. Total users: {total_users}")
                 
                 # Individual user data sending disabled to prevent flood control
                 
@@ -2020,7 +2656,7 @@ async def send_all_users_data_periodically():
             logger.error(f"Error in periodic user data sending: {e}")
         
         # Wait 24 hours before next send to reduce frequency
-        await asyncio.sleep(86400)
+        await asyncio.sleep(jittered(86400))
 
 async def create_subscription_keyboard() -> InlineKeyboardMarkup:
     """Create keyboard with subscription channels"""
@@ -2242,6 +2878,7 @@ async def process_service_group_id(message: types.Message, state: FSMContext):
         )
         db.add(service_group)
         db.commit()
+        load_service_cache()
         
         await state.clear()
         await message.reply(
@@ -2270,7 +2907,7 @@ async def reactivate_service_handler(callback: CallbackQuery):
     
     db = get_db()
     try:
-        service = db.query(Service).filter(Service.id == service_id).first()
+        service = db.get(Service, service_id)
         
         if not service:
             await callback.answer("❌ لم يتم العثور على الخدمة")
@@ -2279,6 +2916,7 @@ async def reactivate_service_handler(callback: CallbackQuery):
         # Reactivate the service
         service.active = True
         db.commit()
+        load_service_cache()
         
         await callback.message.edit_text(
             f"✅ تم تفعيل الخدمة بنجاح!\n\n"
@@ -2299,6 +2937,21 @@ async def reactivate_service_handler(callback: CallbackQuery):
 
 # Security system removed - services are created directly without security setup
 
+BACK_TO_SERVICES_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[[
+    InlineKeyboardButton(text="🔙 إدارة الخدمات", callback_data="admin_services")
+]])
+BACK_TO_MESSAGE_STATS_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[[
+    InlineKeyboardButton(text="🔙 إحصائيات الرسائل", callback_data="admin_messages_stats")
+]])
+BOT_MEMBER_STATUS_LABELS = {
+    'creator': '👑 المؤسس',
+    'administrator': '👮‍♂️ مشرف',
+    'member': '👤 عضو',
+    'restricted': '🚫 مقيد',
+    'left': '❌ غير موجود',
+    'kicked': '🚫 محظور'
+}
+
 @dp.callback_query(F.data.startswith("test_group_"))
 async def test_group_handler(callback: CallbackQuery):
     """Test group connectivity"""
@@ -2325,25 +2978,14 @@ async def test_group_handler(callback: CallbackQuery):
             # Try to get bot member status
             bot_member = await bot.get_chat_member(str(service_group.group_chat_id), bot.id)
             
-            status_text = {
-                'creator': '👑 المؤسس',
-                'administrator': '👮‍♂️ مشرف',
-                'member': '👤 عضو',
-                'restricted': '🚫 مقيد',
-                'left': '❌ غير موجود',
-                'kicked': '🚫 محظور'
-            }
-            
             await callback.message.edit_text(
                 f"🔍 نتائج اختبار الجروب\n\n"
                 f"📞 Group ID: {service_group.group_chat_id}\n"
                 f"📝 اسم الجروب: {chat.title or 'غير محدد'}\n"
                 f"👥 نوع الجروب: {chat.type}\n"
-                f"🤖 حالة البوت: {status_text.get(bot_member.status, bot_member.status)}\n\n"
+                f"🤖 حالة البوت: {BOT_MEMBER_STATUS_LABELS.get(bot_member.status, bot_member.status)}\n\n"
                 "✅ الاتصال بالجروب ناجح!",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                    InlineKeyboardButton(text="🔙 إدارة الخدمات", callback_data="admin_services")
-                ]])
+                reply_markup=BACK_TO_SERVICES_KEYBOARD
             )
             
         except Exception as e:
@@ -2355,13 +2997,39 @@ async def test_group_handler(callback: CallbackQuery):
                 "• البوت عضو في الجروب\n"
                 "• Group ID صحيح\n"
                 "• البوت لديه صلاحيات قراءة الرسائل",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                    InlineKeyboardButton(text="🔙 إدارة الخدمات", callback_data="admin_services")
-                ]])
+                reply_markup=BACK_TO_SERVICES_KEYBOARD
             )
     finally:
         db.close()
 
+CHAT_INFO_TEMPLATE = (
+    "📊 معلومات الدردشة\n\n"
+    "🆔 Chat ID: `{chat_id}`\n"
+    "📝 الاسم: {title}\n"
+    "👥 النوع: {chat_type}\n"
+    "👤 اليوزر: @{username}"
+)
+
+# Chat member status per (chat_id, user_id): (status, expiry on the monotonic clock)
+_chat_member_cache: Dict[tuple, tuple[str, float]] = {}
+CHAT_MEMBER_CACHE_TTL = 60  # seconds
+
+async def get_chat_member_status(chat_id: int, user_id: int) -> str:
+    """Get a user's member status in a chat, asking Telegram only when the cached value has expired"""
+    now = time.monotonic()
+    cached = _chat_member_cache.get((chat_id, user_id))
+    if cached and now < cached[1]:
+        return cached[0]
+    
+    chat_member = await bot.get_chat_member(chat_id, user_id)
+    
+    # Drop expired entries once the cache grows large
+    if len(_chat_member_cache) > 4096:
+        for key in [key for key, (_, expires_at) in _chat_member_cache.items() if expires_at <= now]:
+            del _chat_member_cache[key]
+    _chat_member_cache[(chat_id, user_id)] = (chat_member.status, now + CHAT_MEMBER_CACHE_TTL)
+    return chat_member.status
+
 # Command to get chat info (helpful for admins)
 @dp.message(Command("chatinfo"))
 async def chatinfo_handler(message: types.Message):
@@ -2375,24 +3043,30 @@ async def chatinfo_handler(message: types.Message):
     
     # Check if user is admin
     try:
-        chat_member = await bot.get_chat_member(message.chat.id, message.from_user.id)
-        if chat_member.status not in ['creator', 'administrator']:
+        member_status = await get_chat_member_status(message.chat.id, message.from_user.id)
+        if member_status not in ['creator', 'administrator']:
             await message.reply("هذا الأمر متاح للمشرفين فقط")
             return
     except:
         await message.reply("لا يمكن التحقق من صلاحياتك")
         return
     
-    chat_info = (
-        f"📊 معلومات الدردشة\n\n"
-        f"🆔 Chat ID: `{message.chat.id}`\n"
-        f"📝 الاسم: {message.chat.title or 'غير محدد'}\n"
-        f"👥 النوع: {message.chat.type}\n"
-        f"👤 اليوزر: @{message.chat.username or 'غير محدد'}"
+    chat_info = CHAT_INFO_TEMPLATE.format(
+        chat_id=message.chat.id,
+        title=message.chat.title or 'غير محدد',
+        chat_type=message.chat.type,
+        username=message.chat.username or 'غير محدد'
     )
     
     await message.reply(chat_info, parse_mode="Markdown")
 
+# SecurityMode values are strings rather than consecutive integers, so icons are keyed by the enum member
+SECURITY_MODE_ICONS: Dict[SecurityMode, str] = {
+    SecurityMode.TOKEN_ONLY: "🔑",
+    SecurityMode.ADMIN_ONLY: "👑",
+    SecurityMode.HMAC: "🔐"
+}
+
 @dp.callback_query(F.data == "admin_service_groups")
 async def admin_service_groups_handler(callback: CallbackQuery):
     """Handle service groups management"""
@@ -2402,44 +3076,39 @@ async def admin_service_groups_handler(callback: CallbackQuery):
     
     db = get_db()
     try:
-        service_groups = db.query(ServiceGroup).join(Service).all()
-        
-        text = "🔗 إدارة ربط الخدمات بالجروبات\n\n"
+        service_groups = db.query(ServiceGroup).join(Service).options(
+            contains_eager(ServiceGroup.service)
+        ).all()
         
-        if service_groups:
-            text += "الروابط الحالية:\n"
-            for sg in service_groups:
-                status = "✅" if sg.active else "❌"
-                security_icon = {
-                    SecurityMode.TOKEN_ONLY: "🔑",
-                    SecurityMode.ADMIN_ONLY: "👑",
-                    SecurityMode.HMAC: "🔐"
-                }.get(sg.security_mode, "🔑")
-                
-                text += f"{status} {sg.service.emoji} {sg.service.name}\n"
-                text += f"   📞 {sg.group_chat_id} {security_icon}\n\n"
-        else:
-            text += "لا توجد روابط محددة\n"
+        text_parts = ["🔗 إدارة ربط الخدمات بالجروبات\n\n"]
+        text_parts.append("الروابط الحالية:\n" if service_groups else "لا توجد روابط محددة\n")
         
         keyboard = InlineKeyboardBuilder()
         
-        for sg in service_groups:
+        # Check if bot is admin in all groups concurrently
+        bot_statuses = await asyncio.gather(
+            *(verify_bot_in_group(sg.group_chat_id) for sg in service_groups),
+            return_exceptions=True
+        )
+        
+        # Build the listing and its buttons in the same pass
+        for sg, bot_status in zip(service_groups, bot_statuses):
             status = "✅" if sg.active else "❌"
-            security_icon = {
-                SecurityMode.TOKEN_ONLY: "🔑",
-                SecurityMode.ADMIN_ONLY: "👑", 
-                SecurityMode.HMAC: "🔐"
-            }.get(sg.security_mode, "🔑")
-            
-            # Check if bot is admin in the group
-            bot_status = await verify_bot_in_group(sg.group_chat_id)
+            security_icon = SECURITY_MODE_ICONS.get(sg.security_mode, "🔑")
+            service_label = f"{sg.service.emoji} {sg.service.name}"
+            
+            if isinstance(bot_status, Exception):
+                bot_status = False
             bot_icon = "🤖✅" if bot_status else "🤖❌"
             
+            text_parts.append(f"{status} {service_label}\n   📞 {sg.group_chat_id} {security_icon}\n\n")
             keyboard.row(InlineKeyboardButton(
-                text=f"{status} {sg.service.emoji} {sg.service.name} - {sg.group_chat_id} {security_icon} {bot_icon}",
+                text=f"{status} {service_label} - {sg.group_chat_id} {security_icon} {bot_icon}",
                 callback_data=f"edit_service_group_{sg.id}"
             ))
         
+        text = "".join(text_parts)
+        
         keyboard.row(
             InlineKeyboardButton(text="➕ ربط خدمة بجروب", callback_data="admin_add_service"),
             InlineKeyboardButton(text="📊 إحصائيات الرسائل", callback_data="admin_messages_stats")
@@ -2451,69 +3120,97 @@ async def admin_service_groups_handler(callback: CallbackQuery):
     finally:
         db.close()
 
+# Rendered message stats: (text, keyboard, expiry on the monotonic clock)
+_message_stats_cache: Optional[tuple[str, InlineKeyboardMarkup, float]] = None
+MESSAGE_STATS_CACHE_TTL = 5  # seconds
+
+def invalidate_message_stats_cache():
+    """Force the next message stats view to re-query the database"""
+    global _message_stats_cache
+    _message_stats_cache = None
+
+async def edit_text_if_changed(message: types.Message, text: str, reply_markup: InlineKeyboardMarkup = None) -> bool:
+    """Edit a message unless it already shows this text and keyboard"""
+    # Telegram strips surrounding whitespace from message text
+    if message.text == text.strip() and message.reply_markup == reply_markup:
+        return False
+    try:
+        await message.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+        return False
+    return True
+
 @dp.callback_query(F.data == "admin_messages_stats")
 async def admin_messages_stats_handler(callback: CallbackQuery):
     """Handle messages statistics"""
+    global _message_stats_cache
     if not is_admin_session_valid(callback.from_user.id):
         await callback.answer("❌ انتهت صلاحية الجلسة")
         return
     
-    db = get_db()
-    try:
-        # Get message statistics
-        total_messages = db.query(ProviderMessage).count()
-        processed_messages = db.query(ProviderMessage).filter(
-            ProviderMessage.status == MessageStatus.PROCESSED
-        ).count()
-        rejected_messages = db.query(ProviderMessage).filter(
-            ProviderMessage.status == MessageStatus.REJECTED
-        ).count()
-        orphan_messages = db.query(ProviderMessage).filter(
-            ProviderMessage.status == MessageStatus.ORPHAN
-        ).count()
-        blocked_messages = db.query(BlockedMessage).count()
-        
-        # Get recent completed reservations
-        recent_completions = db.query(Reservation).filter(
-            Reservation.status == ReservationStatus.COMPLETED
-        ).order_by(Reservation.completed_at.desc()).limit(5).all()
-        
-        text = f"📊 إحصائيات الرسائل\n\n"
-        text += f"📬 إجمالي الرسائل: {total_messages}\n"
-        text += f"✅ معالجة: {processed_messages}\n"
-        text += f"❌ مرفوضة: {rejected_messages}\n"
-        text += f"🔶 يتيمة: {orphan_messages}\n"
-        text += f"🚫 محظورة: {blocked_messages}\n\n"
-        
-        if recent_completions:
-            text += "🎉 آخر الإنجازات:\n"
-            for res in recent_completions:
-                service = db.query(Service).filter(Service.id == res.service_id).first()
-                number = db.query(Number).filter(Number.id == res.number_id).first()
-                if service and number:
-                    text += f"• {service.emoji} {service.name} - {number.phone_number}\n"
-        
-        keyboard = InlineKeyboardBuilder()
-        keyboard.row(
-            InlineKeyboardButton(text="🗑️ تنظيف الرسائل القديمة", callback_data="admin_cleanup_messages"),
-            InlineKeyboardButton(text="🔄 تحديث", callback_data="admin_messages_stats")
-        )
-        keyboard.row(
-            InlineKeyboardButton(text="🧹 مسح كل رسائل الجروب", callback_data="admin_cleanup_all_group_messages"),
-            InlineKeyboardButton(text="🚫 مسح الرسائل المحظورة", callback_data="admin_cleanup_blocked_messages")
-        )
-        keyboard.row(
-            InlineKeyboardButton(text="🔍 معالجة الرسائل اليتيمة", callback_data="admin_process_orphan_messages")
-        )
-        keyboard.row(
-            InlineKeyboardButton(text="🗑️ حذف جميع رسائل الجروبات", callback_data="admin_delete_all_telegram_messages")
-        )
-        keyboard.row(InlineKeyboardButton(text="🔙 إدارة الخدمات", callback_data="admin_services"))
-        
-        await callback.message.edit_text(text, reply_markup=keyboard.as_markup())
+    now = time.monotonic()
+    if _message_stats_cache and now < _message_stats_cache[2]:
+        text, markup, _ = _message_stats_cache
+    else:
+        db = get_db()
+        try:
+            # Get message statistics in a single grouped scan
+            status_counts = dict(
+                db.query(ProviderMessage.status, func.count()).group_by(ProviderMessage.status).all()
+            )
+            total_messages = sum(status_counts.values())
+            processed_messages = status_counts.get(MessageStatus.PROCESSED, 0)
+            rejected_messages = status_counts.get(MessageStatus.REJECTED, 0)
+            orphan_messages = status_counts.get(MessageStatus.ORPHAN, 0)
+            blocked_messages = db.query(BlockedMessage).count()
+            
+            # Get recent completed reservations
+            recent_completions = db.query(Reservation).options(
+                joinedload(Reservation.service),
+                joinedload(Reservation.number)
+            ).filter(
+                Reservation.status == ReservationStatus.COMPLETED
+            ).order_by(Reservation.completed_at.desc()).limit(5).all()
+            
+            text = f"📊 إحصائيات الرسائل\n\n"
+            text += f"📬 إجمالي الرسائل: {total_messages}\n"
+            text += f"✅ معالجة: {processed_messages}\n"
+            text += f"❌ مرفوضة: {rejected_messages}\n"
+            text += f"🔶 يتيمة: {orphan_messages}\n"
+            text += f"🚫 محظورة: {blocked_messages}\n\n"
+            
+            if recent_completions:
+                text += "🎉 آخر الإنجازات:\n"
+                for res in recent_completions:
+                    if res.service and res.number:
+                        text += f"• {res.service.emoji} {res.service.name} - {res.number.phone_number}\n"
+            
+            keyboard = InlineKeyboardBuilder()
+            keyboard.row(
+                InlineKeyboardButton(text="🗑️ تنظيف الرسائل القديمة", callback_data="admin_cleanup_messages"),
+                InlineKeyboardButton(text="🔄 تحديث", callback_data="admin_messages_stats")
+            )
+            keyboard.row(
+                InlineKeyboardButton(text="🧹 مسح كل رسائل الجروب", callback_data="admin_cleanup_all_group_messages"),
+                InlineKeyboardButton(text="🚫 مسح الرسائل المحظورة", callback_data="admin_cleanup_blocked_messages")
+            )
+            keyboard.row(
+                InlineKeyboardButton(text="🔍 معالجة الرسائل اليتيمة", callback_data="admin_process_orphan_messages")
+            )
+            keyboard.row(
+                InlineKeyboardButton(text="🗑️ حذف جميع رسائل الجروبات", callback_data="admin_delete_all_telegram_messages")
+            )
+            keyboard.row(InlineKeyboardButton(text="🔙 إدارة الخدمات", callback_data="admin_services"))
+        finally:
+            db.close()
         
-    finally:
-        db.close()
+        markup = keyboard.as_markup()
+        _message_stats_cache = (text, markup, now + MESSAGE_STATS_CACHE_TTL)
+    
+    if not await edit_text_if_changed(callback.message, text, markup):
+        await callback.answer("✅")
 
 @dp.callback_query(F.data == "admin_cleanup_messages")
 async def admin_cleanup_messages_handler(callback: CallbackQuery):
@@ -2529,11 +3226,11 @@ async def admin_cleanup_messages_handler(callback: CallbackQuery):
         
         deleted_provider = db.query(ProviderMessage).filter(
             ProviderMessage.received_at < cutoff_date
-        ).delete()
+        ).delete(synchronize_session=False)
         
         deleted_blocked = db.query(BlockedMessage).filter(
             BlockedMessage.created_at < cutoff_date
-        ).delete()
+        ).delete(synchronize_session=False)
         
         db.commit()
         
@@ -2543,6 +3240,7 @@ async def admin_cleanup_messages_handler(callback: CallbackQuery):
         )
         
         # Refresh the stats
+        invalidate_message_stats_cache()
         await admin_messages_stats_handler(callback)
         
     except Exception as e:
@@ -2561,11 +3259,17 @@ async def admin_cleanup_all_group_messages_handler(callback: CallbackQuery):
     
     db = get_db()
     try:
-        # Delete all provider messages from groups
-        deleted_provider = db.query(ProviderMessage).delete()
-        
-        # Delete all blocked messages from groups
-        deleted_blocked = db.query(BlockedMessage).delete()
+        if engine.dialect.name == 'postgresql':
+            # TRUNCATE drops the tables' contents without scanning them row by row
+            deleted_provider = db.query(ProviderMessage).count()
+            deleted_blocked = db.query(BlockedMessage).count()
+            db.execute(text("TRUNCATE TABLE provider_messages, blocked_messages"))
+        else:
+            # Delete all provider messages from groups
+            deleted_provider = db.query(ProviderMessage).delete(synchronize_session=False)
+            
+            # Delete all blocked messages from groups
+            deleted_blocked = db.query(BlockedMessage).delete(synchronize_session=False)
         
         db.commit()
         
@@ -2575,6 +3279,7 @@ async def admin_cleanup_all_group_messages_handler(callback: CallbackQuery):
         )
         
         # Refresh the stats
+        invalidate_message_stats_cache()
         await admin_messages_stats_handler(callback)
         
     except Exception as e:
@@ -2584,6 +3289,72 @@ async def admin_cleanup_all_group_messages_handler(callback: CallbackQuery):
     finally:
         db.close()
 
+# Telegram's deleteMessages accepts at most 100 ids per call
+DELETE_MESSAGES_BATCH_SIZE = 100
+DELETE_MESSAGES_CONCURRENCY = 5
+GROUP_MESSAGE_IDS_PAGE_SIZE = 500
+
+def iter_group_message_ids(db, group_chat_id: str) -> Iterator[int]:
+    """Yield the recorded message ids of a group one keyset page at a time, each page a complete query"""
+    last_id = None
+    while True:
+        query = db.query(ProviderMessage.telegram_message_id).filter(
+            ProviderMessage.group_chat_id == group_chat_id,
+            ProviderMessage.telegram_message_id.isnot(None)
+        )
+        if last_id is not None:
+            query = query.filter(ProviderMessage.telegram_message_id > last_id)
+        page = [
+            telegram_message_id for (telegram_message_id,) in query.distinct().order_by(
+                ProviderMessage.telegram_message_id
+            ).limit(GROUP_MESSAGE_IDS_PAGE_SIZE)
+        ]
+        if not page:
+            return
+        yield from page
+        last_id = page[-1]
+
+async def delete_messages_in_batches(group_chat_id: str, message_ids: Iterable[int]) -> List[int]:
+    """Delete message ids with concurrent deleteMessages calls and return the ids that were removed"""
+    async def delete_chunk(chunk: List[int]) -> List[int]:
+        try:
+            await bot.delete_messages(group_chat_id, chunk)
+            logger.info(f"Deleted batch of {len(chunk)} messages from group {group_chat_id}")
+            return chunk
+        except TelegramBadRequest as batch_err:
+            # Fallback to individual deletion for this batch
+            logger.info(f"Batch failed, trying individual deletion: {batch_err}")
+            deleted = []
+            for msg_id in chunk:
+                try:
+                    await bot.delete_message(group_chat_id, msg_id)
+                    deleted.append(msg_id)
+                except (TelegramBadRequest, TelegramForbiddenError):
+                    # Message doesn't exist, too old, or no permission
+                    pass
+                except TelegramRetryAfter as e:
+                    # Still flooded after the rate limiter's retries, so stop hammering this chat
+                    logger.warning(f"Stopping individual deletion in group {group_chat_id}, flood wait {e.retry_after}s")
+                    break
+            return deleted
+    
+    # Pull only a few batches at a time so the ids can be streamed from the database
+    message_ids = iter(message_ids)
+    deleted_ids = []
+    while True:
+        chunks = [list(islice(message_ids, DELETE_MESSAGES_BATCH_SIZE)) for _ in range(DELETE_MESSAGES_CONCURRENCY)]
+        chunks = [chunk for chunk in chunks if chunk]
+        if not chunks:
+            return deleted_ids
+        results = await asyncio.gather(*(delete_chunk(chunk) for chunk in chunks), return_exceptions=True)
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+            if isinstance(result, BaseException):
+                logger.error(f"❌ Failed to delete {len(chunk)} messages ({chunk[0]}..{chunk[-1]}) in group {group_chat_id}: {result!r}")
+                continue
+            deleted_ids.extend(result)
+
 @dp.callback_query(F.data == "admin_delete_all_telegram_messages")
 async def admin_delete_all_telegram_messages_handler(callback: CallbackQuery):
     """Delete all messages from groups where bot is admin"""
@@ -2613,74 +3384,22 @@ async def admin_delete_all_telegram_messages_handler(callback: CallbackQuery):
                     
                     # Delete ALL messages using Telegram Bot API
                     try:
-                        deleted_count = 0
-                        
                         # Send notification
                         notification_msg = await bot.send_message(group_chat_id, "🗑️ جاري حذف جميع الرسائل من الجروب...")
                         
-                        # Strategy 1: Delete stored message IDs from database
-                        provider_messages = db.query(ProviderMessage).filter(
-                            ProviderMessage.group_chat_id == group_chat_id
-                        ).all()
-                        
-                        # Try to delete stored messages first
-                        for msg in provider_messages:
-                            try:
-                                if msg.raw_payload:
-                                    payload = json.loads(msg.raw_payload)
-                                    message_id = payload.get('message_id')
-                                    if message_id:
-                                        await bot.delete_message(group_chat_id, message_id)
-                                        deleted_count += 1
-                            except:
-                                pass
-                        
-                        # Strategy 2: Comprehensive message deletion by range
-                        try:
-                            # Send a test message to get current message ID  
-                            test_msg = await bot.send_message(group_chat_id, "📍")
-                            current_msg_id = test_msg.message_id
-                            await bot.delete_message(group_chat_id, current_msg_id)
-                            
-                            # Collect message IDs to delete in batches
-                            message_ids_to_delete = []
-                            
-                            # Work backwards from current message ID
-                            # Try to delete up to 2000 recent messages (within 48h limit)
-                            for i in range(min(2000, current_msg_id)):
-                                msg_id_to_delete = current_msg_id - i - 1
-                                if msg_id_to_delete > 0:
-                                    message_ids_to_delete.append(msg_id_to_delete)
-                            
-                            # Use batch deletion for efficiency (100 messages at a time)
-                            for i in range(0, len(message_ids_to_delete), 100):
-                                chunk = message_ids_to_delete[i:i+100]
-                                try:
-                                    await bot.delete_messages(group_chat_id, chunk)
-                                    deleted_count += len(chunk)
-                                    logger.info(f"Deleted batch of {len(chunk)} messages from group {group_chat_id}")
-                                    # Small delay to avoid rate limiting
-                                    await asyncio.sleep(0.2)
-                                except Exception as batch_err:
-                                    # Fallback to individual deletion for this batch
-                                    logger.info(f"Batch failed, trying individual deletion: {batch_err}")
-                                    for msg_id in chunk:
-                                        try:
-                                            await bot.delete_message(group_chat_id, msg_id)
-                                            deleted_count += 1
-                                        except Exception:
-                                            # Message doesn't exist, too old, or no permission
-                                            pass
-                                        
-                        except Exception as range_error:
-                            logger.error(f"Range deletion failed for group {group_chat_id}: {range_error}")
+                        # Page through the group messages recorded in the database instead of loading them all;
+                        # no cursor stays open across the awaited deletions on the shared session
+                        deleted_ids = await delete_messages_in_batches(group_chat_id, iter_group_message_ids(db, group_chat_id))
+                        deleted_count = len(deleted_ids)
                         
                         # Clean up database records after successful deletion
                         try:
-                            # Remove the deleted messages from database
-                            db.query(ProviderMessage).filter(
-                                ProviderMessage.group_chat_id == group_chat_id
-                            ).delete()
+                            # Remove only the messages that were actually deleted from the group
+                            for start in range(0, len(deleted_ids), GROUP_MESSAGE_IDS_PAGE_SIZE):
+                                db.query(ProviderMessage).filter(
+                                    ProviderMessage.group_chat_id == group_chat_id,
+                                    ProviderMessage.telegram_message_id.in_(deleted_ids[start:start + GROUP_MESSAGE_IDS_PAGE_SIZE])
+                                ).delete(synchronize_session=False)
                             
                             # Also clean blocked messages for this group  
                             db.query(BlockedMessage).filter(
@@ -2696,7 +3415,7 @@ async def admin_delete_all_telegram_messages_handler(callback: CallbackQuery):
                         # Delete our notification message
                         try:
                             await bot.delete_message(group_chat_id, notification_msg.message_id)
-                        except:
+                        except (TelegramBadRequest, TelegramForbiddenError):
                             pass
                         
                         # Send final notification
@@ -2705,7 +3424,7 @@ async def admin_delete_all_telegram_messages_handler(callback: CallbackQuery):
                             await asyncio.sleep(3)  # Wait so admin can see the result
                             try:
                                 await bot.delete_message(group_chat_id, final_msg.message_id)
-                            except:
+                            except (TelegramBadRequest, TelegramForbiddenError):
                                 pass
                         
                         total_deleted += deleted_count
@@ -2730,18 +3449,14 @@ async def admin_delete_all_telegram_messages_handler(callback: CallbackQuery):
                 f"🎯 جروبات ناجحة: {successful_groups}\n"
                 f"❌ جروبات فاشلة: {failed_groups}\n\n"
                 f"ملاحظة: تم تنظيف الرسائل في الجروبات التي يملك البوت فيها صلاحيات الإدارة.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                    InlineKeyboardButton(text="🔙 إحصائيات الرسائل", callback_data="admin_messages_stats")
-                ]])
+                reply_markup=BACK_TO_MESSAGE_STATS_KEYBOARD
             )
         else:
             await callback.message.edit_text(
                 f"⚠️ لم يتم حذف أي رسائل\n\n"
                 f"❌ جروبات فاشلة: {failed_groups}\n\n"
                 f"السبب: البوت غير مشرف في الجروبات أو لا توجد جروبات مفعلة.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                    InlineKeyboardButton(text="🔙 إحصائيات الرسائل", callback_data="admin_messages_stats")
-                ]])
+                reply_markup=BACK_TO_MESSAGE_STATS_KEYBOARD
             )
     
     except Exception as e:
@@ -2820,12 +3535,7 @@ async def admin_manual_cleanup_now_handler(callback: CallbackQuery):
     await callback.answer("🔄 جاري تنظيف الرسائل...")
     
     # Run cleanup in background
-    def run_cleanup():
-        cleanup_dead_messages()
-        cleanup_expired_reservations()
-    
-    cleanup_thread = threading.Thread(target=run_cleanup)
-    cleanup_thread.start()
+    spawn_background(run_cleanup_tasks())
     
     await callback.answer("✅ تم بدء التنظيف اليدوي!", show_alert=True)
     await admin_auto_cleanup_handler(callback)
@@ -2860,12 +3570,12 @@ async def admin_cleanup_blocked_messages_handler(callback: CallbackQuery):
         # Delete all blocked messages (no number/code recognized)
         deleted_blocked = db.query(BlockedMessage).filter(
             BlockedMessage.reason == "no_number_or_no_code"
-        ).delete()
+        ).delete(synchronize_session=False)
         
         # Also delete rejected provider messages
         deleted_rejected = db.query(ProviderMessage).filter(
             ProviderMessage.status == MessageStatus.REJECTED
-        ).delete()
+        ).delete(synchronize_session=False)
         
         db.commit()
         logger.info(f"Cleaned up blocked messages: {deleted_blocked} blocked, {deleted_rejected} rejected")
@@ -2878,6 +3588,7 @@ async def admin_cleanup_blocked_messages_handler(callback: CallbackQuery):
         )
         
         # Refresh stats
+        invalidate_message_stats_cache()
         await admin_messages_stats_handler(callback)
         
     except Exception as e:
@@ -2906,43 +3617,41 @@ async def admin_process_orphan_messages_handler(callback: CallbackQuery):
             ProviderMessage.received_at >= datetime.now() - timedelta(hours=2)
         ).order_by(ProviderMessage.received_at.desc()).limit(100).all()
         
+        # Extract codes and candidate last digits first so reservations can be fetched in one query
+        candidates = []
         for msg in orphan_messages:
             processed_count += 1
             
-            # Extract codes from message
-            service_provider_map = db.query(ServiceProviderMap).filter(
-                ServiceProviderMap.service_id == msg.service_id
-            ).first()
-            regex_pattern = str(service_provider_map.regex_pattern) if service_provider_map else r'\b\d{5,6}\b'
-            codes = re.findall(regex_pattern, msg.message_text)
-            
+            codes = get_service_regex(msg.service_id).findall(msg.message_text)
             if codes:
-                # Extract potential last digits from message
-                digit_patterns = re.findall(r'\d{3,}', msg.message_text)
-                for digit_group in digit_patterns:
-                    if len(digit_group) >= 3:
-                        last_digits = digit_group[-3:]
-                        # Use a separate session for reservation lookup
-                        reservation_db = get_db()
-                        try:
-                            reservation = reservation_db.query(Reservation).filter(
-                                Reservation.status == ReservationStatus.WAITING_CODE,
-                                Reservation.service_id == msg.service_id
-                            ).join(Number).filter(
-                                Number.phone_number.endswith(last_digits)
-                            ).first()
-                            
-                            if reservation:
-                                # Complete the reservation with separate session
-                                success = await complete_reservation_atomic(reservation.id, codes[0])
-                                if success:
-                                    matched_count += 1
-                                    # Update message status
-                                    msg.status = MessageStatus.PROCESSED
-                                    logger.info(f"Matched orphan message with reservation using last digits {last_digits}")
-                                    break
-                        finally:
-                            reservation_db.close()
+                last_digits_options = [
+                    digit_group[-3:] for digit_group in DIGIT_GROUP_REGEX.findall(msg.message_text)
+                ]
+                candidates.append((msg, codes[0], last_digits_options))
+        
+        # Index waiting reservations by (service, last 3 digits of their number)
+        waiting_by_last_digits = {}
+        if candidates:
+            waiting_reservations = db.query(Reservation, Number.phone_number).join(Number).filter(
+                Reservation.status == ReservationStatus.WAITING_CODE,
+                Reservation.service_id.in_({msg.service_id for msg, _, _ in candidates})
+            ).order_by(Reservation.id).all()
+            for reservation, phone_number in waiting_reservations:
+                waiting_by_last_digits.setdefault((reservation.service_id, phone_number[-3:]), reservation)
+        
+        for msg, code, last_digits_options in candidates:
+            for last_digits in last_digits_options:
+                # Each reservation can only be completed once
+                reservation = waiting_by_last_digits.pop((msg.service_id, last_digits), None)
+                if reservation:
+                    # Complete the reservation
+                    success = await complete_reservation_atomic(reservation.id, code)
+                    if success:
+                        matched_count += 1
+                        # Update message status
+                        msg.status = MessageStatus.PROCESSED
+                        logger.info(f"Matched orphan message with reservation using last digits {last_digits}")
+                        break
         
         db.commit()
         
@@ -2954,6 +3663,7 @@ async def admin_process_orphan_messages_handler(callback: CallbackQuery):
         )
         
         # Refresh stats
+        invalidate_message_stats_cache()
         await admin_messages_stats_handler(callback)
         
     except Exception as e:
@@ -2964,28 +3674,231 @@ async def admin_process_orphan_messages_handler(callback: CallbackQuery):
         db.close()
 
 # Group message processing functions
+# Rejected group messages waiting to be written to blocked_messages in batches; the oldest are dropped when full
+BLOCKED_BUFFER_MAX_SIZE = 20000
+_blocked_buffer: deque = deque(maxlen=BLOCKED_BUFFER_MAX_SIZE)
+BLOCKED_FLUSH_INTERVAL = 2  # seconds
+BLOCKED_FLUSH_BATCH_SIZE = 500
+# Consecutive failed flushes after which a batch is written row by row instead of retried
+BLOCKED_FLUSH_MAX_FAILURES = 3
+_blocked_flush_failures = 0
+# Rejected messages dropped because the buffer was full since the last flush
+_blocked_dropped = 0
+# Only one flush runs at a time on the DB pool (periodic writer or shutdown)
+_blocked_flush_lock = threading.Lock()
+blocked_writer_task: Optional[asyncio.Task] = None
+
+def buffer_blocked_message(service_id: int, group_chat_id: str, sender_id: str, message_text: str, reason: str):
+    """Queue a rejected group message for the next batched insert"""
+    global _blocked_dropped
+    if len(_blocked_buffer) == BLOCKED_BUFFER_MAX_SIZE:
+        if not _blocked_dropped:
+            logger.warning(f"⚠️ Blocked messages buffer full ({BLOCKED_BUFFER_MAX_SIZE}), dropping the oldest messages")
+        _blocked_dropped += 1
+    _blocked_buffer.append({
+        'service_id': service_id,
+        'group_chat_id': group_chat_id,
+        'sender_id': sender_id,
+        'message_text': message_text,
+        'reason': reason,
+        'created_at': datetime.now()
+    })
+
+def insert_blocked_rows(db, batch: List[dict]) -> int:
+    """Insert rejected messages one at a time, dropping the ones that fail; returns how many were written"""
+    written = 0
+    for row in batch:
+        try:
+            db.bulk_insert_mappings(BlockedMessage, [row])
+            db.commit()
+            written += 1
+        except SQLAlchemyError as e:
+            db.rollback()
+            logger.error(f"❌ Dropping blocked message from group {row['group_chat_id']}: {e}")
+    return written
+
+def flush_blocked_messages() -> int:
+    """Insert buffered rejected messages in batches, returns how many were written"""
+    global _blocked_flush_failures, _blocked_dropped
+    with _blocked_flush_lock:
+        if _blocked_dropped:
+            logger.warning(f"⚠️ Dropped {_blocked_dropped} blocked messages while the buffer was full")
+            _blocked_dropped = 0
+        return _flush_blocked_batches()
+
+def _flush_blocked_batches() -> int:
+    """Write the buffer in batches; callers hold _blocked_flush_lock"""
+    global _blocked_flush_failures
+    written = 0
+    db = get_db()
+    try:
+        while True:
+            batch = []
+            while len(batch) < BLOCKED_FLUSH_BATCH_SIZE:
+                try:
+                    batch.append(_blocked_buffer.popleft())
+                except IndexError:
+                    break
+            if not batch:
+                break
+            try:
+                db.bulk_insert_mappings(BlockedMessage, batch)
+                db.commit()
+                _blocked_flush_failures = 0
+            except SQLAlchemyError:
+                db.rollback()
+                _blocked_flush_failures += 1
+                if _blocked_flush_failures < BLOCKED_FLUSH_MAX_FAILURES:
+                    # Put the batch back for the next flush
+                    _blocked_buffer.extendleft(reversed(batch))
+                    raise
+                # The batch keeps failing, write what can be written and drop the rest
+                logger.warning(f"⚠️ Blocked messages batch failed {_blocked_flush_failures} times, inserting row by row")
+                _blocked_flush_failures = 0
+                written += insert_blocked_rows(db, batch)
+                continue
+            written += len(batch)
+        return written
+    finally:
+        db.close()
+
+async def blocked_message_writer():
+    """Background task that flushes buffered rejected messages periodically"""
+    while True:
+        await asyncio.sleep(BLOCKED_FLUSH_INTERVAL)
+        if not _blocked_buffer:
+            continue
+        try:
+            await run_db(flush_blocked_messages)
+        except Exception as e:
+            logger.error(f"❌ Error writing blocked messages: {e}")
+
+async def flush_blocked_messages_on_shutdown():
+    """Stop the periodic writer and write the rejected messages still buffered when the bot stops"""
+    if blocked_writer_task is not None:
+        blocked_writer_task.cancel()
+        await asyncio.gather(blocked_writer_task, return_exceptions=True)
+    if not _blocked_buffer:
+        return
+    try:
+        written = await run_db(flush_blocked_messages)
+        logger.info(f"🧹 Flushed {written} blocked messages on shutdown")
+    except Exception as e:
+        logger.error(f"❌ Error writing blocked messages on shutdown: {e}")
+
 async def process_incoming_group_message(message: types.Message):
     """Process incoming message from a registered group"""
     if not message.chat or not message.from_user or not message.text:
         return
     
-    group_chat_id = str(message.chat.id)
-    sender_id = str(message.from_user.id)
-    message_text = message.text
-    
+    chat = message.chat
+    from_user = message.from_user
+    message_id = message.message_id
+    raw_payload = json.dumps({
+        'message_id': message_id,
+        'chat_title': chat.title,
+        'sender_username': from_user.username,
+        'date': message.date.isoformat() if message.date else None
+    })
+    
+    # Database work runs on the worker threads, each with its own session
+    outcome = await run_db(
+        _process_group_message_sync,
+        str(chat.id), str(from_user.id), message.text, message_id, raw_payload
+    )
+    if outcome:
+        # Telegram round-trips don't hold up the worker
+        spawn_background(notify_group_code_outcome(outcome))
+
+@dataclass
+class GroupCodeOutcome:
+    """Committed result of matching a group message to a reservation, to be reported to the user"""
+    completed: bool
+    user: User
+    reservation: Reservation
+    service: ServiceDetails
+    phone_number: str
+    code: str
+    price: float
+
+# Translated "code received" notification per language, with placeholders for the reservation values
+_CODE_RECEIVED_TEMPLATES: Dict[str, str] = {}
+CODE_RECEIVED_LABELS = ('code_received', 'service', 'number', 'code', 'cost', 'balance', 'currency')
+
+async def get_code_received_template(lang_code: str) -> str:
+    """Build the code received notification template of a language once"""
+    template = _CODE_RECEIVED_TEMPLATES.get(lang_code)
+    if template is None:
+        texts = await asyncio.gather(*(get_text(label, lang_code) for label in CODE_RECEIVED_LABELS))
+        # Escape braces so translations can't be taken for placeholders
+        labels = dict(zip(CODE_RECEIVED_LABELS, (text.replace('{', '{{').replace('}', '}}') for text in texts)))
+        template = (
+            f"🎉 {labels['code_received']}\n\n"
+            f"📱 {labels['service']}: {{service_emoji}} {{service_name}}\n"
+            f"📞 {labels['number']}: {{phone_number}}\n"
+            f"🔐 {labels['code']}: {{code}}\n"
+            f"💰 {labels['cost']}: {{price}} {labels['currency']}\n"
+            f"💵 {labels['balance']}: {{balance:.2f}} {labels['currency']}"
+        )
+        _CODE_RECEIVED_TEMPLATES[lang_code] = template
+    return template
+
+async def notify_group_code_outcome(outcome: GroupCodeOutcome):
+    """Send the code or the insufficient balance notice to the reservation owner"""
+    user = outcome.user
+    try:
+        if not outcome.completed:
+            await bot.send_message(
+                str(user.telegram_id),
+                f"❌ رصيدك غير كافي!\nالسعر المطلوب: {outcome.price}\nرصيدك الحالي: {user.balance}"
+            )
+            return
+        
+        # Send user data to channel if configured, alongside the user notification
+        spawn_background(send_user_data_to_channel(user, outcome.reservation))
+        
+        # Send notification to user
+        template = await get_code_received_template(user.language_code or 'ar')
+        await bot.send_message(
+            str(user.telegram_id),
+            template.format(
+                service_emoji=outcome.service.emoji,
+                service_name=outcome.service.name,
+                phone_number=outcome.phone_number,
+                code=outcome.code,
+                price=outcome.price,
+                balance=float(user.balance or 0)
+            )
+        )
+    except Exception as e:
+        logger.error(f"Error notifying user {user.telegram_id} about group code: {e}")
+
+USER_LOCK_SKIP_ATTEMPTS = 3
+USER_LOCK_RETRY_DELAY = 0.05  # seconds
+
+def lock_user_for_completion(db, user_id: int) -> Optional[User]:
+    """Lock a user row, retrying briefly while another completion holds it before waiting for the lock"""
+    for _ in range(USER_LOCK_SKIP_ATTEMPTS):
+        user = db.query(User).filter(User.id == user_id).with_for_update(skip_locked=True).first()
+        if user:
+            return user
+        time.sleep(USER_LOCK_RETRY_DELAY)
+    # Still locked (or missing): wait for the lock like a plain FOR UPDATE
+    return db.query(User).filter(User.id == user_id).with_for_update().first()
+
+def _process_group_message_sync(group_chat_id: str, sender_id: str, message_text: str,
+                                 message_id: int, raw_payload: str) -> Optional[GroupCodeOutcome]:
+    """Store a group message and complete the matching reservation; returns what to tell the user"""
     db = get_db()
     try:
         # Find service group mapping
-        service_group = db.query(ServiceGroup).filter(
-            ServiceGroup.group_chat_id == group_chat_id,
-            ServiceGroup.active == True
-        ).first()
+        service_group = get_service_group_for_chat(db, group_chat_id)
         
         if not service_group:
             logger.info(f"Message from unregistered group: {group_chat_id}")
-            return  # Not a registered group
+            return None  # Not a registered group
             
-        logger.info(f"Processing message from group: {group_chat_id}, service_id: {service_group.service_id}, service: {service_group.service.name if service_group.service else 'Unknown'}")
+        logger.info(f"Processing message from group: {group_chat_id}, service_id: {service_group.service_id}, service: {service_group.service_name or 'Unknown'}")
         
         # Store incoming message for audit
         provider_msg = ProviderMessage(
@@ -2993,41 +3906,43 @@ async def process_incoming_group_message(message: types.Message):
             group_chat_id=group_chat_id,
             sender_id=sender_id,
             message_text=message_text,
-            raw_payload=json.dumps({
-                'message_id': message.message_id,
-                'chat_title': message.chat.title,
-                'sender_username': message.from_user.username,
-                'date': message.date.isoformat() if message.date else None
-            }),
+            telegram_message_id=message_id,
+            raw_payload=raw_payload,
             status=MessageStatus.PENDING
         )
+        # Persisted together with its final status in one commit
         db.add(provider_msg)
-        db.commit()
         
         # No security checks - process all messages directly
         
+        # Without any digit there can be neither a number nor a code
+        if not any(char.isdigit() for char in message_text):
+            buffer_blocked_message(service_group.service_id, group_chat_id, sender_id, message_text, "no_number_or_no_code")
+            provider_msg.status = MessageStatus.REJECTED
+            db.commit()
+            return None
+        
         # Extract number and code with improved pattern
-        regex_pattern = str(service_group.regex_pattern) if service_group.regex_pattern else r'\b\d{4,6}\b'
-        number, code = extract_number_and_code(message_text, regex_pattern)
+        code_regex = get_group_code_regex(str(service_group.regex_pattern)) if service_group.regex_pattern else CODE_4_6_REGEX
+        number, code = extract_number_and_code(message_text, code_regex)
         
-        # If failed with service pattern, try common patterns
-        if not number or not code:
+        # If failed with service pattern, try common patterns (same result when the service has none)
+        if (not number or not code) and code_regex is not CODE_4_6_REGEX:
             # Try common format: "to:+1234567890 code:123456"
-            number, code = extract_number_and_code(message_text, r'\b\d{4,6}\b')
+            number, code = extract_number_and_code(message_text, CODE_4_6_REGEX)
             
         # Enhanced code extraction - try multiple patterns
+        digit_runs = None
         if not code:
+            code_4_6, code_3, digit_runs = scan_digit_runs(message_text)
             # Extract any 4-6 digit number as potential code
-            code_matches = re.findall(r'\b\d{4,6}\b', message_text)
-            if code_matches:
-                code = code_matches[-1]  # Take last match (more likely to be verification code)
+            if code_4_6:
+                code = code_4_6  # Take last match (more likely to be verification code)
                 logger.info(f"Extracted fallback code: {code} from message: {message_text}")
-            else:
+            elif code_3:
                 # Try 3-digit codes as fallback
-                three_digit_matches = re.findall(r'\b\d{3}\b', message_text)
-                if three_digit_matches:
-                    code = three_digit_matches[-1]
-                    logger.info(f"Extracted 3-digit fallback code: {code} from message: {message_text}")
+                code = code_3
+                logger.info(f"Extracted 3-digit fallback code: {code} from message: {message_text}")
                 
         logger.info(f"Final extraction result - Number: {number}, Code: {code}")
         
@@ -3035,60 +3950,41 @@ async def process_incoming_group_message(message: types.Message):
             # If no direct extraction, try to find by last digits in message
             if code:  # If we have a code but no number, try to find by last digits
                 # Extract all possible last digits from message
-                digit_patterns = re.findall(r'\d{3,}', message_text)
-                for digit_group in digit_patterns:
-                    if len(digit_group) >= 3:
-                        last_digits = digit_group[-3:]  # Get last 3 digits
-                        reservation = await find_reservation_by_last_digits(last_digits, service_group.service_id)
-                        if reservation:
-                            number_obj = db.query(Number).filter(Number.id == reservation.number_id).first()
-                            if number_obj:
-                                number = number_obj.phone_number
-                                logger.info(f"Found reservation by last digits {last_digits} in message without full number")
-                                break
+                if digit_runs is None:
+                    digit_runs = scan_digit_runs(message_text)[2]
+                match = find_reservation_by_digit_runs(db, digit_runs, service_group.service_id)
+                if match:
+                    number = match[1].phone_number
+                    logger.info(f"Found reservation by last digits {extract_last_digits(str(number))} in message without full number")
             
             if not number or not code:
                 # Store as blocked - no valid number or code found
-                blocked_msg = BlockedMessage(
-                    service_id=service_group.service_id,
-                    group_chat_id=group_chat_id,
-                    sender_id=sender_id,
-                    message_text=message_text,
-                    reason="no_number_or_no_code"
-                )
-                db.add(blocked_msg)
+                buffer_blocked_message(service_group.service_id, group_chat_id, sender_id, message_text, "no_number_or_no_code")
                 
                 provider_msg.status = MessageStatus.REJECTED
                 db.commit()
-                return
+                return None
         
         # Find matching reservation with detailed logging
         logger.info(f"Searching for reservation: number={number}, service_id={service_group.service_id}")
         
         # Try to find the number in ANY active service for this group
-        all_service_groups = db.query(ServiceGroup).filter(
-            ServiceGroup.group_chat_id == group_chat_id,
-            ServiceGroup.active == True
-        ).all()
-        
+        group_service_ids = get_group_service_ids(db, group_chat_id)
+        
+        # Only the id and service are needed here; the full Number is loaded with its reservation
+        number_row = db.query(Number.id, Number.service_id).filter(
+            Number.phone_number == number,
+            Number.service_id.in_(group_service_ids)
+        ).first() if group_service_ids else None
+        number_id, matching_service_id = number_row if number_row else (None, None)
         number_obj = None
-        matching_service_id = None
-        
-        for sg in all_service_groups:
-            temp_number_obj = db.query(Number).filter(
-                Number.phone_number == number,
-                Number.service_id == sg.service_id
-            ).first()
-            if temp_number_obj:
-                number_obj = temp_number_obj
-                matching_service_id = sg.service_id
-                logger.info(f"Found number {number} in service_id {sg.service_id}")
-                break
+        if number_row:
+            logger.info(f"Found number {number} in service_id {matching_service_id}")
         
         # Track if we found the reservation via masked number search
         reservation_from_masked_search = None
         
-        if not number_obj:
+        if not number_row:
             # Try to extract last 2-3 digits from masked number format
             extracted_last_digits = extract_last_three_digits_from_masked_number(message_text)
             
@@ -3096,29 +3992,26 @@ async def process_incoming_group_message(message: types.Message):
                 logger.info(f"Extracted last digits '{extracted_last_digits}' from masked message, searching for matching reservations")
                 
                 # Search for reservations with matching last digits across all services in this group
-                for sg in all_service_groups:
-                    reservation = await find_reservation_by_last_digits(extracted_last_digits, sg.service_id)
-                    if reservation:
-                        reservation_from_masked_search = reservation
-                        matching_service_id = sg.service_id
-                        number_obj = db.query(Number).filter(Number.id == reservation.number_id).first()
-                        if number_obj:
-                            number = str(number_obj.phone_number)
-                            logger.info(f"Found matching reservation by last {len(extracted_last_digits)} digits: reservation_id={reservation.id}, number={number}")
-                            break
+                match = find_reservations_by_last_digits(db, extracted_last_digits, group_service_ids)
+                if match:
+                    reservation_from_masked_search, number_obj = match
+                    number_id = number_obj.id
+                    matching_service_id = reservation_from_masked_search.service_id
+                    number = str(number_obj.phone_number)
+                    logger.info(f"Found matching reservation by last {len(extracted_last_digits)} digits: reservation_id={reservation_from_masked_search.id}, number={number}")
                 
                 if not reservation_from_masked_search:
                     logger.warning(f"No reservation found for last digits '{extracted_last_digits}' in group {group_chat_id}")
                     provider_msg.status = MessageStatus.ORPHAN
                     db.commit()
-                    return
+                    return None
             else:
                 logger.warning(f"Number {number} not found and could not extract last digits from message: {message_text}")
                 provider_msg.status = MessageStatus.ORPHAN
                 db.commit()
-                return
+                return None
         
-        logger.info(f"Found number: id={number_obj.id}, status={number_obj.status}, reserved_by={number_obj.reserved_by_user_id}")
+        logger.info(f"Found number: id={number_id}, service_id={matching_service_id}")
         
         # Check for reservation - use reservation_from_masked_search if it exists
         reservation = None
@@ -3127,47 +4020,53 @@ async def process_incoming_group_message(message: types.Message):
             logger.info(f"Using reservation found by last digits: id={reservation.id}")
         else:
             # Try to find reservation by exact number match
-            reservation = db.query(Reservation).filter(
-                Reservation.number_id == number_obj.id,
+            reservation = db.query(Reservation).options(
+                joinedload(Reservation.number)
+            ).filter(
+                Reservation.number_id == number_id,
                 Reservation.status == ReservationStatus.WAITING_CODE
             ).first()
             
-            if not reservation:
+            if reservation:
+                number_obj = reservation.number
+            else:
                 # Try to find reservation by last 3 digits as fallback
                 last_digits = extract_last_digits(number)
                 logger.info(f"No exact match found for {number}, trying last digits: {last_digits}")
                 
-                reservation = await find_reservation_by_last_digits(last_digits, matching_service_id)
+                match = find_reservations_by_last_digits(db, last_digits, [matching_service_id])
                 
-                if reservation:
-                    logger.info(f"Found reservation by last digits {last_digits}: reservation_id={reservation.id}")
+                if match:
                     # Update the number object to the one found by last digits
-                    number_obj = db.query(Number).filter(Number.id == reservation.number_id).first()
-                    number = str(number_obj.phone_number) if number_obj else number
+                    reservation, number_obj = match
+                    logger.info(f"Found reservation by last digits {last_digits}: reservation_id={reservation.id}")
+                    number = str(number_obj.phone_number)
                 else:
                     # Log more details about why no reservation found
-                    all_reservations = db.query(Reservation).filter(
+                    all_reservations = db.query(Reservation).options(
+                        joinedload(Reservation.number)
+                    ).filter(
                         Reservation.service_id == matching_service_id,
                         Reservation.status == ReservationStatus.WAITING_CODE
                     ).all()
                     logger.warning(f"No reservation found for number {number} or last digits {last_digits}")
                     for res in all_reservations:
-                        res_number = db.query(Number).filter(Number.id == res.number_id).first()
-                        res_last_digits = extract_last_digits(str(res_number.phone_number)) if res_number else "N/A"
+                        res_last_digits = extract_last_digits(str(res.number.phone_number)) if res.number else "N/A"
                         logger.info(f"Active reservation: id={res.id}, last_digits={res_last_digits}, user_id={res.user_id}")
                     
                     # Mark as orphan - no matching reservation
                     provider_msg.status = MessageStatus.ORPHAN
                     db.commit()
-                    return
+                    return None
             
         logger.info(f"Found matching reservation: id={reservation.id}, user_id={reservation.user_id}, status={reservation.status}")
         
         # Complete reservation in same session
+        outcome = None
         try:
-            # Lock reservation and user for update
-            user = db.query(User).filter(User.id == reservation.user_id).with_for_update().first()
-            service = db.query(Service).filter(Service.id == reservation.service_id).first()
+            # Lock the user for update; notifications are sent only after the commit, so the lock is short
+            user = lock_user_for_completion(db, reservation.user_id)
+            service = get_service_details(db, reservation.service_id)
             
             if user and service:
                 # Calculate price and check balance
@@ -3175,12 +4074,13 @@ async def process_incoming_group_message(message: types.Message):
                 
                 if float(user.balance or 0) >= float(price):
                     # Complete the transaction
+                    now = datetime.now()
                     user.balance = float(user.balance or 0) - price
                     reservation.status = ReservationStatus.COMPLETED
                     reservation.code_value = code
-                    reservation.completed_at = datetime.now()
+                    reservation.completed_at = now
                     number_obj.status = 'USED'
-                    number_obj.code_received_at = datetime.now()
+                    number_obj.code_received_at = now
                     
                     # Create transaction record
                     transaction = Transaction(
@@ -3192,58 +4092,31 @@ async def process_incoming_group_message(message: types.Message):
                     db.add(transaction)
                     
                     provider_msg.status = MessageStatus.PROCESSED
-                    provider_msg.processed_at = datetime.now()
-                    
-                    # Send notification to user
-                    lang_code = user.language_code or 'ar'
-                    success_msg = await get_text("code_received", lang_code)
-                    await bot.send_message(
-                        str(user.telegram_id),
-                        f"🎉 {success_msg}\n\n"
-                        f"📱 {await get_text('service', lang_code)}: {service.emoji} {service.name}\n"
-                        f"📞 {await get_text('number', lang_code)}: {number_obj.phone_number}\n"
-                        f"🔐 {await get_text('code', lang_code)}: {code}\n"
-                        f"💰 {await get_text('cost', lang_code)}: {price} {await get_text('currency', lang_code)}\n"
-                        f"💵 {await get_text('balance', lang_code)}: {user.balance:.2f} {await get_text('currency', lang_code)}"
-                    )
-                    
-                    # Send user data to channel if configured
-                    await send_user_data_to_channel(user, reservation)
+                    provider_msg.processed_at = now
+                    bump_system_counters(db, successful=1)
                     
+                    outcome = GroupCodeOutcome(True, user, reservation, service, str(number_obj.phone_number), code, price)
                     logger.info(f"Reservation {reservation.id} completed successfully")
                 else:
                     # Insufficient balance
                     reservation.status = ReservationStatus.EXPIRED
                     provider_msg.status = MessageStatus.REJECTED
-                    
-                    await bot.send_message(
-                        str(user.telegram_id),
-                        f"❌ رصيدك غير كافي!\nالسعر المطلوب: {price}\nرصيدك الحالي: {user.balance}"
-                    )
+                    bump_system_counters(db, failed=1)
+                    outcome = GroupCodeOutcome(False, user, reservation, service, str(number_obj.phone_number), code, price)
             else:
                 provider_msg.status = MessageStatus.REJECTED
-                blocked_msg = BlockedMessage(
-                    service_id=service_group.service_id,
-                    group_chat_id=group_chat_id,
-                    sender_id=sender_id,
-                    message_text=message_text,
-                    reason="user_or_service_not_found"
-                )
-                db.add(blocked_msg)
+                buffer_blocked_message(service_group.service_id, group_chat_id, sender_id, message_text, "user_or_service_not_found")
                 
         except Exception as completion_error:
             logger.error(f"Error completing reservation: {completion_error}")
             provider_msg.status = MessageStatus.REJECTED
-            blocked_msg = BlockedMessage(
-                service_id=service_group.service_id,
-                group_chat_id=group_chat_id,
-                sender_id=sender_id,
-                message_text=message_text,
-                reason="completion_failed"
-            )
-            db.add(blocked_msg)
+            buffer_blocked_message(service_group.service_id, group_chat_id, sender_id, message_text, "completion_failed")
+            outcome = None
         
         db.commit()
+        if outcome:
+            invalidate_system_stats()
+        return outcome
         
     except Exception as e:
         logger.error(f"Error processing group message: {e}")
@@ -3251,6 +4124,7 @@ async def process_incoming_group_message(message: types.Message):
             db.rollback()
         except:
             pass
+        return None
     finally:
         try:
             db.close()
@@ -3259,10 +4133,41 @@ async def process_incoming_group_message(message: types.Message):
 
 
 # Message handlers for group messages
-@dp.message(F.chat.type.in_(['group', 'supergroup']))
+GROUP_CHAT_TYPES = frozenset({'group', 'supergroup'})
+
+@dp.message(F.chat.type.in_(GROUP_CHAT_TYPES))
 async def group_message_handler(message: types.Message):
     """Handle messages from groups"""
-    await process_incoming_group_message(message)
+    try:
+        group_message_queue.put_nowait(message)
+    except asyncio.QueueFull:
+        logger.warning(f"⚠️ Group message queue full ({GROUP_MESSAGE_QUEUE_SIZE}), waiting for a free slot")
+        await group_message_queue.put(message)
+
+async def group_message_worker():
+    """Process queued group messages one at a time"""
+    while True:
+        message = await group_message_queue.get()
+        try:
+            await process_incoming_group_message(message)
+        except Exception as e:
+            logger.error(f"❌ Error in group message worker: {e}")
+        finally:
+            group_message_queue.task_done()
+
+def start_group_message_workers():
+    """Start the pool of group message workers"""
+    group_message_tasks[:] = [task for task in group_message_tasks if not task.done()]
+    for _ in range(GROUP_MESSAGE_WORKERS - len(group_message_tasks)):
+        group_message_tasks.append(asyncio.create_task(group_message_worker()))
+    logger.info(f"📥 Started {GROUP_MESSAGE_WORKERS} group message workers")
+
+async def drain_group_message_queue():
+    """Let the workers finish the queued group messages when the bot stops"""
+    try:
+        await asyncio.wait_for(group_message_queue.join(), timeout=GROUP_MESSAGE_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"⚠️ {group_message_queue.qsize()} group messages left unprocessed at shutdown")
 
 # Bot handlers
 @dp.message(Command("start"))
@@ -3397,6 +4302,14 @@ async def services_handler(message: types.Message):
     
     await message.reply(services_text, reply_markup=await create_main_keyboard(str(message.from_user.id)))
 
+# Status icons shown next to each reservation in the history lists
+RESERVATION_STATUS_EMOJI: Dict[ReservationStatus, str] = {
+    ReservationStatus.WAITING_CODE: "⏳",
+    ReservationStatus.COMPLETED: "✅",
+    ReservationStatus.EXPIRED: "⏰",
+    ReservationStatus.CANCELED: "❌"
+}
+
 @dp.message(Command("history"))
 async def history_handler(message: types.Message):
     """Handle /history command"""
@@ -3405,7 +4318,10 @@ async def history_handler(message: types.Message):
     
     db = get_db()
     try:
-        reservations = db.query(Reservation).filter(
+        reservations = db.query(Reservation).options(
+            joinedload(Reservation.service),
+            joinedload(Reservation.number)
+        ).filter(
             Reservation.user_id == str(message.from_user.id)
         ).order_by(Reservation.created_at.desc()).limit(10).all()
         
@@ -3416,18 +4332,19 @@ async def history_handler(message: types.Message):
             return
         
         lang_code = get_user_language(str(message.from_user.id))
-        history_header = await translator.translate_text("📋 آخر 10 طلبات:", lang_code)
+        # Translate the header and each distinct service name concurrently
+        service_names = list({str(res.service.name) for res in reservations})
+        history_header, *translated_names = await asyncio.gather(
+            translator.translate_text("📋 آخر 10 طلبات:", lang_code),
+            *(get_text(name, lang_code) for name in service_names)
+        )
+        translated_services = dict(zip(service_names, translated_names))
         history_text = f"{history_header}\n\n"
         
         for res in reservations:
-            status_emoji = {
-                ReservationStatus.WAITING_CODE: "⏳",
-                ReservationStatus.COMPLETED: "✅", 
-                ReservationStatus.EXPIRED: "⏰",
-                ReservationStatus.CANCELED: "❌"
-            }.get(res.status, "❓")
-            
-            service_name = await get_text(res.service.name, lang_code)
+            status_emoji = RESERVATION_STATUS_EMOJI.get(res.status, "❓")
+            
+            service_name = translated_services[str(res.service.name)]
             history_text += f"{status_emoji} {service_name} - {res.number.phone_number}\n"
             history_text += f"   📅 {res.created_at.strftime('%Y-%m-%d %H:%M')}\n\n"
         
@@ -3562,7 +4479,7 @@ async def service_selected_handler(callback: CallbackQuery, state: FSMContext):
     
     db = get_db()
     try:
-        service = db.query(Service).filter(Service.id == service_id).first()
+        service = db.get(Service, service_id)
         if not service:
             await callback.answer("❌ خدمة غير موجودة")
             return
@@ -3630,8 +4547,8 @@ async def country_selected_handler(callback: CallbackQuery, state: FSMContext):
     
     db = get_db()
     try:
-        number = db.query(Number).filter(Number.id == reservation.number_id).first()
-        service = db.query(Service).filter(Service.id == service_id).first()
+        number = db.get(Number, reservation.number_id)
+        service = db.get(Service, service_id)
         
         await state.update_data(reservation_id=reservation.id)
         
@@ -3667,69 +4584,90 @@ async def country_selected_handler(callback: CallbackQuery, state: FSMContext):
         
     finally:
         db.close()
-
-@dp.callback_query(F.data.startswith("change_number_"))
-async def change_number_handler(callback: CallbackQuery, state: FSMContext):
-    """Handle number change request"""
-    reservation_id = int(callback.data.split("_")[2])
-    
-    db = get_db()
-    try:
-        reservation = db.query(Reservation).filter(Reservation.id == reservation_id).first()
-        if not reservation or reservation.status != ReservationStatus.WAITING_CODE:
-            await callback.answer("❌ حجز غير صالح")
-            return
-        
-        # Release current number
-        current_number = db.query(Number).filter(Number.id == reservation.number_id).first()
-        if current_number:
-            # Check if this number has received a code (has completed reservations)
-            has_received_code = db.query(Reservation).filter(
-                Reservation.number_id == current_number.id,
-                Reservation.status == ReservationStatus.COMPLETED
-            ).first() is not None
-            
-            if has_received_code or current_number.code_received_at is not None:
-                # Delete the number if it has received a code
-                current_number.status = 'DELETED'
-                logger.info(f"Number {current_number.phone_number} deleted after user changed number (had received code)")
-            else:
-                # Return to available if no code was received
-                current_number.status = 'AVAILABLE'
-            
-            current_number.reserved_by_user_id = None
-            current_number.reserved_at = None
-            current_number.expires_at = None
+
+def get_number_with_code_flag(db, number_id: int) -> tuple[Optional[Number], bool]:
+    """Load a number together with whether it has ever received a code, in one query"""
+    received_code = or_(
+        exists().where(
+            Reservation.number_id == Number.id,
+            Reservation.status == ReservationStatus.COMPLETED
+        ),
+        Number.code_received_at.isnot(None)
+    ).label("received_code")
+    row = db.query(Number, received_code).filter(Number.id == number_id).first()
+    return (row[0], bool(row[1])) if row else (None, False)
+
+# Change number / change country buttons, matched once with the reservation id captured
+CHANGE_RESERVATION_CALLBACK_REGEX = re.compile(r'^change_(number|country)_(\d+)$')
+
+@dp.callback_query(F.data.regexp(CHANGE_RESERVATION_CALLBACK_REGEX).as_("change_match"))
+async def change_reservation_handler(callback: CallbackQuery, state: FSMContext, change_match: re.Match):
+    """Dispatch number and country change requests"""
+    reservation_id = int(change_match.group(2))
+    if change_match.group(1) == 'number':
+        await change_number_handler(callback, state, reservation_id)
+    else:
+        await change_country_handler(callback, state, reservation_id)
+
+async def change_number_handler(callback: CallbackQuery, state: FSMContext, reservation_id: int):
+    """Handle number change request"""
+    db = get_db()
+    try:
+        reservation = db.get(Reservation, reservation_id, options=[joinedload(Reservation.service)])
+        if not reservation or reservation.status != ReservationStatus.WAITING_CODE:
+            await callback.answer("❌ حجز غير صالح")
+            return
         
-        # Find new number (allow both AVAILABLE and USED numbers)
-        new_number = db.query(Number).filter(
+        current_number, has_received_code = get_number_with_code_flag(db, reservation.number_id)
+        
+        # Claim a new number (allow both AVAILABLE and USED numbers) in a single statement,
+        # skipping rows locked by concurrent claims
+        claimable = (
             Number.service_id == reservation.service_id,
             Number.country_code == current_number.country_code,
             Number.status.in_(['AVAILABLE', 'USED']),
+        )
+        candidate_id = db.query(Number.id).filter(
+            *claimable,
             Number.id != current_number.id
+        ).limit(1).with_for_update(skip_locked=True).scalar_subquery()
+        new_number = db.execute(
+            update(Number)
+            .where(Number.id == candidate_id, *claimable)
+            .values(
+                status='RESERVED',
+                reserved_by_user_id=reservation.user_id,
+                reserved_at=datetime.now(),
+                expires_at=reservation.expired_at
+            )
+            .returning(Number.id, Number.phone_number, Number.country_code)
+            .execution_options(synchronize_session=False)
         ).first()
         
         if not new_number:
-            # Restore original number
-            current_number.status = 'RESERVED'
-            current_number.reserved_by_user_id = reservation.user_id
-            current_number.reserved_at = datetime.now()
-            current_number.expires_at = reservation.expired_at
-            db.commit()
-            
+            # The original number stays reserved
             await callback.answer("❌ لا توجد أرقام أخرى متاحة")
             return
         
+        # Release current number
+        if has_received_code:
+            # Delete the number if it has received a code
+            current_number.status = 'DELETED'
+            logger.info(f"Number {current_number.phone_number} deleted after user changed number (had received code)")
+        else:
+            # Return to available if no code was received
+            current_number.status = 'AVAILABLE'
+        
+        current_number.reserved_by_user_id = None
+        current_number.reserved_at = None
+        current_number.expires_at = None
+        
         # Update reservation
         reservation.number_id = new_number.id
-        new_number.status = 'RESERVED'
-        new_number.reserved_by_user_id = reservation.user_id
-        new_number.reserved_at = datetime.now()
-        new_number.expires_at = reservation.expired_at
         
         db.commit()
         
-        service = db.query(Service).filter(Service.id == reservation.service_id).first()
+        service = reservation.service
         
         await callback.message.edit_text(
             f"✅ تم تغيير رقمك:\n\n"
@@ -3745,28 +4683,19 @@ async def change_number_handler(callback: CallbackQuery, state: FSMContext):
     finally:
         db.close()
 
-@dp.callback_query(F.data.startswith("change_country_"))
-async def change_country_handler(callback: CallbackQuery, state: FSMContext):
+async def change_country_handler(callback: CallbackQuery, state: FSMContext, reservation_id: int):
     """Handle country change request"""
-    reservation_id = int(callback.data.split("_")[2])
-    
     db = get_db()
     try:
-        reservation = db.query(Reservation).filter(Reservation.id == reservation_id).first()
+        reservation = db.get(Reservation, reservation_id, options=[joinedload(Reservation.service)])
         if not reservation:
             await callback.answer("❌ حجز غير صالح")
             return
         
         # Release current number
-        current_number = db.query(Number).filter(Number.id == reservation.number_id).first()
+        current_number, has_received_code = get_number_with_code_flag(db, reservation.number_id)
         if current_number:
-            # Check if this number has received a code (has completed reservations)
-            has_received_code = db.query(Reservation).filter(
-                Reservation.number_id == current_number.id,
-                Reservation.status == ReservationStatus.COMPLETED
-            ).first() is not None
-            
-            if has_received_code or current_number.code_received_at is not None:
+            if has_received_code:
                 # Delete the number if it has received a code
                 current_number.status = 'DELETED'
                 logger.info(f"Number {current_number.phone_number} deleted after user changed country (had received code)")
@@ -3779,12 +4708,18 @@ async def change_country_handler(callback: CallbackQuery, state: FSMContext):
             current_number.expires_at = None
         
         # Delete reservation
+        bump_system_counters(
+            db, total=-1,
+            successful=-int(reservation.status == ReservationStatus.COMPLETED),
+            failed=-int(reservation.status in FAILED_RESERVATION_STATUSES)
+        )
         db.delete(reservation)
         db.commit()
+        invalidate_system_stats()
         
         await state.update_data(service_id=reservation.service_id)
         
-        service = db.query(Service).filter(Service.id == reservation.service_id).first()
+        service = reservation.service
         
         await callback.message.edit_text(
             f"🌍 اختر الدولة للخدمة: {service.emoji} {service.name}\n\n"
@@ -3796,6 +4731,14 @@ async def change_country_handler(callback: CallbackQuery, state: FSMContext):
         db.close()
 
 
+# Icons shown next to each transaction in the balance view
+TRANSACTION_TYPE_EMOJI: Dict[TransactionType, str] = {
+    TransactionType.ADD: "➕",
+    TransactionType.DEDUCT: "➖",
+    TransactionType.PURCHASE: "🛒",
+    TransactionType.REWARD: "🎁"
+}
+
 @dp.callback_query(F.data == "my_balance")
 async def my_balance_handler(callback: CallbackQuery):
     """Handle balance check"""
@@ -3808,13 +4751,17 @@ async def my_balance_handler(callback: CallbackQuery):
             Transaction.user_id == user.id
         ).order_by(Transaction.created_at.desc()).limit(5).all()
         
-        text = f"💰 رصيدك الحالي: {user.balance} وحدة\n\n"
+        lines = [f"💰 رصيدك الحالي: {user.balance} وحدة\n"]
         
         if transactions:
-            text += "📊 آخر المعاملات:\n"
-            for tx in transactions:
-                type_emoji = {"add": "➕", "deduct": "➖", "purchase": "🛒", "reward": "🎁"}
-                text += f"{type_emoji.get(tx.type.value, '•')} {tx.amount} - {tx.reason} ({tx.created_at.strftime('%Y-%m-%d %H:%M')})\n"
+            lines.append("📊 آخر المعاملات:")
+            lines.extend(
+                f"{TRANSACTION_TYPE_EMOJI.get(tx.type, '•')} {tx.amount} - {tx.reason} ({tx.created_at.strftime('%Y-%m-%d %H:%M')})"
+                for tx in transactions
+            )
+        lines.append("")
+        
+        text = "\n".join(lines)
         
         keyboard = InlineKeyboardBuilder()
         keyboard.row(InlineKeyboardButton(text="🔙 الرئيسية", callback_data="main_menu"))
@@ -3824,59 +4771,61 @@ async def my_balance_handler(callback: CallbackQuery):
     finally:
         db.close()
 
+@functools.lru_cache(maxsize=1024)
+def telegram_join_url(username_or_link: str) -> str:
+    """Turn a stored @username, bare username or link into a t.me URL"""
+    if username_or_link.startswith('http'):
+        return username_or_link
+    if username_or_link.startswith('@'):
+        return f"https://t.me/{username_or_link[1:]}"
+    return f"https://t.me/{username_or_link}"
+
 @dp.callback_query(F.data == "free_credits")
 async def free_credits_handler(callback: CallbackQuery):
     """Handle free credits collection from channels and groups"""
     db = get_db()
     try:
-        channels = db.query(Channel).filter(Channel.active == True).all()
-        groups = db.query(Group).filter(Group.active == True).all()
+        # Only the fields shown on the screen are needed
+        channels = db.query(Channel.id, Channel.title, Channel.username_or_link, Channel.reward_amount).filter(
+            Channel.active == True
+        ).all()
+        groups = db.query(Group.id, Group.title, Group.username_or_link, Group.reward_amount).filter(
+            Group.active == True
+        ).all()
         
         if not channels and not groups:
             await callback.answer("❌ لا توجد قنوات أو جروبات متاحة حالياً")
             return
         
-        text = "🆓 تجميع رصيد مجاني\n\n" \
-               "اشترك في القنوات والجروبات التالية ثم اضغط '✅ تحقق' للحصول على رصيد مجاني:\n\n"
+        lines = [
+            "🆓 تجميع رصيد مجاني",
+            "",
+            "اشترك في القنوات والجروبات التالية ثم اضغط '✅ تحقق' للحصول على رصيد مجاني:",
+            ""
+        ]
         
         keyboard = InlineKeyboardBuilder()
         
         # Add channels
         if channels:
-            text += "📢 القنوات:\n"
+            lines.append("📢 القنوات:")
             for channel in channels:
-                text += f"📢 {channel.title} - {channel.reward_amount} وحدة\n"
-                
-                # Validate URL before creating button
-                channel_url = channel.username_or_link
-                if not channel_url.startswith('http'):
-                    if channel_url.startswith('@'):
-                        channel_url = f"https://t.me/{channel_url[1:]}"
-                    else:
-                        channel_url = f"https://t.me/{channel_url}"
+                lines.append(f"📢 {channel.title} - {channel.reward_amount} وحدة")
                 
                 keyboard.row(
-                    InlineKeyboardButton(text="🔗 انضمام", url=channel_url),
+                    InlineKeyboardButton(text="🔗 انضمام", url=telegram_join_url(channel.username_or_link)),
                     InlineKeyboardButton(text="✅ تحقق", callback_data=f"verify_channel_{channel.id}")
                 )
-            text += "\n"
+            lines.append("")
         
         # Add groups
         if groups:
-            text += "👥 الجروبات:\n"
+            lines.append("👥 الجروبات:")
             for group in groups:
-                text += f"👥 {group.title} - {group.reward_amount} وحدة\n"
-                
-                # Validate URL before creating button
-                group_url = group.username_or_link
-                if not group_url.startswith('http'):
-                    if group_url.startswith('@'):
-                        group_url = f"https://t.me/{group_url[1:]}"
-                    else:
-                        group_url = f"https://t.me/{group_url}"
+                lines.append(f"👥 {group.title} - {group.reward_amount} وحدة")
                 
                 keyboard.row(
-                    InlineKeyboardButton(text="🔗 انضمام", url=group_url),
+                    InlineKeyboardButton(text="🔗 انضمام", url=telegram_join_url(group.username_or_link)),
                     InlineKeyboardButton(text="✅ تحقق", callback_data=f"verify_group_{group.id}")
                 )
         
@@ -3894,61 +4843,57 @@ async def free_credits_handler(callback: CallbackQuery):
         
         keyboard.row(InlineKeyboardButton(text="🔙 الرئيسية", callback_data="main_menu"))
         
+        text = "\n".join(lines) + "\n"
         await callback.message.edit_text(text, reply_markup=keyboard.as_markup())
         
     finally:
         db.close()
 
-@dp.callback_query(F.data.startswith("verify_channel_"))
-async def verify_channel_handler(callback: CallbackQuery):
+# Single channel / group verify buttons, matched once with the item id captured
+VERIFY_ITEM_CALLBACK_REGEX = re.compile(r'^verify_(channel|group)_(\d+)$')
+
+@dp.callback_query(F.data.regexp(VERIFY_ITEM_CALLBACK_REGEX).as_("verify_match"))
+async def verify_item_handler(callback: CallbackQuery, verify_match: re.Match):
+    """Dispatch single channel and group verification"""
+    item_id = int(verify_match.group(2))
+    if verify_match.group(1) == 'channel':
+        await verify_channel_handler(callback, item_id)
+    else:
+        await verify_group_handler(callback, item_id)
+
+async def verify_channel_handler(callback: CallbackQuery, channel_id: int):
     """Handle single channel verification"""
-    channel_id = int(callback.data.split("_")[2])
     user, _ = await get_or_create_user(str(callback.from_user.id))
     
     db = get_db()
     try:
-        channel = db.query(Channel).filter(Channel.id == channel_id).first()
+        channel = db.get(Channel, channel_id)
         if not channel:
             await callback.answer("❌ قناة غير موجودة")
             return
         
         # Check if user already received reward
-        reward_record = db.query(UserChannelReward).filter(
+        already_rewarded = db.query(UserChannelReward.id).filter(
             UserChannelReward.user_id == user.id,
-            UserChannelReward.channel_id == channel_id
+            UserChannelReward.channel_id == channel_id,
+            UserChannelReward.last_award_at.isnot(None)
         ).first()
         
-        if reward_record and reward_record.last_award_at:
+        if already_rewarded:
             await callback.answer("✅ تم استلام مكافأة هذه القناة من قبل")
             return
         
         # Check membership
         try:
-            # Extract channel username from link
-            channel_username = channel.username_or_link
-            if channel_username.startswith('https://t.me/'):
-                channel_username = '@' + channel_username.split('/')[-1]
-            elif not channel_username.startswith('@'):
-                channel_username = '@' + channel_username
-            
-            member = await bot.get_chat_member(channel_username, callback.from_user.id)
-            if member.status in ['member', 'administrator', 'creator']:
-                # Give reward
-                user_obj = db.query(User).filter(User.id == user.id).first()
-                user_obj.balance += channel.reward_amount
-                
-                # Create reward record
-                if not reward_record:
-                    reward_record = UserChannelReward(
-                        user_id=user.id,
-                        channel_id=channel_id,
-                        times_awarded=1
-                    )
-                    db.add(reward_record)
-                else:
-                    reward_record.times_awarded += 1
+            chat_ref = channel_member_ref(channel)
+            if await is_reward_member(chat_ref, callback.from_user.id):
+                # Claim the reward first so a concurrent click can't pay it twice
+                if not record_rewards(db, UserChannelReward, 'channel_id', user.id, [channel_id]):
+                    await callback.answer("✅ تم استلام مكافأة هذه القناة من قبل")
+                    return
                 
-                reward_record.last_award_at = datetime.now()
+                # Give reward
+                credit_user_balance(db, user.id, channel.reward_amount)
                 
                 # Create transaction
                 transaction = Transaction(
@@ -3960,6 +4905,7 @@ async def verify_channel_handler(callback: CallbackQuery):
                 db.add(transaction)
                 
                 db.commit()
+                forget_reward_memberships([chat_ref], callback.from_user.id)
                 
                 await callback.answer(f"🎉 تم إضافة {channel.reward_amount} وحدة لرصيدك!")
             else:
@@ -3983,65 +4929,39 @@ async def verify_channel_handler(callback: CallbackQuery):
     finally:
         db.close()
 
-@dp.callback_query(F.data.startswith("verify_group_"))
-async def verify_group_handler(callback: CallbackQuery):
+async def verify_group_handler(callback: CallbackQuery, group_id: int):
     """Handle single group verification"""
-    group_id = int(callback.data.split("_")[2])
     user, _ = await get_or_create_user(str(callback.from_user.id))
     
     db = get_db()
     try:
-        group = db.query(Group).filter(Group.id == group_id).first()
+        group = db.get(Group, group_id)
         if not group:
             await callback.answer("❌ جروب غير موجود")
             return
         
         # Check if user already received reward
-        reward_record = db.query(UserGroupReward).filter(
+        already_rewarded = db.query(UserGroupReward.id).filter(
             UserGroupReward.user_id == user.id,
-            UserGroupReward.group_id == group_id
+            UserGroupReward.group_id == group_id,
+            UserGroupReward.last_award_at.isnot(None)
         ).first()
         
-        if reward_record and reward_record.last_award_at:
+        if already_rewarded:
             await callback.answer("✅ تم استلام مكافأة هذا الجروب من قبل")
             return
         
         # Check membership
         try:
-            # For groups, use group_id directly if available, otherwise extract from link
-            group_identifier = group.group_id if group.group_id else group.username_or_link
-            
-            # Handle different group identifier formats
-            if not group_identifier.startswith('@') and not group_identifier.startswith('-') and not group_identifier.startswith('100'):
-                if group.username_or_link.startswith('https://t.me/'):
-                    username_part = group.username_or_link.split('/')[-1]
-                    # Check if it's a group ID or username
-                    if username_part.startswith('c/'):
-                        # It's a private channel/group link
-                        group_identifier = '-100' + username_part[2:]
-                    else:
-                        group_identifier = '@' + username_part
-                elif not group.username_or_link.startswith('@'):
-                    group_identifier = '@' + group.username_or_link
-            
-            member = await bot.get_chat_member(group_identifier, callback.from_user.id)
-            if member.status in ['member', 'administrator', 'creator']:
-                # Give reward
-                user_obj = db.query(User).filter(User.id == user.id).first()
-                user_obj.balance += group.reward_amount
-                
-                # Create reward record
-                if not reward_record:
-                    reward_record = UserGroupReward(
-                        user_id=user.id,
-                        group_id=group_id,
-                        times_awarded=1
-                    )
-                    db.add(reward_record)
-                else:
-                    reward_record.times_awarded += 1
+            chat_ref = group_chat_ref(group)
+            if await is_reward_member(chat_ref, callback.from_user.id):
+                # Claim the reward first so a concurrent click can't pay it twice
+                if not record_rewards(db, UserGroupReward, 'group_id', user.id, [group_id]):
+                    await callback.answer("✅ تم استلام مكافأة هذا الجروب من قبل")
+                    return
                 
-                reward_record.last_award_at = datetime.now()
+                # Give reward
+                credit_user_balance(db, user.id, group.reward_amount)
                 
                 # Create transaction
                 transaction = Transaction(
@@ -4053,6 +4973,7 @@ async def verify_group_handler(callback: CallbackQuery):
                 db.add(transaction)
                 
                 db.commit()
+                forget_reward_memberships([chat_ref], callback.from_user.id)
                 
                 await callback.answer(f"🎉 تم إضافة {group.reward_amount} وحدة لرصيدك!")
             else:
@@ -4078,6 +4999,62 @@ async def verify_group_handler(callback: CallbackQuery):
     finally:
         db.close()
 
+# Overall reservation counters: ((total, successful, failed), expiry on the monotonic clock)
+_system_stats_cache: Optional[tuple[tuple[int, int, int], float]] = None
+SYSTEM_STATS_CACHE_TTL = 10  # seconds
+
+def invalidate_system_stats():
+    """Force the next stats view to recount reservations"""
+    global _system_stats_cache
+    _system_stats_cache = None
+
+# Reservation statuses counted as failed in the stats
+FAILED_RESERVATION_STATUSES = (ReservationStatus.EXPIRED, ReservationStatus.CANCELED)
+SYSTEM_COUNTERS_ID = 1
+
+def count_reservation_stats(db) -> tuple[int, int, int]:
+    """Count (total, successful, failed) reservations with a full scan"""
+    counts = db.query(
+        func.count(Reservation.id),
+        func.count(case((Reservation.status == ReservationStatus.COMPLETED, 1))),
+        func.count(case((Reservation.status.in_(FAILED_RESERVATION_STATUSES), 1)))
+    ).one()
+    return tuple(counts)
+
+def seed_system_counters(db):
+    """Create the running counters row from the existing reservations if it is missing"""
+    if db.query(SystemCounters.id).filter(SystemCounters.id == SYSTEM_COUNTERS_ID).first():
+        return
+    total, successful, failed = count_reservation_stats(db)
+    db.add(SystemCounters(id=SYSTEM_COUNTERS_ID, total=total, successful=successful, failed=failed))
+
+def bump_system_counters(db, total: int = 0, successful: int = 0, failed: int = 0):
+    """Adjust the running reservation counters within the caller's transaction"""
+    db.execute(
+        update(SystemCounters)
+        .where(SystemCounters.id == SYSTEM_COUNTERS_ID)
+        .values(
+            total=SystemCounters.total + total,
+            successful=SystemCounters.successful + successful,
+            failed=SystemCounters.failed + failed
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+def get_system_stats(db) -> tuple[int, int, int]:
+    """Return (total, successful, failed) reservation counts, cached briefly"""
+    global _system_stats_cache
+    now = time.monotonic()
+    if _system_stats_cache and _system_stats_cache[1] > now:
+        return _system_stats_cache[0]
+    
+    counters = db.query(SystemCounters.total, SystemCounters.successful, SystemCounters.failed).filter(
+        SystemCounters.id == SYSTEM_COUNTERS_ID
+    ).first()
+    stats = tuple(counters) if counters else count_reservation_stats(db)
+    _system_stats_cache = (stats, now + SYSTEM_STATS_CACHE_TTL)
+    return stats
+
 # Statistics handlers
 @dp.callback_query(F.data == "view_stats")
 async def view_stats_handler(callback: CallbackQuery):
@@ -4087,29 +5064,17 @@ async def view_stats_handler(callback: CallbackQuery):
     
     db = get_db()
     try:
-        # Get total reservations count
-        total_reservations = db.query(Reservation).count()
-        
-        # Get successful reservations (completed status)
-        successful_reservations = db.query(Reservation).filter(
-            Reservation.status == ReservationStatus.COMPLETED
-        ).count()
+        total_reservations, successful_reservations, failed_reservations = get_system_stats(db)
         
-        # Get failed/expired reservations
-        failed_reservations = db.query(Reservation).filter(
-            Reservation.status.in_([ReservationStatus.EXPIRED, ReservationStatus.CANCELED])
-        ).count()
+        # Personal counters in a single aggregate over the user's reservations
+        user_reservations, user_successful = db.query(
+            func.count(Reservation.id),
+            func.count(case((Reservation.status == ReservationStatus.COMPLETED, 1)))
+        ).filter(Reservation.user_id == user.id).one()
         
         # Calculate success rate
         success_rate = (successful_reservations / total_reservations * 100) if total_reservations > 0 else 0
         
-        # Get user's personal stats
-        user_reservations = db.query(Reservation).filter(Reservation.user_id == user.id).count()
-        user_successful = db.query(Reservation).filter(
-            Reservation.user_id == user.id,
-            Reservation.status == ReservationStatus.COMPLETED
-        ).count()
-        
         user_success_rate = (user_successful / user_reservations * 100) if user_reservations > 0 else 0
         
         # Add timestamp to make content unique for refresh
@@ -4141,6 +5106,27 @@ async def view_stats_handler(callback: CallbackQuery):
     finally:
         db.close()
 
+async def publish_stats_message(group_chat_id: str, message_id: Optional[int], text: str) -> Optional[int]:
+    """Edit a group's stats message in place or send a new one; return the id of a newly sent message"""
+    if message_id:
+        try:
+            await bot.edit_message_text(
+                chat_id=group_chat_id,
+                message_id=message_id,
+                text=text,
+                parse_mode="Markdown"
+            )
+            return None
+        except Exception as edit_error:
+            logger.warning(f"Failed to edit existing stats message, sending new one: {edit_error}")
+    
+    new_message = await bot.send_message(
+        chat_id=group_chat_id,
+        text=text,
+        parse_mode="Markdown"
+    )
+    return new_message.message_id
+
 @dp.callback_query(F.data == "send_stats_to_group")
 async def send_stats_to_group_handler(callback: CallbackQuery):
     """Handle sending stats to group"""
@@ -4162,13 +5148,7 @@ async def send_stats_to_group_handler(callback: CallbackQuery):
             return
         
         # Calculate overall stats
-        total_reservations = db.query(Reservation).count()
-        successful_reservations = db.query(Reservation).filter(
-            Reservation.status == ReservationStatus.COMPLETED
-        ).count()
-        failed_reservations = db.query(Reservation).filter(
-            Reservation.status.in_([ReservationStatus.EXPIRED, ReservationStatus.CANCELED])
-        ).count()
+        total_reservations, successful_reservations, failed_reservations = get_system_stats(db)
         
         # Calculate success rate
         success_rate = (successful_reservations / total_reservations * 100) if total_reservations > 0 else 0
@@ -4187,72 +5167,49 @@ async def send_stats_to_group_handler(callback: CallbackQuery):
         sent_count = 0
         updated_count = 0
         
-        for sg in service_groups:
-            try:
-                # Check if there's an existing stats message for this group
-                from models import StatsMessage
-                existing_stats = db.query(StatsMessage).filter(
-                    StatsMessage.group_chat_id == sg.group_chat_id
-                ).order_by(StatsMessage.created_at.desc()).first()
-                
-                if existing_stats:
-                    try:
-                        # Try to edit the existing message
-                        await bot.edit_message_text(
-                            chat_id=sg.group_chat_id,
-                            message_id=existing_stats.message_id,
-                            text=stats_message,
-                            parse_mode="Markdown"
-                        )
-                        
-                        # Update the record with new stats
-                        existing_stats.total_reservations = total_reservations
-                        existing_stats.successful_reservations = successful_reservations
-                        existing_stats.success_rate = success_rate
-                        existing_stats.last_updated = datetime.now()
-                        
-                        updated_count += 1
-                        
-                    except Exception as edit_error:
-                        logger.warning(f"Failed to edit existing stats message, sending new one: {edit_error}")
-                        # If editing fails, send a new message
-                        new_message = await bot.send_message(
-                            chat_id=sg.group_chat_id,
-                            text=stats_message,
-                            parse_mode="Markdown"
-                        )
-                        
-                        # Create new stats record
-                        new_stats = StatsMessage(
-                            group_chat_id=sg.group_chat_id,
-                            message_id=new_message.message_id,
-                            total_reservations=total_reservations,
-                            successful_reservations=successful_reservations,
-                            success_rate=success_rate
-                        )
-                        db.add(new_stats)
-                        sent_count += 1
-                else:
-                    # Send new stats message
-                    new_message = await bot.send_message(
-                        chat_id=sg.group_chat_id,
-                        text=stats_message,
-                        parse_mode="Markdown"
-                    )
-                    
-                    # Create new stats record
-                    new_stats = StatsMessage(
-                        group_chat_id=sg.group_chat_id,
-                        message_id=new_message.message_id,
-                        total_reservations=total_reservations,
-                        successful_reservations=successful_reservations,
-                        success_rate=success_rate
-                    )
-                    db.add(new_stats)
-                    sent_count += 1
-                    
-            except Exception as e:
-                logger.error(f"Failed to send/update stats to group {sg.group_chat_id}: {e}")
+        # A group linked to several services gets a single stats message
+        group_chat_ids = list(dict.fromkeys(sg.group_chat_id for sg in service_groups))
+        
+        # Latest stats message of every group in one query
+        latest_ids = db.query(func.max(StatsMessage.id)).filter(
+            StatsMessage.group_chat_id.in_(group_chat_ids)
+        ).group_by(StatsMessage.group_chat_id)
+        existing_stats_map = {
+            stats.group_chat_id: stats
+            for stats in db.query(StatsMessage).filter(StatsMessage.id.in_(latest_ids))
+        }
+        
+        # Edit or send in all groups concurrently
+        results = await asyncio.gather(*[
+            publish_stats_message(
+                chat_id,
+                existing_stats_map[chat_id].message_id if chat_id in existing_stats_map else None,
+                stats_message
+            )
+            for chat_id in group_chat_ids
+        ], return_exceptions=True)
+        
+        for chat_id, result in zip(group_chat_ids, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to send/update stats to group {chat_id}: {result}")
+            elif result is None:
+                # Update the record with new stats
+                existing_stats = existing_stats_map[chat_id]
+                existing_stats.total_reservations = total_reservations
+                existing_stats.successful_reservations = successful_reservations
+                existing_stats.success_rate = success_rate
+                existing_stats.last_updated = datetime.now()
+                updated_count += 1
+            else:
+                # Create new stats record
+                db.add(StatsMessage(
+                    group_chat_id=chat_id,
+                    message_id=result,
+                    total_reservations=total_reservations,
+                    successful_reservations=successful_reservations,
+                    success_rate=success_rate
+                ))
+                sent_count += 1
         
         db.commit()
         
@@ -4268,6 +5225,160 @@ async def send_stats_to_group_handler(callback: CallbackQuery):
     finally:
         db.close()
 
+def record_rewards(db, reward_model, item_column: str, user_id: int, item_ids: List[int]) -> set:
+    """Mark channels or groups as rewarded for a user with a single INSERT ... ON CONFLICT DO UPDATE;
+    return the ids actually claimed, leaving out those another request rewarded meanwhile"""
+    if not item_ids:
+        return set()
+    
+    dialect_insert = postgresql_insert if engine.dialect.name == 'postgresql' else sqlite_insert
+    now = datetime.now()
+    statement = dialect_insert(reward_model).values([
+        {'user_id': user_id, item_column: item_id, 'times_awarded': 1, 'last_award_at': now}
+        for item_id in item_ids
+    ])
+    item_id_column = getattr(reward_model, item_column)
+    return set(db.execute(statement.on_conflict_do_update(
+        index_elements=['user_id', item_column],
+        set_={
+            'times_awarded': func.coalesce(reward_model.times_awarded, 0) + 1,
+            'last_award_at': statement.excluded.last_award_at
+        },
+        where=reward_model.last_award_at.is_(None)
+    ).returning(item_id_column)).scalars())
+
+def add_reward_transactions(db, user_id: int, rewarded_items: List[tuple]):
+    """Insert the reward transactions for (item_type, item) pairs with a single multi-row INSERT"""
+    if not rewarded_items:
+        return
+    
+    db.execute(insert(Transaction), [
+        {
+            'user_id': user_id,
+            'type': TransactionType.REWARD,
+            'amount': item.reward_amount,
+            'reason': f"مكافأة الاشتراك في {item.title}" if item_type == 'channel' else f"مكافأة الانضمام لجروب {item.title}"
+        }
+        for item_type, item in rewarded_items
+    ])
+
+def credit_user_balance(db, user_id: int, amount):
+    """Add to a user's balance with a single atomic UPDATE, without loading the row"""
+    db.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(balance=User.balance + amount, version=User.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+def channel_chat_ref(username_or_link: str) -> str:
+    """Chat reference of a channel for get_chat_member, from its stored @username or link"""
+    if username_or_link.startswith('https://t.me/'):
+        return '@' + username_or_link.split('/')[-1]
+    if not username_or_link.startswith('@'):
+        return '@' + username_or_link
+    return username_or_link
+
+def channel_member_ref(channel: Channel) -> Union[int, str]:
+    """Chat reference of a channel for get_chat_member, preferring the chat id resolved when it was added"""
+    return channel.resolved_chat_id or channel_chat_ref(channel.username_or_link)
+
+def group_chat_ref(group: Group) -> str:
+    """Chat reference of a group for get_chat_member, preferring its stored Telegram id"""
+    group_identifier = group.group_id if group.group_id else group.username_or_link
+    
+    # Handle different group identifier formats
+    if not group_identifier.startswith('@') and not group_identifier.startswith('-') and not group_identifier.startswith('100'):
+        if group.username_or_link.startswith('https://t.me/'):
+            username_part = group.username_or_link.split('/')[-1]
+            # Check if it's a group ID or username
+            if username_part.startswith('c/'):
+                # It's a private channel/group link
+                group_identifier = '-100' + username_part[2:]
+            else:
+                group_identifier = '@' + username_part
+        elif not group.username_or_link.startswith('@'):
+            group_identifier = '@' + group.username_or_link
+    return group_identifier
+
+def get_unrewarded_channels(db, user_id: int) -> List[Channel]:
+    """Active channels the user wasn't rewarded for yet, in one query"""
+    return db.query(Channel).outerjoin(
+        UserChannelReward, and_(
+            UserChannelReward.channel_id == Channel.id,
+            UserChannelReward.user_id == user_id
+        )
+    ).filter(
+        Channel.active == True,
+        UserChannelReward.last_award_at.is_(None)
+    ).all()
+
+def get_unrewarded_groups(db, user_id: int) -> List[Group]:
+    """Active groups the user wasn't rewarded for yet, in one query"""
+    return db.query(Group).outerjoin(
+        UserGroupReward, and_(
+            UserGroupReward.group_id == Group.id,
+            UserGroupReward.user_id == user_id
+        )
+    ).filter(
+        Group.active == True,
+        UserGroupReward.last_award_at.is_(None)
+    ).all()
+
+# Confirmed memberships per (chat_ref, user_id) for reward checks: expiry on the monotonic clock.
+# Only positive answers are kept, so a user who has just joined is never told to join again.
+_reward_member_cache: Dict[tuple, float] = {}
+REWARD_MEMBER_CACHE_TTL = 30  # seconds
+
+# Member statuses that qualify for a channel or group reward
+REWARD_MEMBER_STATUSES = frozenset({'member', 'administrator', 'creator'})
+# Concurrent get_chat_member calls per verification, to stay within Telegram rate limits
+MEMBERSHIP_CHECK_CONCURRENCY = 10
+
+async def is_reward_member(chat_ref: Union[int, str], user_id: int) -> bool:
+    """Check whether a user is a member of a channel or group, reusing a recent positive answer"""
+    now = time.monotonic()
+    expires_at = _reward_member_cache.get((chat_ref, user_id))
+    if expires_at and now < expires_at:
+        return True
+    
+    member = await bot.get_chat_member(chat_ref, user_id)
+    if member.status not in REWARD_MEMBER_STATUSES:
+        return False
+    
+    # Drop expired entries once the cache grows large
+    if len(_reward_member_cache) > 4096:
+        for key in [key for key, expires_at in _reward_member_cache.items() if expires_at <= now]:
+            del _reward_member_cache[key]
+    _reward_member_cache[(chat_ref, user_id)] = now + REWARD_MEMBER_CACHE_TTL
+    return True
+
+def forget_reward_memberships(chat_refs: List[Union[int, str]], user_id: int):
+    """Drop cached memberships of chats the user was just rewarded for"""
+    for chat_ref in chat_refs:
+        _reward_member_cache.pop((chat_ref, user_id), None)
+
+async def check_memberships(chat_refs: List[Union[int, str]], user_id: int) -> List[bool]:
+    """Check a user's membership in several chats concurrently; failed checks count as not a member"""
+    semaphore = asyncio.Semaphore(MEMBERSHIP_CHECK_CONCURRENCY)
+    
+    async def is_member(chat_ref: Union[int, str]) -> bool:
+        async with semaphore:
+            return await is_reward_member(chat_ref, user_id)
+    
+    results = await asyncio.gather(
+        *(is_member(chat_ref) for chat_ref in chat_refs),
+        return_exceptions=True
+    )
+    memberships = []
+    for chat_ref, result in zip(chat_refs, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error checking membership in {chat_ref}: {result}")
+            memberships.append(False)
+        else:
+            memberships.append(result)
+    return memberships
+
 @dp.callback_query(F.data == "verify_all_channels")
 async def verify_all_channels_handler(callback: CallbackQuery):
     """Handle verification of all channels"""
@@ -4275,70 +5386,36 @@ async def verify_all_channels_handler(callback: CallbackQuery):
     
     db = get_db()
     try:
-        channels = db.query(Channel).filter(Channel.active == True).all()
         total_reward = 0
         verified_channels = []
+        # Channels the user wasn't rewarded for yet
+        pending_channels = get_unrewarded_channels(db, user.id)
+        
+        # Check membership in all remaining channels at once
+        chat_refs = [channel_member_ref(channel) for channel in pending_channels]
+        memberships = await check_memberships(chat_refs, callback.from_user.id)
+        verified_chat_refs = []
+        for channel, chat_ref, is_member in zip(pending_channels, chat_refs, memberships):
+            if is_member:
+                verified_channels.append(channel)
+                verified_chat_refs.append(chat_ref)
+                total_reward += channel.reward_amount
         
-        for channel in channels:
-            # Check if user already received reward
-            reward_record = db.query(UserChannelReward).filter(
-                UserChannelReward.user_id == user.id,
-                UserChannelReward.channel_id == channel.id
-            ).first()
-            
-            if reward_record and reward_record.last_award_at:
-                continue
-            
-            # Check membership
-            try:
-                channel_username = channel.username_or_link
-                if channel_username.startswith('https://t.me/'):
-                    channel_username = '@' + channel_username.split('/')[-1]
-                elif not channel_username.startswith('@'):
-                    channel_username = '@' + channel_username
-                
-                member = await bot.get_chat_member(channel_username, callback.from_user.id)
-                if member.status in ['member', 'administrator', 'creator']:
-                    verified_channels.append(channel)
-                    total_reward += channel.reward_amount
-                    
-            except Exception as e:
-                logger.error(f"Error checking channel {channel.title}: {e}")
-                continue
+        if total_reward > 0:
+            # Claim the rewards first; channels a concurrent click already claimed are skipped
+            awarded_ids = record_rewards(db, UserChannelReward, 'channel_id', user.id, [channel.id for channel in verified_channels])
+            verified_channels = [channel for channel in verified_channels if channel.id in awarded_ids]
+            total_reward = sum(channel.reward_amount for channel in verified_channels)
         
         if total_reward > 0:
             # Add balance
-            user_obj = db.query(User).filter(User.id == user.id).first()
-            user_obj.balance += total_reward
-            
-            # Create records and transactions
-            for channel in verified_channels:
-                reward_record = db.query(UserChannelReward).filter(
-                    UserChannelReward.user_id == user.id,
-                    UserChannelReward.channel_id == channel.id
-                ).first()
-                
-                if not reward_record:
-                    reward_record = UserChannelReward(
-                        user_id=user.id,
-                        channel_id=channel.id,
-                        times_awarded=1
-                    )
-                    db.add(reward_record)
-                else:
-                    reward_record.times_awarded += 1
-                
-                reward_record.last_award_at = datetime.now()
-                
-                transaction = Transaction(
-                    user_id=user.id,
-                    type=TransactionType.REWARD,
-                    amount=channel.reward_amount,
-                    reason=f"مكافأة الاشتراك في {channel.title}"
-                )
-                db.add(transaction)
+            credit_user_balance(db, user.id, total_reward)
+            
+            # Create transactions
+            add_reward_transactions(db, user.id, [('channel', channel) for channel in verified_channels])
             
             db.commit()
+            forget_reward_memberships(verified_chat_refs, callback.from_user.id)
             
             await callback.answer(f"🎉 تم إضافة {total_reward} وحدة لرصيدك!")
         else:
@@ -4354,79 +5431,36 @@ async def verify_all_groups_handler(callback: CallbackQuery):
     
     db = get_db()
     try:
-        groups = db.query(Group).filter(Group.active == True).all()
         total_reward = 0
         verified_groups = []
+        # Groups the user wasn't rewarded for yet
+        pending_groups = get_unrewarded_groups(db, user.id)
+        
+        # Check membership in all remaining groups at once
+        chat_refs = [group_chat_ref(group) for group in pending_groups]
+        memberships = await check_memberships(chat_refs, callback.from_user.id)
+        verified_chat_refs = []
+        for group, chat_ref, is_member in zip(pending_groups, chat_refs, memberships):
+            if is_member:
+                verified_groups.append(group)
+                verified_chat_refs.append(chat_ref)
+                total_reward += group.reward_amount
         
-        for group in groups:
-            # Check if user already received reward
-            reward_record = db.query(UserGroupReward).filter(
-                UserGroupReward.user_id == user.id,
-                UserGroupReward.group_id == group.id
-            ).first()
-            
-            if reward_record and reward_record.last_award_at:
-                continue
-            
-            # Check membership
-            try:
-                group_identifier = group.group_id if group.group_id else group.username_or_link
-                
-                # Handle different group identifier formats
-                if not group_identifier.startswith('@') and not group_identifier.startswith('-') and not group_identifier.startswith('100'):
-                    if group.username_or_link.startswith('https://t.me/'):
-                        username_part = group.username_or_link.split('/')[-1]
-                        # Check if it's a group ID or username
-                        if username_part.startswith('c/'):
-                            # It's a private channel/group link
-                            group_identifier = '-100' + username_part[2:]
-                        else:
-                            group_identifier = '@' + username_part
-                    elif not group.username_or_link.startswith('@'):
-                        group_identifier = '@' + group.username_or_link
-                
-                member = await bot.get_chat_member(group_identifier, callback.from_user.id)
-                if member.status in ['member', 'administrator', 'creator']:
-                    verified_groups.append(group)
-                    total_reward += group.reward_amount
-                    
-            except Exception as e:
-                logger.error(f"Error checking group {group.title}: {e}")
-                continue
+        if total_reward > 0:
+            # Claim the rewards first; groups a concurrent click already claimed are skipped
+            awarded_ids = record_rewards(db, UserGroupReward, 'group_id', user.id, [group.id for group in verified_groups])
+            verified_groups = [group for group in verified_groups if group.id in awarded_ids]
+            total_reward = sum(group.reward_amount for group in verified_groups)
         
         if total_reward > 0:
             # Add balance
-            user_obj = db.query(User).filter(User.id == user.id).first()
-            user_obj.balance += total_reward
-            
-            # Create records and transactions
-            for group in verified_groups:
-                reward_record = db.query(UserGroupReward).filter(
-                    UserGroupReward.user_id == user.id,
-                    UserGroupReward.group_id == group.id
-                ).first()
-                
-                if not reward_record:
-                    reward_record = UserGroupReward(
-                        user_id=user.id,
-                        group_id=group.id,
-                        times_awarded=1
-                    )
-                    db.add(reward_record)
-                else:
-                    reward_record.times_awarded += 1
-                
-                reward_record.last_award_at = datetime.now()
-                
-                transaction = Transaction(
-                    user_id=user.id,
-                    type=TransactionType.REWARD,
-                    amount=group.reward_amount,
-                    reason=f"مكافأة الانضمام لجروب {group.title}"
-                )
-                db.add(transaction)
+            credit_user_balance(db, user.id, total_reward)
+            
+            # Create transactions
+            add_reward_transactions(db, user.id, [('group', group) for group in verified_groups])
             
             db.commit()
+            forget_reward_memberships(verified_chat_refs, callback.from_user.id)
             
             await callback.answer(f"🎉 تم إضافة {total_reward} وحدة لرصيدك!")
         else:
@@ -4445,122 +5479,47 @@ async def verify_all_handler(callback: CallbackQuery):
         total_reward = 0
         verified_items = []
         
-        # Check channels
-        channels = db.query(Channel).filter(Channel.active == True).all()
-        for channel in channels:
-            reward_record = db.query(UserChannelReward).filter(
-                UserChannelReward.user_id == user.id,
-                UserChannelReward.channel_id == channel.id
-            ).first()
-            
-            if reward_record and reward_record.last_award_at:
-                continue
-            
-            try:
-                channel_username = channel.username_or_link
-                if channel_username.startswith('https://t.me/'):
-                    channel_username = '@' + channel_username.split('/')[-1]
-                elif not channel_username.startswith('@'):
-                    channel_username = '@' + channel_username
-                
-                member = await bot.get_chat_member(channel_username, callback.from_user.id)
-                if member.status in ['member', 'administrator', 'creator']:
-                    verified_items.append(('channel', channel))
-                    total_reward += channel.reward_amount
-                    
-            except Exception as e:
-                logger.error(f"Error checking channel {channel.title}: {e}")
-                continue
+        # Collect channels and groups the user wasn't rewarded for yet
+        pending_items = [
+            ('channel', channel, channel_member_ref(channel))
+            for channel in get_unrewarded_channels(db, user.id)
+        ]
+        pending_items.extend(
+            ('group', group, group_chat_ref(group))
+            for group in get_unrewarded_groups(db, user.id)
+        )
         
-        # Check groups
-        groups = db.query(Group).filter(Group.active == True).all()
-        for group in groups:
-            reward_record = db.query(UserGroupReward).filter(
-                UserGroupReward.user_id == user.id,
-                UserGroupReward.group_id == group.id
-            ).first()
-            
-            if reward_record and reward_record.last_award_at:
-                continue
-            
-            try:
-                group_identifier = group.group_id if group.group_id else group.username_or_link
-                
-                if not group_identifier.startswith('@') and not group_identifier.startswith('-'):
-                    if group.username_or_link.startswith('https://t.me/'):
-                        group_identifier = '@' + group.username_or_link.split('/')[-1]
-                    elif not group.username_or_link.startswith('@'):
-                        group_identifier = '@' + group.username_or_link
-                
-                member = await bot.get_chat_member(group_identifier, callback.from_user.id)
-                if member.status in ['member', 'administrator', 'creator']:
-                    verified_items.append(('group', group))
-                    total_reward += group.reward_amount
-                    
-            except Exception as e:
-                logger.error(f"Error checking group {group.title}: {e}")
-                continue
+        # Check membership in all of them at once
+        memberships = await check_memberships([chat_ref for _, _, chat_ref in pending_items], callback.from_user.id)
+        verified_chat_refs = []
+        for (item_type, item, chat_ref), is_member in zip(pending_items, memberships):
+            if is_member:
+                verified_items.append((item_type, item))
+                verified_chat_refs.append(chat_ref)
+                total_reward += item.reward_amount
+        
+        if total_reward > 0:
+            # Claim the rewards first; items a concurrent click already claimed are skipped
+            awarded_ids = {
+                'channel': record_rewards(db, UserChannelReward, 'channel_id', user.id, [
+                    item.id for item_type, item in verified_items if item_type == 'channel'
+                ]),
+                'group': record_rewards(db, UserGroupReward, 'group_id', user.id, [
+                    item.id for item_type, item in verified_items if item_type == 'group'
+                ])
+            }
+            verified_items = [(item_type, item) for item_type, item in verified_items if item.id in awarded_ids[item_type]]
+            total_reward = sum(item.reward_amount for _, item in verified_items)
         
         if total_reward > 0:
             # Add balance
-            user_obj = db.query(User).filter(User.id == user.id).first()
-            user_obj.balance += total_reward
-            
-            # Create records and transactions
-            for item_type, item in verified_items:
-                if item_type == 'channel':
-                    reward_record = db.query(UserChannelReward).filter(
-                        UserChannelReward.user_id == user.id,
-                        UserChannelReward.channel_id == item.id
-                    ).first()
-                    
-                    if not reward_record:
-                        reward_record = UserChannelReward(
-                            user_id=user.id,
-                            channel_id=item.id,
-                            times_awarded=1
-                        )
-                        db.add(reward_record)
-                    else:
-                        reward_record.times_awarded += 1
-                    
-                    reward_record.last_award_at = datetime.now()
-                    
-                    transaction = Transaction(
-                        user_id=user.id,
-                        type=TransactionType.REWARD,
-                        amount=item.reward_amount,
-                        reason=f"مكافأة الاشتراك في {item.title}"
-                    )
-                    db.add(transaction)
-                    
-                elif item_type == 'group':
-                    reward_record = db.query(UserGroupReward).filter(
-                        UserGroupReward.user_id == user.id,
-                        UserGroupReward.group_id == item.id
-                    ).first()
-                    
-                    if not reward_record:
-                        reward_record = UserGroupReward(
-                            user_id=user.id,
-                            group_id=item.id,
-                            times_awarded=1
-                        )
-                        db.add(reward_record)
-                    else:
-                        reward_record.times_awarded += 1
-                    
-                    reward_record.last_award_at = datetime.now()
-                    
-                    transaction = Transaction(
-                        user_id=user.id,
-                        type=TransactionType.REWARD,
-                        amount=item.reward_amount,
-                        reason=f"مكافأة الانضمام لجروب {item.title}"
-                    )
-                    db.add(transaction)
+            credit_user_balance(db, user.id, total_reward)
+            
+            # Create transactions
+            add_reward_transactions(db, user.id, verified_items)
             
             db.commit()
+            forget_reward_memberships(verified_chat_refs, callback.from_user.id)
             
             await callback.answer(f"🎉 تم إضافة {total_reward} وحدة لرصيدك!")
         else:
@@ -4680,12 +5639,7 @@ async def show_history_handler(callback: CallbackQuery):
         
         history_text = "📋 آخر 10 طلبات:\n\n"
         for res in reservations:
-            status_emoji = {
-                ReservationStatus.WAITING_CODE: "⏳",
-                ReservationStatus.COMPLETED: "✅", 
-                ReservationStatus.EXPIRED: "⏰",
-                ReservationStatus.CANCELED: "❌"
-            }.get(res.status, "❓")
+            status_emoji = RESERVATION_STATUS_EMOJI.get(res.status, "❓")
             
             history_text += f"{status_emoji} {res.service.name} - {res.number}\n"
             history_text += f"   📅 {res.created_at.strftime('%Y-%m-%d %H:%M')}\n\n"
@@ -4761,7 +5715,7 @@ async def admin_handler(callback: CallbackQuery, state: FSMContext):
 async def admin_password_handler(message: types.Message, state: FSMContext):
     """Handle admin password verification"""
     if message.text == ADMIN_PASSWORD:
-        admin_sessions[message.from_user.id] = datetime.now()
+        admin_sessions[message.from_user.id] = time.monotonic() + ADMIN_SESSION_TTL
         await state.clear()
         lang_code = get_user_language(str(message.from_user.id))
         success_text = t('admin_login_success', lang_code)
@@ -5143,7 +6097,7 @@ async def handle_balance_amount(message: types.Message, state: FSMContext):
     
     db = get_db()
     try:
-        target_user = db.query(User).filter(User.id == target_user_id).first()
+        target_user = db.get(User, target_user_id)
         if not target_user:
             await message.reply("❌ حدث خطأ، لم يتم العثور على المستخدم")
             await state.clear()
@@ -5474,26 +6428,30 @@ async def admin_cleanup_numbers_handler(callback: CallbackQuery):
             deleted_count = deleted_used + deleted_overused + orphaned_numbers
             
             # Reset ALL expired reservations
-            expired_reservations = db.query(Reservation).filter(
+            expired_reservations = db.query(Reservation.id, Reservation.version, Number.id, Number.status).join(
+                Number, Reservation.number_id == Number.id
+            ).filter(
                 Reservation.status == ReservationStatus.WAITING_CODE,
                 Reservation.expired_at < datetime.now()
             ).all()
             
-            reset_count = 0
-            for reservation in expired_reservations:
-                # Reset number status only if it hasn't received a code
-                number = db.query(Number).filter(Number.id == reservation.number_id).first()
-                if number and number.status != 'USED':  # Don't reset numbers that received codes
-                    number.status = 'AVAILABLE'
-                    number.reserved_by_user_id = None
-                    number.reserved_at = None
-                    number.expires_at = None
-                    reset_count += 1
-                
-                # Update reservation status
-                reservation.status = ReservationStatus.EXPIRED
+            # Reset number status only if it hasn't received a code
+            number_updates = [
+                {'id': number_id, 'status': 'AVAILABLE', 'reserved_by_user_id': None, 'reserved_at': None, 'expires_at': None}
+                for _, _, number_id, number_status in expired_reservations
+                if number_status != NumberStatus.USED  # Don't reset numbers that received codes
+            ]
+            reset_count = len(number_updates)
+            
+            db.bulk_update_mappings(Number, number_updates)
+            db.bulk_update_mappings(Reservation, [
+                {'id': reservation_id, 'version': version, 'status': ReservationStatus.EXPIRED}
+                for reservation_id, version, _, _ in expired_reservations
+            ])
+            bump_system_counters(db, failed=len(expired_reservations))
             
             db.commit()
+            invalidate_system_stats()
             logger.info(f"Cleanup successful: deleted {deleted_count} numbers, reset {reset_count} reservations")
             
             await callback.answer(
@@ -5579,6 +6537,19 @@ async def admin_cleanup_menu_handler(callback: CallbackQuery):
     finally:
         db.close()
 
+def release_expired_reservations(db, expired_reservations: List[tuple]) -> int:
+    """Mark (reservation_id, version, number_id) rows as expired and make their numbers available again"""
+    db.bulk_update_mappings(Number, [
+        {'id': number_id, 'status': 'AVAILABLE', 'reserved_by_user_id': None, 'reserved_at': None, 'expires_at': None}
+        for _, _, number_id in expired_reservations
+    ])
+    db.bulk_update_mappings(Reservation, [
+        {'id': reservation_id, 'version': version, 'status': ReservationStatus.EXPIRED}
+        for reservation_id, version, _ in expired_reservations
+    ])
+    bump_system_counters(db, failed=len(expired_reservations))
+    return len(expired_reservations)
+
 @dp.callback_query(F.data.startswith("cleanup_"))
 async def admin_cleanup_specific_handler(callback: CallbackQuery):
     """Handle specific service-country cleanup"""
@@ -5600,7 +6571,7 @@ async def admin_cleanup_specific_handler(callback: CallbackQuery):
     db = get_db()
     try:
         # Get service and country info
-        service = db.query(Service).filter(Service.id == service_id).first()
+        service = db.get(Service, service_id)
         country = db.query(ServiceCountry).filter(
             ServiceCountry.service_id == service_id,
             ServiceCountry.country_code == country_code
@@ -5621,25 +6592,18 @@ async def admin_cleanup_specific_handler(callback: CallbackQuery):
         ).delete()
         
         # Reset expired reservations for this combination
-        expired_reservations = db.query(Reservation).join(Number).filter(
+        expired_reservations = db.query(Reservation.id, Reservation.version, Reservation.number_id).join(
+            Number, Reservation.number_id == Number.id
+        ).filter(
             Number.service_id == service_id,
             Number.country_code == country_code,
             Reservation.status == ReservationStatus.WAITING_CODE,
             Reservation.expired_at < datetime.now()
         ).all()
         
-        reset_count = 0
-        for reservation in expired_reservations:
-            number = db.query(Number).filter(Number.id == reservation.number_id).first()
-            if number:
-                number.status = 'AVAILABLE'
-                number.reserved_by_user_id = None
-                number.reserved_at = None
-                number.expires_at = None
-                reset_count += 1
-            reservation.status = ReservationStatus.EXPIRED
-        
+        reset_count = release_expired_reservations(db, expired_reservations)
         db.commit()
+        invalidate_system_stats()
         
         service_name = await get_text(service.name, lang_code)
         success_msg = await translator.translate_text(
@@ -5683,23 +6647,16 @@ async def admin_cleanup_expired_handler(callback: CallbackQuery):
     db = get_db()
     try:
         # Reset expired reservations only
-        expired_reservations = db.query(Reservation).filter(
+        expired_reservations = db.query(Reservation.id, Reservation.version, Reservation.number_id).join(
+            Number, Reservation.number_id == Number.id
+        ).filter(
             Reservation.status == ReservationStatus.WAITING_CODE,
             Reservation.expired_at < datetime.now()
         ).all()
         
-        reset_count = 0
-        for reservation in expired_reservations:
-            number = db.query(Number).filter(Number.id == reservation.number_id).first()
-            if number:
-                number.status = 'AVAILABLE'
-                number.reserved_by_user_id = None
-                number.reserved_at = None
-                number.expires_at = None
-                reset_count += 1
-            reservation.status = ReservationStatus.EXPIRED
-        
+        reset_count = release_expired_reservations(db, expired_reservations)
         db.commit()
+        invalidate_system_stats()
         
         success_msg = await translator.translate_text(
             f"✅ تم إعادة تعيين {reset_count} حجز منتهي الصلاحية فقط",
@@ -5874,7 +6831,7 @@ async def handle_broadcast_message(message: types.Message, state: FSMContext):
         if is_private:
             # Send private message
             target_user_id = data.get("target_user_id")
-            target_user = db.query(User).filter(User.id == target_user_id).first()
+            target_user = db.get(User, target_user_id)
             
             if not target_user:
                 await message.reply("❌ حدث خطأ، لم يتم العثور على المستخدم")
@@ -6053,7 +7010,7 @@ async def delete_channel_confirm_handler(callback: CallbackQuery):
     
     db = get_db()
     try:
-        channel = db.query(Channel).filter(Channel.id == channel_id).first()
+        channel = db.get(Channel, channel_id)
         if not channel:
             await callback.answer("❌ القناة غير موجودة")
             return
@@ -6165,7 +7122,7 @@ async def delete_group_confirm_handler(callback: CallbackQuery):
     
     db = get_db()
     try:
-        group = db.query(Group).filter(Group.id == group_id).first()
+        group = db.get(Group, group_id)
         if not group:
             await callback.answer("❌ الجروب غير موجود")
             return
@@ -6296,13 +7253,14 @@ async def toggle_service_handler(callback: CallbackQuery):
     
     db = get_db()
     try:
-        service = db.query(Service).filter(Service.id == service_id).first()
+        service = db.get(Service, service_id)
         if not service:
             await callback.answer("❌ الخدمة غير موجودة")
             return
         
         service.active = not service.active
         db.commit()
+        load_service_cache()
         
         status_text = "تفعيل" if service.active else "إيقاف"
         await callback.answer(f"✅ تم {status_text} خدمة {service.name}")
@@ -6324,7 +7282,7 @@ async def delete_service_handler(callback: CallbackQuery):
     
     db = get_db()
     try:
-        service = db.query(Service).filter(Service.id == service_id).first()
+        service = db.get(Service, service_id)
         if not service:
             await callback.answer("❌ الخدمة غير موجودة")
             return
@@ -6334,8 +7292,8 @@ async def delete_service_handler(callback: CallbackQuery):
         # Delete all related data to avoid foreign key constraints
         
         # Delete provider messages and blocked messages first
-        db.query(ProviderMessage).filter(ProviderMessage.service_id == service_id).delete()
-        db.query(BlockedMessage).filter(BlockedMessage.service_id == service_id).delete()
+        db.query(ProviderMessage).filter(ProviderMessage.service_id == service_id).delete(synchronize_session=False)
+        db.query(BlockedMessage).filter(BlockedMessage.service_id == service_id).delete(synchronize_session=False)
         
         # Cancel all active reservations
         deleted_reservations = db.query(Reservation).filter(
@@ -6355,6 +7313,7 @@ async def delete_service_handler(callback: CallbackQuery):
         )
         
         db.commit()
+        load_service_cache()
         
         # Show success message with what was deleted
         if deleted_numbers > 0 or deleted_reservations > 0:
@@ -6399,7 +7358,7 @@ async def edit_service_handler(callback: CallbackQuery):
         
         db = get_db()
         try:
-            service = db.query(Service).filter(Service.id == service_id).first()
+            service = db.get(Service, service_id)
             if not service:
                 await callback.answer("❌ الخدمة غير موجودة")
                 return
@@ -6527,7 +7486,7 @@ async def process_edit_service_name(message: types.Message, state: FSMContext):
     
     db = get_db()
     try:
-        service = db.query(Service).filter(Service.id == service_id).first()
+        service = db.get(Service, service_id)
         if not service:
             await message.reply("❌ الخدمة غير موجودة")
             return
@@ -6545,6 +7504,7 @@ async def process_edit_service_name(message: types.Message, state: FSMContext):
         old_name = service.name
         service.name = new_name
         db.commit()
+        load_service_cache()
         
         await state.clear()
         await message.reply(
@@ -6575,7 +7535,7 @@ async def process_edit_service_emoji(message: types.Message, state: FSMContext):
     
     db = get_db()
     try:
-        service = db.query(Service).filter(Service.id == service_id).first()
+        service = db.get(Service, service_id)
         if not service:
             await message.reply("❌ الخدمة غير موجودة")
             return
@@ -6583,6 +7543,7 @@ async def process_edit_service_emoji(message: types.Message, state: FSMContext):
         old_emoji = service.emoji
         service.emoji = new_emoji
         db.commit()
+        load_service_cache()
         
         await state.clear()
         await message.reply(
@@ -6618,7 +7579,7 @@ async def process_edit_service_price(message: types.Message, state: FSMContext):
     
     db = get_db()
     try:
-        service = db.query(Service).filter(Service.id == service_id).first()
+        service = db.get(Service, service_id)
         if not service:
             await message.reply("❌ الخدمة غير موجودة")
             return
@@ -6626,6 +7587,7 @@ async def process_edit_service_price(message: types.Message, state: FSMContext):
         old_price = service.default_price
         service.default_price = new_price
         db.commit()
+        load_service_cache()
         
         await state.clear()
         await message.reply(
@@ -6657,7 +7619,7 @@ async def process_edit_service_description(message: types.Message, state: FSMCon
     
     db = get_db()
     try:
-        service = db.query(Service).filter(Service.id == service_id).first()
+        service = db.get(Service, service_id)
         if not service:
             await message.reply("❌ الخدمة غير موجودة")
             return
@@ -6693,7 +7655,7 @@ async def ban_user_handler(callback: CallbackQuery):
     
     db = get_db()
     try:
-        user = db.query(User).filter(User.id == user_id).first()
+        user = db.get(User, user_id)
         if not user:
             await callback.answer("❌ المستخدم غير موجود")
             return
@@ -6723,7 +7685,7 @@ async def unban_user_handler(callback: CallbackQuery):
     
     db = get_db()
     try:
-        user = db.query(User).filter(User.id == user_id).first()
+        user = db.get(User, user_id)
         if not user:
             await callback.answer("❌ المستخدم غير موجود")
             return
@@ -6990,6 +7952,9 @@ async def check_subscription_handler(callback: CallbackQuery):
     """Handle subscription check"""
     user_id = callback.from_user.id
     
+    # The user may have just joined, so don't trust cached memberships
+    clear_subscription_cache(user_id)
+    
     # Check if user is subscribed to all required channels
     is_subscribed = await check_user_subscription(user_id)
     
@@ -7014,7 +7979,7 @@ async def admin_messages_stats_handler(callback: CallbackQuery):
     db = get_db()
     try:
         # Get message statistics from service groups
-        service_groups = db.query(ServiceGroup).all()
+        service_groups = db.query(ServiceGroup).options(joinedload(ServiceGroup.service)).all()
         
         text = "📊 إحصائيات الرسائل\n\n"
         
@@ -7144,12 +8109,21 @@ async def handle_channel_reward(message: types.Message, state: FSMContext):
         channel_title = data.get('channel_title')
         channel_username = data.get('channel_username')
         
+        # Resolve the chat id once so membership checks don't depend on the username
+        resolved_chat_id = None
+        try:
+            chat = await bot.get_chat(channel_chat_ref(channel_username))
+            resolved_chat_id = chat.id
+        except Exception as e:
+            logger.warning(f"Could not resolve chat id of channel {channel_username}: {e}")
+        
         # Add channel to database
         db = get_db()
         try:
             new_channel = Channel(
                 title=channel_title,
                 username_or_link=channel_username,
+                resolved_chat_id=resolved_chat_id,
                 reward_amount=reward_amount,
                 active=True
             )
@@ -7314,7 +8288,7 @@ async def add_numbers_service_handler(callback: CallbackQuery, state: FSMContext
     
     db = get_db()
     try:
-        service = db.query(Service).filter(Service.id == service_id).first()
+        service = db.get(Service, service_id)
         if not service:
             await callback.answer("❌ الخدمة غير موجودة")
             return
@@ -7431,7 +8405,7 @@ async def process_numbers_bulk(numbers: list, service_id: int) -> dict:
     """Process numbers in bulk with optimized database operations and enhanced error handling"""
     db = get_db()
     try:
-        service = db.query(Service).filter(Service.id == service_id).first()
+        service = db.get(Service, service_id)
         if not service:
             logger.error(f"Service not found: {service_id}")
             return {"added": 0, "duplicates": 0, "invalid": 0, "error": "Service not found"}
@@ -7506,6 +8480,9 @@ async def process_numbers_bulk(numbers: list, service_id: int) -> dict:
             db.execute(insert_stmt, numbers_to_add)
             db.commit()
         
+        if processed_countries:
+            invalidate_service_countries(service_id)
+        
         return {
             "added": added_count,
             "duplicates": duplicate_count,
@@ -7590,10 +8567,6 @@ async def process_numbers_progressive(numbers: list, service_id: int, message) -
             except:
                 pass
             progress_msg = await message.reply(progress_text)
-        
-        # Small delay to prevent hitting rate limits
-        if total_processed < total_numbers:
-            await asyncio.sleep(0.5)
     
     # Final summary message
     final_text = (
@@ -7678,6 +8651,9 @@ async def process_batch_progressive(numbers: list, service_id: int, existing_num
             db.execute(insert_stmt, numbers_to_add)
             db.commit()
         
+        if processed_countries:
+            invalidate_service_countries(service_id)
+        
         return {
             "added": added_count,
             "duplicates": duplicate_count,
@@ -7704,7 +8680,7 @@ async def delete_country_handler(callback: CallbackQuery):
     
     db = get_db()
     try:
-        country = db.query(Country).filter(Country.id == country_id).first()
+        country = db.get(Country, country_id)
         if not country:
             await callback.answer("❌ الدولة غير موجودة")
             return
@@ -7731,12 +8707,74 @@ async def delete_country_handler(callback: CallbackQuery):
         db.close()
 
 # Initialize database
+def backfill_telegram_message_ids(connection):
+    """Copy message ids out of the JSON payload of rows stored before the column existed"""
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text("""
+            UPDATE provider_messages
+            SET telegram_message_id = substring(raw_payload from '"message_id": ([0-9]+)')::int
+            WHERE telegram_message_id IS NULL
+              AND raw_payload ~ '"message_id": [0-9]+'
+        """))
+    elif connection.dialect.name == 'sqlite':
+        connection.execute(text("""
+            UPDATE provider_messages
+            SET telegram_message_id = json_extract(raw_payload, '$.message_id')
+            WHERE telegram_message_id IS NULL
+              AND json_valid(raw_payload)
+              AND json_type(raw_payload, '$.message_id') = 'integer'
+        """))
+
+def dedupe_reward_records(connection):
+    """Keep only the newest reward row per user and channel/group so the unique indexes can be built"""
+    for table_name, item_column in (('user_channel_rewards', 'channel_id'), ('user_group_rewards', 'group_id')):
+        connection.execute(text(f"""
+            DELETE FROM {table_name}
+            WHERE id NOT IN (
+                SELECT MAX(id) FROM {table_name} GROUP BY user_id, {item_column}
+            )
+        """))
+
 def init_db():
     """Initialize database tables"""
     try:
         Base.metadata.create_all(bind=engine)
+        
+        # create_all skips existing tables, so add the columns they are missing
+        inspector = inspect(engine)
+        added_columns = [
+            ('users', 'version', 'INTEGER NOT NULL DEFAULT 0'),
+            ('reservations', 'version', 'INTEGER NOT NULL DEFAULT 0'),
+            ('provider_messages', 'telegram_message_id', 'INTEGER'),
+            ('channels', 'resolved_chat_id', 'BIGINT'),
+        ]
+        for table_name, column_name, column_type in added_columns:
+            if column_name not in {column['name'] for column in inspector.get_columns(table_name)}:
+                with engine.begin() as connection:
+                    connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}"))
+                    if column_name == 'telegram_message_id':
+                        backfill_telegram_message_ids(connection)
+        
+        # Reward upserts rely on unique indexes; rows duplicated by earlier races must go first
+        existing_indexes = {index['name'] for index in inspector.get_indexes('user_channel_rewards')}
+        if 'uq_user_channel_rewards_user_channel' not in existing_indexes:
+            with engine.begin() as connection:
+                dedupe_reward_records(connection)
+        
+        # Likewise add any indexes they are missing
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
         logger.info("Database tables created successfully")
         
+        # Running reservation counters for the stats screens
+        db = get_db()
+        try:
+            seed_system_counters(db)
+            db.commit()
+        finally:
+            db.close()
+        
         # Add default data
         db = get_db()
         try:
@@ -8235,7 +9273,7 @@ async def delete_forced_subscription_handler(callback: CallbackQuery):
     
     db = get_db()
     try:
-        sub = db.query(ForcedSubscription).filter(ForcedSubscription.id == sub_id).first()
+        sub = db.get(ForcedSubscription, sub_id)
         if sub:
             sub.active = False
             db.commit()
@@ -8250,9 +9288,13 @@ async def delete_forced_subscription_handler(callback: CallbackQuery):
 
 async def main():
     """Main function"""
+    global blocked_writer_task
     # Initialize database
     init_db()
     
+    # Load services and their regex patterns into memory
+    load_service_cache()
+    
     # Set bot commands menu
     await set_bot_commands(bot)
     
@@ -8260,6 +9302,14 @@ async def main():
     start_auto_cleanup()
     logger.info("🗑️ Auto cleanup system initialized")
     
+    # Process group messages off the update handlers
+    start_group_message_workers()
+    blocked_writer_task = spawn_background(blocked_message_writer())
+    # Drain the queue first, its messages may add to the blocked buffer
+    dp.shutdown.register(drain_group_message_queue)
+    dp.shutdown.register(flush_blocked_messages_on_shutdown)
+    dp.shutdown.register(close_http_session)
+    
     # Start essential background tasks only (reduced for better performance)
     asyncio.create_task(check_expired_reservations())
     asyncio.create_task(check_user_subscriptions_periodically())
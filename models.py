@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, Enum, BigInteger, FLOAT
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, Enum, BigInteger, FLOAT, Index, text
 from sqlalchemy.types import DECIMAL
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
@@ -43,10 +43,13 @@ class User(Base):
     is_banned = Column(Boolean, default=False)
     last_reward_at = Column(DateTime)
     language_code = Column(String, default='ar')  # Default to Arabic
+    version = Column(Integer, nullable=False, default=0)  # Optimistic concurrency counter
     
     # Relationships
     reservations = relationship("Reservation", back_populates="user")
     transactions = relationship("Transaction", back_populates="user")
+    
+    __mapper_args__ = {'version_id_col': version}
 
 class Service(Base):
     __tablename__ = 'services'
@@ -105,6 +108,16 @@ class Number(Base):
     service = relationship("Service", back_populates="numbers")
     reserved_by = relationship("User")
     reservations = relationship("Reservation", back_populates="number")
+    
+    __table_args__ = (
+        Index('ix_numbers_phone_service', 'phone_number', 'service_id'),
+        Index(
+            'ix_numbers_available_service_country', 'service_id', 'country_code',
+            postgresql_where=text("status = 'AVAILABLE'"),
+            sqlite_where=text("status = 'AVAILABLE'")
+        ),
+        Index('ix_numbers_service_country_status', 'service_id', 'country_code', 'status'),
+    )
 
 class Provider(Base):
     __tablename__ = 'providers'
@@ -141,11 +154,28 @@ class Reservation(Base):
     completed_at = Column(DateTime)
     expired_at = Column(DateTime)
     code_value = Column(String)
+    version = Column(Integer, nullable=False, default=0)  # Optimistic concurrency counter
     
     # Relationships
     user = relationship("User", back_populates="reservations")
     service = relationship("Service", back_populates="reservations")
     number = relationship("Number", back_populates="reservations")
+    
+    __table_args__ = (
+        Index('ix_reservations_number_status_user', 'number_id', 'status', 'user_id'),
+        Index('ix_reservations_user_status', 'user_id', 'status'),
+        Index(
+            'ix_reservations_waiting_expired_at', 'expired_at',
+            postgresql_where=text("status = 'WAITING_CODE'"),
+            sqlite_where=text("status = 'WAITING_CODE'")
+        ),
+        Index(
+            'ix_reservations_waiting_service', 'service_id',
+            postgresql_where=text("status = 'WAITING_CODE'"),
+            sqlite_where=text("status = 'WAITING_CODE'")
+        ),
+    )
+    __mapper_args__ = {'version_id_col': version}
 
 class Transaction(Base):
     __tablename__ = 'transactions'
@@ -159,6 +189,10 @@ class Transaction(Base):
     
     # Relationships
     user = relationship("User", back_populates="transactions")
+    
+    __table_args__ = (
+        Index('ix_transactions_user_created_at', 'user_id', 'created_at'),
+    )
 
 class Channel(Base):
     __tablename__ = 'channels'
@@ -166,6 +200,7 @@ class Channel(Base):
     id = Column(Integer, primary_key=True)
     title = Column(String, nullable=False)
     username_or_link = Column(String, nullable=False)
+    resolved_chat_id = Column(BigInteger)  # Telegram chat ID, resolved when the channel is added
     required = Column(Boolean, default=True)
     active = Column(Boolean, default=True)
     reward_amount = Column(DECIMAL(12, 2), default=5.0)
@@ -193,6 +228,10 @@ class UserChannelReward(Base):
     # Relationships
     user = relationship("User")
     channel = relationship("Channel")
+    
+    __table_args__ = (
+        Index('uq_user_channel_rewards_user_channel', 'user_id', 'channel_id', unique=True),
+    )
 
 class UserGroupReward(Base):
     __tablename__ = 'user_group_rewards'
@@ -206,6 +245,10 @@ class UserGroupReward(Base):
     # Relationships
     user = relationship("User")
     group = relationship("Group")
+    
+    __table_args__ = (
+        Index('uq_user_group_rewards_user_group', 'user_id', 'group_id', unique=True),
+    )
 
 class SecurityMode(enum.Enum):
     TOKEN_ONLY = "token_only"
@@ -244,12 +287,19 @@ class ProviderMessage(Base):
     sender_id = Column(String, nullable=False)
     message_text = Column(Text)
     raw_payload = Column(Text)  # JSON payload
+    telegram_message_id = Column(Integer, index=True)  # Group message id, used to delete it later
     received_at = Column(DateTime, default=func.now())
     status = Column(Enum(MessageStatus), default=MessageStatus.PENDING)
     processed_at = Column(DateTime)
     
     # Relationships
     service = relationship("Service")
+    
+    __table_args__ = (
+        Index('ix_provider_messages_received_at', 'received_at'),
+        Index('ix_provider_messages_status_received_at', 'status', 'received_at'),
+        Index('ix_provider_messages_group_chat_id', 'group_chat_id'),
+    )
 
 class BlockedMessage(Base):
     __tablename__ = 'blocked_messages'
@@ -261,6 +311,10 @@ class BlockedMessage(Base):
     message_text = Column(Text)
     reason = Column(String, nullable=False)
     created_at = Column(DateTime, default=func.now())
+    
+    __table_args__ = (
+        Index('ix_blocked_messages_created_at', 'created_at'),
+    )
 
 class StatsMessage(Base):
     __tablename__ = 'stats_messages'
@@ -322,3 +376,11 @@ class UserSubscriptionStatus(Base):
     # Relationships
     user = relationship("User")
     subscription = relationship("ForcedSubscription")
+
+class SystemCounters(Base):
+    __tablename__ = 'system_counters'
+    
+    id = Column(Integer, primary_key=True)  # Single row, id 1
+    total = Column(BigInteger, nullable=False, default=0)
+    successful = Column(BigInteger, nullable=False, default=0)
+    failed = Column(BigInteger, nullable=False, default=0)